@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Smoke check of multi-seed training on a shipped algorithm config.
+
+Builds MultiSeedPWM for a few seeds from cfg/alg/<alg>.yaml, shrunk to a
+short horizon and small batches, and runs `update` with and without world
+model finetuning on random data.
+
+Usage:
+    python scripts/check_multi_seed.py --alg pwm_5M_flow
+    python scripts/check_multi_seed.py --alg pwm_48M --device cuda:0
+    python scripts/check_multi_seed.py alg.world_model_config.ensemble_size=2 \
+        alg.wm_disagreement_threshold=0.01
+"""
+
+import argparse
+import math
+import sys
+import tempfile
+from pathlib import Path
+
+import torch
+from hydra import compose, initialize_config_dir
+
+# Add PWM to path
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+from flow_mbpo_pwm.algorithms.multi_seed import MultiSeedPWM
+
+CFG_DIR = (Path(__file__).parent / "cfg").resolve()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Smoke check MultiSeedPWM.update")
+    parser.add_argument("--alg", default="pwm_5M_flow", help="Config in cfg/alg")
+    parser.add_argument("--device", default="cpu", help="Torch device")
+    parser.add_argument("--seeds", type=int, default=2, help="Number of seeds")
+    parser.add_argument("--updates", type=int, default=2, help="Updates per mode")
+    parser.add_argument("--horizon", type=int, default=4, help="Rollout horizon")
+    parser.add_argument("--batch-size", type=int, default=16, help="Batch size")
+    parser.add_argument("--obs-dim", type=int, default=24, help="Observation dim")
+    parser.add_argument("--act-dim", type=int, default=6, help="Action dim")
+    parser.add_argument("overrides", nargs="*", help="Further Hydra overrides")
+    args = parser.parse_args()
+
+    with initialize_config_dir(config_dir=str(CFG_DIR), version_base="1.2"):
+        cfg = compose(
+            config_name="config_mt30.yaml",
+            overrides=[
+                f"alg={args.alg}",
+                f"general.device={args.device}",
+                f"horizon={args.horizon}",
+                *args.overrides,
+            ],
+        )
+    # task setup of train_multitask.py, task embeddings only when multitask
+    wm_config = cfg.alg.world_model_config
+    wm_config.task_dim = 64 if wm_config.multitask else 0
+    wm_config.tasks = [cfg.task]
+    wm_config.action_dims = [args.act_dim]
+
+    seeds = list(range(args.seeds))
+    multi_seed = MultiSeedPWM.from_config(
+        cfg.alg,
+        seeds,
+        obs_dim=args.obs_dim,
+        act_dim=args.act_dim,
+        env=None,
+        logdir=tempfile.mkdtemp(),
+        max_epochs=args.updates,
+    )
+
+    N, H, B = args.seeds, args.horizon, args.batch_size
+    device = multi_seed.device
+    task = torch.zeros(B, dtype=torch.long, device=device)
+    for finetune_wm in [False, True]:
+        for i in range(args.updates):
+            obs = torch.randn(N, H + 1, B, args.obs_dim, device=device)
+            act = torch.rand(N, H, B, args.act_dim, device=device) * 2 - 1
+            rew = torch.randn(N, H, B, 1, device=device)
+            multi_seed.update_lrs(i)
+            metrics = multi_seed.update(obs, act, rew, task, finetune_wm)
+            assert len(metrics) == N
+            for m in metrics:
+                for k, v in m.items():
+                    assert math.isfinite(v), f"{k} = {v}"
+        print(f"finetune_wm={finetune_wm}: {metrics[0]}")
+
+    min_logstd = multi_seed.min_logstd
+    if min_logstd is not None:
+        for p in multi_seed.actor_logstd:
+            assert (p >= min_logstd).all(), "stacked logstd below min_logstd"
+    multi_seed.sync_to_agents()
+    print(f"OK: MultiSeedPWM.update on {args.alg} with {N} seeds")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Convert TD-MPC2 .pt dataset shards into a task-indexed, memory-mappable format
+
+The output directory holds one .npy array per field of shape
+[episodes, steps, ...] with the episodes grouped by task, and a meta.json with
+the episode range and observation/reward moments of every task. Read it with
+flow_mbpo_pwm.utils.offline_dataset.OfflineDataset, or point
+general.data_dir (train_multitask.py) or general.pretrain (train_dflex.py) at it.
+
+Usage:
+    python scripts/convert_tdmpc2_dataset.py \
+        --input /data/tdmpc2/mt80 \
+        --output /data/tdmpc2/mt80_converted
+"""
+
+import argparse
+import json
+import os
+import sys
+from glob import glob
+from pathlib import Path
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+# Add PWM to path
+PWM_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(PWM_DIR / "src"))
+
+from flow_mbpo_pwm.utils.offline_dataset import META_FILE
+from flow_mbpo_pwm.utils.streaming import load_dataset_file
+
+
+def episode_tasks(td, chunk_size):
+    """Task id of every episode, 0 for datasets without a task field."""
+    if "task" not in td.keys():
+        return torch.zeros(td.shape[0], dtype=torch.long)
+    return torch.cat(
+        [
+            td["task"][i : i + chunk_size, 0].long()
+            for i in range(0, td.shape[0], chunk_size)
+        ]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert TD-MPC2 datasets")
+    parser.add_argument("--input", required=True, help="Directory of .pt shards or a single .pt file")
+    parser.add_argument("--output", required=True, help="Output directory")
+    parser.add_argument("--chunk-size", type=int, default=256, help="Episodes converted at a time")
+    args = parser.parse_args()
+
+    if os.path.isdir(args.input):
+        paths = sorted(glob(os.path.join(args.input, "*.pt")))
+    else:
+        paths = [args.input]
+    assert len(paths) > 0, f"No data found at {args.input}"
+    os.makedirs(args.output, exist_ok=True)
+
+    # pass 1: count the episodes of every task, reading only the task ids
+    counts, template = {}, None
+    for path in tqdm(paths, desc="Indexing"):
+        td = load_dataset_file(path)
+        if template is None:
+            template = td[:1]
+        assert td.shape[1] == template.shape[1], f"Episode length differs in {path}"
+        tasks, num = episode_tasks(td, args.chunk_size).unique(return_counts=True)
+        for t, n in zip(tasks.tolist(), num.tolist()):
+            counts[t] = counts.get(t, 0) + n
+        del td
+
+    # episodes of every task are stored contiguously, tasks in ascending order
+    ranges, start = {}, 0
+    for t in sorted(counts):
+        ranges[t] = [start, start + counts[t]]
+        start += counts[t]
+    num_episodes, ep_len = start, template.shape[1]
+
+    fields = {}
+    for key, value in template.items():
+        fields[key] = np.lib.format.open_memmap(
+            os.path.join(args.output, f"{key}.npy"),
+            mode="w+",
+            dtype=value.numpy().dtype,
+            shape=(num_episodes, *value.shape[1:]),
+        )
+
+    # pass 2: copy the episodes to the slots of their task, accumulate moments
+    cursor = {t: r[0] for t, r in ranges.items()}
+    moments = {
+        t: {key: [0, 0.0, 0.0] for key in ["obs", "reward"]} for t in ranges
+    }  # count, sum, sum of squares
+    for path in tqdm(paths, desc="Converting"):
+        td = load_dataset_file(path)
+        for i in range(0, td.shape[0], args.chunk_size):
+            chunk = td[i : i + args.chunk_size].clone()
+            tasks = episode_tasks(chunk, args.chunk_size)
+            for t in tasks.unique().tolist():
+                part = chunk[tasks == t]
+                n = part.shape[0]
+                for key in fields:
+                    fields[key][cursor[t] : cursor[t] + n] = part[key].numpy()
+                cursor[t] += n
+                for key, dim in [("obs", template["obs"].shape[-1]), ("reward", 1)]:
+                    x = torch.nan_to_num(part[key].reshape(-1, dim)).double()
+                    m = moments[t][key]
+                    m[0] += x.shape[0]
+                    m[1] = m[1] + x.sum(0)
+                    m[2] = m[2] + x.pow(2).sum(0)
+        del td
+    for arr in fields.values():
+        arr.flush()
+
+    tasks = {}
+    for t, r in ranges.items():
+        tasks[t] = dict(episodes=r)
+        for key, (count, total, sq) in moments[t].items():
+            mean = total / count
+            var = (sq / count - mean**2).clamp(min=0.0)
+            tasks[t][key] = dict(count=count, mean=mean.tolist(), var=var.tolist())
+    meta = dict(
+        num_episodes=num_episodes,
+        episode_length=ep_len,
+        fields=list(fields),
+        tasks=tasks,
+        sources=[os.path.abspath(p) for p in paths],
+    )
+    with open(os.path.join(args.output, META_FILE), "w") as f:
+        json.dump(meta, f)
+    print(f"Wrote {num_episodes} episodes of {len(tasks)} tasks to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,7 @@ from omegaconf import DictConfig, OmegaConf, open_dict
 from hydra.core.hydra_config import HydraConfig
 from flow_mbpo_pwm.utils import hydra_utils
 from flow_mbpo_pwm.utils.common import seeding
+from flow_mbpo_pwm.utils.distributed import get_local_rank, get_rank
 from hydra.utils import instantiate
 
 from IPython.core import ultratb
@@ -69,14 +70,19 @@ def create_wandb_run(wandb_cfg, job_config, run_id=None):
 def train(cfg: DictConfig):
     cfg_full = OmegaConf.to_container(cfg, resolve=True)
 
-    if cfg.general.run_wandb:
+    if cfg.general.run_wandb and get_rank() == 0:
         create_wandb_run(cfg.wandb, cfg_full)
 
     # patch code to make jobs log in the correct directory when doing multirun
     logdir = HydraConfig.get()["runtime"]["output_dir"]
     logdir = os.path.join(logdir, cfg.general.logdir)
 
-    seeding(cfg.general.seed, False)
+    if cfg.alg.get("wm_data_parallel", False) and "cuda" in cfg.general.device:
+        # one GPU per torchrun process
+        cfg.general.device = f"cuda:{get_local_rank()}"
+
+    # ranks sample different data, the initial weights are broadcast by PWM
+    seeding(cfg.general.seed + get_rank(), False)
 
     if "SHAC" in cfg.alg._target_ or "AHAC" in cfg.alg._target_:
         cfg.env.config.no_grad = False
@@ -89,6 +95,13 @@ def train(cfg: DictConfig):
     print("num_actions = ", env.num_actions)
     print("num_obs = ", env.num_obs)
 
+    alg_kwargs = {}
+    if cfg.alg.get("async_collection", False):
+        # the collector process builds its own copy of the env
+        env_config = OmegaConf.to_container(cfg.env.config, resolve=True)
+        env_config["logdir"] = logdir
+        alg_kwargs["env_config"] = OmegaConf.create(env_config)
+
     agent = instantiate(
         cfg.alg,
         env=env,
@@ -96,6 +109,7 @@ def train(cfg: DictConfig):
         act_dim=env.num_actions,
         logdir=logdir,
         log=cfg.general.run_wandb,
+        **alg_kwargs,
     )
 
     if cfg.general.checkpoint:
@@ -142,7 +156,7 @@ def train(cfg: DictConfig):
         f"mean episode loss = {loss:.2f}, mean discounted loss = {discounted_loss:.2f}, mean episode length = {ep_len:.2f}"
     )
 
-    if cfg.general.run_wandb:
+    if cfg.general.run_wandb and get_rank() == 0:
         wandb.finish()
 
 
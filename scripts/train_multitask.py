@@ -17,6 +17,9 @@ from time import time
 
 from envs import make_env
 from flow_mbpo_pwm.utils.common import seeding
+from flow_mbpo_pwm.algorithms.multi_seed import MultiSeedPWM
+from flow_mbpo_pwm.utils.streaming import EpisodeStream, stream_into_buffer
+from flow_mbpo_pwm.utils.offline_dataset import OfflineDataset, load_into_buffer
 from common import TASK_SET
 from copy import deepcopy
 from hydra.core.hydra_config import HydraConfig
@@ -169,6 +172,12 @@ def eval(agent, env, task_set, task_idx, eval_episodes):
     return results
 
 
+def eval_seeds(agents, env, task_set, task_idx, eval_episodes):
+    """Evaluate the agent of every seed and average the results."""
+    results = [eval(agent, env, task_set, task_idx, eval_episodes) for agent in agents]
+    return {k: np.nanmean([r[k] for r in results]) for k in results[0]}
+
+
 @hydra.main(config_path="cfg", config_name="config_mt30.yaml", version_base="1.2")
 def train(cfg: dict):
     """
@@ -227,40 +236,58 @@ def train(cfg: dict):
     # Make algorithm
     obs_dim = env.observation_space.shape[0]
     act_dim = env.action_space.shape[0]
-    agent = instantiate(
-        cfg.alg,
+    alg_kwargs = dict(
         obs_dim=obs_dim,
         act_dim=act_dim,
         env=None,
         logdir=logdir,
         max_epochs=cfg.general.epochs,
     )
+    multi_seed = None
+    if cfg.general.get("num_seeds", 1) > 1:
+        # train all seeds in this process with stacked models
+        seeds = [cfg.general.seed + i for i in range(cfg.general.num_seeds)]
+        multi_seed = MultiSeedPWM.from_config(
+            cfg.alg, seeds, wm_checkpoint=cfg.general.checkpoint, **alg_kwargs
+        )
+        agents = multi_seed.agents
+    else:
+        agent = instantiate(cfg.alg, **alg_kwargs)
 
-    # load model
-    if cfg.general.checkpoint:
-        agent.load_wm(cfg.general.checkpoint)
-        agent.wm_bootstrapped = True
+        # load model
+        if cfg.general.checkpoint:
+            agent.load_wm(cfg.general.checkpoint)
+            agent.wm_bootstrapped = True
+        agents = [agent]
+    agent = agents[0]
 
     cfg.episode_length = 101 if "mt80" in cfg.general.data_dir else 501
     cfg.buffer.buffer_size = 24000 * cfg.episode_length
     buffer = instantiate(cfg.buffer)
 
-    fp = Path(os.path.join(cfg.general.data_dir, "*.pt"))
-    fps = sorted(glob(str(fp)))
-    assert len(fps) > 0, f"No data found at {fp}"
-    print(f"Found {len(fps)} files in {fp}")
-    for fp in tqdm(fps, desc="Loading data"):
-        print("Loading", fp)
-        td = torch.load(fp)
-        assert td.shape[1] == cfg.episode_length, (
-            f"Expected episode length {td.shape[1]} to match config episode length {cfg.episode_length}, "
-            f"please double-check your config."
+    chunk_size = cfg.general.get("data_chunk_size", 256)
+    reservoir = cfg.general.get("data_reservoir", False)
+    if OfflineDataset.is_converted(cfg.general.data_dir):
+        # converted dataset: only the episodes of the task are read
+        dataset = OfflineDataset(cfg.general.data_dir)
+        assert dataset.episode_length == cfg.episode_length, (
+            f"Expected episode length {dataset.episode_length} to match config "
+            f"episode length {cfg.episode_length}, please double-check your config."
+        )
+        num_eps = load_into_buffer(
+            buffer, dataset, task_id, chunk_size=chunk_size, reservoir=reservoir
         )
-        idx = torch.all(td["task"] == task_id, dim=1)
-        td = td[idx]
-        print(f"Found {len(td)} episodes in file.")
-        if td.shape[0] != 0:
-            buffer.add_batch(td)
+    else:
+        fp = Path(os.path.join(cfg.general.data_dir, "*.pt"))
+        fps = sorted(glob(str(fp)))
+        assert len(fps) > 0, f"No data found at {fp}"
+        print(f"Found {len(fps)} files in {fp}")
+        # episodes of the task are streamed in chunks instead of loading whole files
+        stream = EpisodeStream(
+            fps, chunk_size=chunk_size, task_id=task_id, episode_length=cfg.episode_length
+        )
+        num_eps = stream_into_buffer(buffer, stream, reservoir=reservoir)
+    print(f"Found {num_eps} episodes of task {task}")
 
     if buffer.num_eps == 0:
         raise ValueError("No data found for task", task)
@@ -270,9 +297,21 @@ def train(cfg: dict):
     task_ids = torch.tensor([task_id] * cfg.buffer.batch_size, device=agent.device)
     metrics_log = []
     for i in range(cfg.general.epochs):
-        agent.update_lrs(i)
-        obs, act, rew = buffer.sample()
-        train_metrics = agent.update(obs, act, rew, task_ids, cfg.general.finetune_wm)
+        if multi_seed is not None:
+            multi_seed.update_lrs(i)
+            obs, act, rew = multi_seed.sample(buffer)
+            seed_metrics = multi_seed.update(
+                obs, act, rew, task_ids, cfg.general.finetune_wm
+            )
+            train_metrics = {
+                k: np.mean([m[k] for m in seed_metrics]) for k in seed_metrics[0]
+            }
+        else:
+            agent.update_lrs(i)
+            obs, act, rew = buffer.sample()
+            train_metrics = agent.update(
+                obs, act, rew, task_ids, cfg.general.finetune_wm
+            )
 
         metrics = {
             "iteration": i,
@@ -282,11 +321,18 @@ def train(cfg: dict):
 
         # Evaluate agent periodically
         if i % cfg.general.eval_freq == 0:
-            metrics.update(eval(agent, env, task_set, task_id, cfg.general.eval_runs))
+            if multi_seed is not None:
+                multi_seed.sync_to_agents()
+            metrics.update(
+                eval_seeds(agents, env, task_set, task_id, cfg.general.eval_runs)
+            )
             reward = metrics[f"episode_reward"]
             print(f"R: {reward:.2f}")
             if i > 0:
-                agent.save(f"model_{i}", logdir)
+                if multi_seed is not None:
+                    multi_seed.save(f"model_{i}", logdir)
+                else:
+                    agent.save(f"model_{i}", logdir)
 
         if i % 100 == 0:
             if "wm_loss" not in metrics:
@@ -306,16 +352,20 @@ def train(cfg: dict):
             if cfg.general.run_wandb:
                 wandb.log(metrics)
 
-    agent.save(f"model_final", logdir)
+    if multi_seed is not None:
+        multi_seed.save(f"model_final", logdir)
+    else:
+        agent.save(f"model_final", logdir)
     print("Final evaluation")
 
-    metrics.update(eval(agent, env, task_set, task_id, cfg.general.eval_runs))
+    metrics.update(eval_seeds(agents, env, task_set, task_id, cfg.general.eval_runs))
     reward = metrics[f"episode_reward"]
     print(f"Final reward: {reward:.2f}")
 
     # Now do planning
-    agent.planning = True
-    planning_metrics = eval(agent, env, task_set, task_id, cfg.general.eval_runs)
+    for agent in agents:
+        agent.planning = True
+    planning_metrics = eval_seeds(agents, env, task_set, task_id, cfg.general.eval_runs)
     metrics["episode_reward_planning"] = planning_metrics[f"episode_reward"]
     metrics["episode_success_planning"] = planning_metrics[f"episode_success"]
     print(f"Final reward with planning: {metrics['episode_reward_planning']:.2f}")
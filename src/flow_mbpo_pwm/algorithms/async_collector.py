@@ -0,0 +1,268 @@
+"""
+Asynchronous env collection for PWM.
+
+A collector process steps its own copy of the env with a periodically
+refreshed snapshot of the actor and the world model encoder, while the
+learner process runs the actor, critic and world model updates. Weights are
+published through shared memory and the collector writes finished episodes
+straight into a `SharedBuffer`, so only episode statistics cross the queue.
+"""
+
+import copy
+import queue as queue_lib
+import time
+
+import torch
+import torch.multiprocessing as mp
+from hydra.utils import instantiate
+
+from flow_mbpo_pwm.utils.buffer import EpisodeStager
+from flow_mbpo_pwm.utils.common import print_info, print_warning
+from flow_mbpo_pwm.utils.rollout_stats import sanitize_obs_
+
+
+# layout of the shared collector statistics
+STAT_ENV_TIME, STAT_POLICY_TIME, STAT_WAIT_TIME, STAT_TOTAL_TIME, STAT_STEPS = range(5)
+
+# world model parameters used by `wm.encode`, the only part the collector runs
+ENCODER_PREFIXES = ("_encoder.", "_task_emb.")
+
+
+class WeightSnapshot:
+    """
+    Versioned copy of the actor, world model encoder and observation
+    normalization in shared CPU memory. Written by the learner with `publish`
+    and read by the collector with `load_into`. The dynamics, reward and
+    other world model heads are never run by the collector and not shared.
+    """
+
+    def __init__(self, actor, wm, obs_rms=None):
+        self.actor = self._share(actor.state_dict())
+        self.encoder = self._share(self._encoder_state(wm))
+        self.obs_rms = None
+        if obs_rms is not None:
+            self.obs_rms = dict(
+                mean=obs_rms.mean.detach().cpu().clone().share_memory_(),
+                var=obs_rms.var.detach().cpu().clone().share_memory_(),
+            )
+        self.version = mp.get_context("spawn").Value("l", 0)
+
+    @staticmethod
+    def _share(state_dict):
+        return {k: v.detach().cpu().clone().share_memory_() for k, v in state_dict.items()}
+
+    @staticmethod
+    def _encoder_state(wm):
+        return {
+            k: v for k, v in wm.state_dict().items() if k.startswith(ENCODER_PREFIXES)
+        }
+
+    @torch.no_grad()
+    def publish(self, actor, wm, obs_rms=None):
+        """Copy the current learner weights into shared memory."""
+        with self.version.get_lock():
+            for k, v in actor.state_dict().items():
+                self.actor[k].copy_(v)
+            for k, v in self._encoder_state(wm).items():
+                self.encoder[k].copy_(v)
+            if self.obs_rms is not None:
+                self.obs_rms["mean"].copy_(obs_rms.mean)
+                self.obs_rms["var"].copy_(obs_rms.var)
+            self.version.value += 1
+
+    @torch.no_grad()
+    def load_into(self, actor, wm, obs_rms=None):
+        """Load the latest snapshot into local modules. Returns its version."""
+        with self.version.get_lock():
+            actor.load_state_dict(self.actor)
+            wm.load_state_dict(self.encoder, strict=False)
+            if self.obs_rms is not None:
+                obs_rms.mean.copy_(self.obs_rms["mean"])
+                obs_rms.var.copy_(self.obs_rms["var"])
+            return self.version.value
+
+
+def _collector_main(
+    env_config,
+    actor,
+    wm,
+    obs_rms,
+    snapshot,
+    buffer,
+    queue,
+    stop,
+    stats,
+    steps_per_flush,
+    device,
+):
+    """Entry point of the collector process."""
+    torch.set_grad_enabled(False)
+    env = instantiate(env_config)
+    actor, wm = actor.to(device), wm.to(device)
+    if obs_rms is not None:
+        obs_rms = obs_rms.to(device)
+    version = snapshot.load_into(actor, wm, obs_rms)
+
+    obs = env.reset()
+    stager = EpisodeStager(
+        env.num_envs,
+        env.episode_length + 1,
+        steps_per_flush,
+        env.num_obs,
+        env.num_actions,
+        device,
+    )
+    stager.reset(obs)
+    episode_loss = torch.zeros(env.num_envs, device=device)
+    episode_length = torch.zeros(env.num_envs, dtype=torch.int, device=device)
+
+    start = time.time()
+    while not stop.is_set():
+        if snapshot.version.value != version:
+            version = snapshot.load_into(actor, wm, obs_rms)
+
+        finished_loss, finished_length = [], []
+        for _ in range(steps_per_flush):
+            t0 = time.time()
+            z = wm.encode(obs_rms.normalize(obs) if obs_rms is not None else obs, None)
+            actions = torch.tanh(actor(z))
+            t1 = time.time()
+            obs, rew, done, info = env.step(actions)
+            real_obs = info["obs_before_reset"]
+            sanitize_obs_(obs)
+            sanitize_obs_(real_obs)
+            stager.add(real_obs, actions, rew, info["termination"], done, obs)
+
+            episode_loss -= rew
+            episode_length += 1
+            finished_loss.append(episode_loss[done].cpu())
+            finished_length.append(episode_length[done].cpu())
+            episode_loss.masked_fill_(done, 0.0)
+            episode_length.masked_fill_(done, 0)
+            t2 = time.time()
+
+            with stats.get_lock():
+                stats[STAT_POLICY_TIME] += t1 - t0
+                stats[STAT_ENV_TIME] += t2 - t1
+                stats[STAT_STEPS] += env.num_envs
+
+        stager.flush(buffer)
+        t0 = time.time()
+        ep_loss, ep_length = torch.cat(finished_loss), torch.cat(finished_length)
+        queue.put((ep_loss, ep_length, version, steps_per_flush * env.num_envs))
+        with stats.get_lock():
+            stats[STAT_WAIT_TIME] += time.time() - t0
+            stats[STAT_TOTAL_TIME] = time.time() - start
+
+
+class AsyncCollector:
+    """
+    Learner-side handle of the collector process.
+
+    Args:
+        agent: PWM agent whose actor, world model and obs_rms are published
+        env_config: Hydra config of the env, instantiated inside the collector
+        buffer: SharedBuffer the collector writes finished episodes to
+        steps_per_flush: Env steps between two shipments of finished episodes
+        max_queue: Maximum number of shipments waiting for the learner
+        device: Device of the collector's env and policy (defaults to the agent's)
+    """
+
+    def __init__(
+        self, agent, env_config, buffer, steps_per_flush, max_queue=64, device=None
+    ):
+        ctx = mp.get_context("spawn")
+        self.device = str(device or agent.device)
+        obs_rms = agent.obs_rms.to("cpu") if agent.obs_rms is not None else None
+        self.snapshot = WeightSnapshot(agent.actor, agent.wm, obs_rms)
+        self.queue = ctx.Queue(max_queue)
+        self.stop_event = ctx.Event()
+        self.stats = ctx.Array("d", 5)
+        self.version = 0
+        self._last_stats = [0.0] * 5
+        self._learner_wait = 0.0
+        self._learner_start = None
+        self._process = ctx.Process(
+            target=_collector_main,
+            args=(
+                env_config,
+                copy.deepcopy(agent.actor).cpu(),
+                copy.deepcopy(agent.wm).cpu(),
+                obs_rms,
+                self.snapshot,
+                buffer,
+                self.queue,
+                self.stop_event,
+                self.stats,
+                steps_per_flush,
+                self.device,
+            ),
+            daemon=True,
+        )
+
+    def start(self):
+        print_info(f"Starting async env collector on {self.device}")
+        self._process.start()
+        self._learner_start = time.time()
+
+    def stop(self):
+        self.stop_event.set()
+        self._process.join(timeout=30)
+        if self._process.is_alive():
+            print_warning("Async collector did not stop, terminating it")
+            self._process.terminate()
+
+    def publish(self, agent):
+        """Make the current learner weights visible to the collector."""
+        self.snapshot.publish(agent.actor, agent.wm, agent.obs_rms)
+        self.version = self.snapshot.version.value
+
+    def drain(self, meters=None, block=False):
+        """
+        Collect the statistics of all flushes since the previous call. With
+        `block`, wait until at least one flush has happened. Finished-episode
+        losses and lengths go to the `episode_loss` and `episode_length`
+        AverageMeters in `meters`. Returns the number of env steps collected.
+        """
+        num_steps = 0
+        lag = []
+        while True:
+            if not self._process.is_alive():
+                raise RuntimeError("Async env collector died")
+            try:
+                t0 = time.time()
+                item = self.queue.get(block=block and num_steps == 0, timeout=60)
+                self._learner_wait += time.time() - t0
+            except queue_lib.Empty:
+                if block and num_steps == 0:
+                    continue
+                break
+            ep_loss, ep_length, version, steps = item
+            num_steps += steps
+            lag.append(self.version - version)
+            if meters is not None and ep_loss.numel() > 0:
+                device = meters["episode_loss"].mean.device
+                meters["episode_loss"].update(ep_loss.to(device))
+                meters["episode_length"].update(ep_length.to(device).float())
+        self.policy_lag = sum(lag) / len(lag) if lag else 0.0
+        return num_steps
+
+    def metrics(self):
+        """Per-phase utilization since the previous call."""
+        with self.stats.get_lock():
+            current = list(self.stats)
+        delta = [c - p for c, p in zip(current, self._last_stats)]
+        self._last_stats = current
+        total = max(delta[STAT_TOTAL_TIME], 1e-8)
+        learner_total = max(time.time() - self._learner_start, 1e-8)
+        metrics = {
+            "async/collector_env_util": delta[STAT_ENV_TIME] / total,
+            "async/collector_policy_util": delta[STAT_POLICY_TIME] / total,
+            "async/collector_queue_wait": delta[STAT_WAIT_TIME] / total,
+            "async/collector_sps": delta[STAT_STEPS] / total,
+            "async/learner_wait_frac": self._learner_wait / learner_total,
+            "async/policy_lag": getattr(self, "policy_lag", 0.0),
+        }
+        self._learner_wait = 0.0
+        self._learner_start = time.time()
+        return metrics
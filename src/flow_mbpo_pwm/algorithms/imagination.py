@@ -0,0 +1,178 @@
+"""
+Latent-only imagination rollouts for PWM.
+
+The actor is trained on rollouts of the world model that start from encoded
+replay-buffer observations instead of the live env state, so the actor batch
+size is independent of `num_envs` and no simulator step is needed.
+"""
+
+import torch
+
+from flow_mbpo_pwm.utils.common import print_error, print_warning
+
+
+class ImaginationEngine:
+    """
+    Runs latent imagination rollouts with the world model, actor and critic
+    of a PWM agent and computes the actor loss.
+
+    The critic training buffers (`obs_buf`, `rew_buf`, `done_mask`,
+    `next_values`, `target_values`) are allocated once and reused by every
+    rollout. Imagined trajectories only terminate early when they are
+    truncated for the disagreement of a world model ensemble
+    (`wm_disagreement_threshold`); their untrusted steps are then left out
+    of critic training. Otherwise only the last step of the horizon is
+    marked as done.
+
+    Args:
+        agent: PWM agent providing wm, actor, critic and the rollout settings
+        batch_size: Number of imagined trajectories per rollout
+    """
+
+    def __init__(self, agent, batch_size):
+        self.agent = agent
+        self.batch_size = batch_size
+        self._allocate(batch_size)
+
+    def _allocate(self, batch_size):
+        agent = self.agent
+        shape = (agent.horizon, batch_size)
+        kwargs = dict(dtype=torch.float32, device=agent.device)
+        self.batch_size = batch_size
+        self.obs_buf = torch.zeros((*shape, agent.latent_dim), **kwargs)
+        self.rew_buf = torch.zeros(shape, **kwargs)
+        self.next_values = torch.zeros(shape, **kwargs)
+        self.target_values = torch.zeros(shape, **kwargs)
+        # truncation at the end of the horizon is the only way to be done
+        self.done_mask = torch.zeros(shape, **kwargs)
+        self.done_mask[-1] = 1.0
+
+    def rollout(self, z, task=None, return_disagreement=False):
+        """
+        Imagine `horizon` steps from the latents `z`. Has no side effects, so
+        it can be vmapped over stacked agents. Returns the latents the actor
+        acted on, the rewards and the values of the next latents, each
+        stacked over the horizon. The rewards include the disagreement
+        penalty of a world model ensemble, and with `return_disagreement` the
+        per-step disagreement [H, B] is returned as well.
+        """
+        agent = self.agent
+        steps = []
+        for i in range(agent.horizon):
+            actions = agent.actor(z.detach() if agent.detach else z)
+            actions = torch.tanh(actions)
+
+            step = dict(z=z, actions=actions)
+            heads = not agent.batched_heads
+            out = agent._imagine_step(z, actions, task, heads)
+            if heads:
+                z, step["rew"], step["value"] = out
+            else:
+                z = out
+            step["z_next"] = z
+            if agent.use_disagreement:
+                step["disagreement"] = agent.wm.last_disagreement
+            steps.append(step)
+
+        if agent.batched_heads:
+            rews, values = agent._batched_heads(steps, task)
+        else:
+            rews = torch.stack([step["rew"] for step in steps])
+            values = torch.stack([step["value"] for step in steps])
+        zs = torch.stack([step["z"] for step in steps]).detach()
+
+        disagreement = None
+        if agent.use_disagreement:
+            disagreement = torch.stack([step["disagreement"] for step in steps])
+            if agent.wm_disagreement_penalty > 0:
+                rews = rews - agent.wm_disagreement_penalty * disagreement
+        if return_disagreement:
+            return zs, rews, values, disagreement
+        return zs, rews, values
+
+    def alive_mask(self, disagreement):
+        """
+        Mask [H, B] of the steps whose prediction is trusted, a rollout is
+        truncated at the first step whose disagreement exceeds
+        `wm_disagreement_threshold`.
+        """
+        agent = self.agent
+        keep = (disagreement.detach() <= agent.wm_disagreement_threshold).float()
+        return keep.cumprod(dim=0)
+
+    def discounted_return(self, rews, values, alive=None, start_values=None):
+        """
+        Discounted return over the horizon, bootstrapped from the last value.
+        With an `alive_mask`, a rollout truncated at step i leaves out the
+        reward of that step and is bootstrapped from `start_values[i]`, the
+        value of the last trusted latent, instead.
+        """
+        agent = self.agent
+        discount = agent.gamma ** torch.arange(
+            agent.horizon + 1, dtype=torch.float32, device=rews.device
+        )
+        if alive is None:
+            returns = (discount[:-1, None] * rews).sum(dim=0)
+            return returns + agent.gamma * discount[-1] * values[-1]
+        stop = torch.cat([1.0 - alive[:1], alive[:-1] - alive[1:]])  # truncated at step i
+        returns = (discount[:-1, None] * rews * alive).sum(dim=0)
+        returns = returns + (discount[:-1, None] * stop * start_values).sum(dim=0)
+        return returns + agent.gamma * discount[-1] * alive[-1] * values[-1]
+
+    def actor_loss(self, obs, task=None):
+        """
+        Imagine `horizon` steps from the (unnormalized) observations `obs`
+        and return the actor loss. Fills the critic training buffers.
+        """
+        agent = self.agent
+        bsz = obs.shape[0]
+        if bsz != self.batch_size:
+            self._allocate(bsz)
+
+        if agent.obs_rms:
+            obs = agent.obs_rms.normalize(obs)
+        z = agent.wm.encode(obs, task)
+        zs, rews, values, disagreement = self.rollout(
+            z, task, return_disagreement=True
+        )
+        with torch.no_grad():
+            self.obs_buf.copy_(zs)
+
+        # sanity checks over the whole rollout
+        if agent.sync_free:
+            agent.rollout_stats.count("nan_model_reward", torch.isnan(rews))
+            agent.rollout_stats.count("next_value_error", values.abs() > 1e6)
+        else:
+            if torch.any(torch.isnan(rews)):
+                print_warning("NaN reward from model!")
+            if (values.abs() > 1e6).any():
+                print_error("next value error")
+        rews = torch.nan_to_num(rews, 0.0, 0.0, 0.0)
+
+        alive = start_values = None
+        if disagreement is not None:
+            agent.rollout_disagreement = disagreement.detach().mean()
+            if agent.wm_disagreement_threshold is not None:
+                alive = self.alive_mask(disagreement)
+                agent.rollout_truncated = 1.0 - alive[-1].mean()
+                # values of the latents the steps start from
+                start_value = agent.critic(z).min(dim=0).values.view(1, bsz)
+                start_values = torch.cat([start_value, values[:-1]])
+        actor_loss = -self.discounted_return(rews, values, alive, start_values)
+
+        with torch.no_grad():
+            self.rew_buf.copy_(rews)
+            self.next_values.copy_(values)
+            if alive is not None:
+                # the step before a truncation bootstraps from its trusted
+                # latent, truncated steps are left out of critic training
+                self.done_mask[:-1].copy_(alive[:-1] - alive[1:])
+                self.obs_buf.masked_fill_(alive[..., None] == 0, float("nan"))
+
+        if agent.ret_rms is not None:
+            agent.ret_rms.update(actor_loss)
+            actor_loss = actor_loss / torch.sqrt(agent.ret_rms.var + 1e-5)
+        else:
+            actor_loss = actor_loss / agent.horizon
+
+        return actor_loss.mean()
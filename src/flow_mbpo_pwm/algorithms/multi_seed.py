@@ -0,0 +1,343 @@
+"""
+Training several seeds of PWM in one process.
+
+The actor, critic and world model parameters of all seeds are stacked along a
+leading seed dimension and every loss is evaluated with a single vmapped call,
+so all seeds share one kernel launch per layer. Each seed keeps its own
+optimizer state (Adam is element-wise on the stacked parameters), its own RNG
+stream for data sampling and its own checkpoint directory.
+
+The noise drawn inside the vmapped calls (actor sampling, flow τ draws) is
+not covered by the per-seed streams: vmap draws it for all seeds from the
+global generator, so the run of a seed depends on the number of seeds and
+its position among them, and differs from a single-seed run.
+"""
+
+from contextlib import contextmanager
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+from hydra.utils import instantiate
+
+from flow_mbpo_pwm.algorithms.imagination import ImaginationEngine
+from flow_mbpo_pwm.models.model_utils import SeedStack
+from flow_mbpo_pwm.utils.common import filter_dict, print_error, print_info, print_warning, seeding
+from flow_mbpo_pwm.utils.targets import compute_target_values
+
+
+def _clip_per_seed(params, max_norm):
+    """
+    `clip_grad_norm_` applied separately to every seed of stacked parameters.
+    Returns the per-seed gradient norms before clipping.
+    """
+    grads = [p.grad for p in params if p.grad is not None]
+    norms = torch.stack([g.flatten(1).pow(2).sum(1) for g in grads]).sum(0).sqrt()
+    if max_norm is not None:
+        scale = (max_norm / (norms + 1e-6)).clamp(max=1.0)
+        for g in grads:
+            g.mul_(scale.view(-1, *([1] * (g.dim() - 1))))
+    return norms
+
+
+class MultiSeedPWM:
+    """
+    Vectorized offline training (`PWM.update`) of one PWM agent per seed.
+
+    The agents must share their config. Their modules keep the initial
+    weights of their seed; the trained weights live in the stacked modules
+    and are copied back by `sync_to_agents`, e.g. before evaluating or
+    saving a single seed.
+
+    Args:
+        agents: PWM agents, one per seed
+        seeds: Seed of every agent, used to name the checkpoint directories
+        rng_states: Per-seed (cpu, cuda) RNG states to start the data sampling
+            streams from
+    """
+
+    def __init__(self, agents, seeds, rng_states=None):
+        if len(agents) != len(seeds):
+            print_error("need one seed per agent")
+        agent = agents[0]
+        if agent.actor_checkpoint is not None or agent.flow_integrator == "adaptive":
+            print_error("multi-seed training needs fixed-step solvers without checkpointing")
+        if agent.jump_optimizer is not None or agent.wm_data_parallel:
+            print_warning("jump head and WM data parallelism are ignored with multiple seeds")
+
+        self.agents = agents
+        self.seeds = list(seeds)
+        self.num_seeds = len(agents)
+        self.device = agent.device
+        self.horizon = agent.horizon
+        self.engine = agent.imagination or ImaginationEngine(agent, 1)
+
+        self.stack = SeedStack(self._modules(agent), [self._modules(a) for a in agents])
+        self.wm_optimizer = self.stack.stack_optimizer(agent.wm_optimizer)
+        self.actor_optimizer = self.stack.stack_optimizer(agent.actor_optimizer)
+        self.critic_optimizer = self.stack.stack_optimizer(agent.critic_optimizer)
+        stacked = self.stack.stacked_parameters()
+        self.wm_params = [p for k, p in stacked.items() if k.startswith("wm.")]
+        self.actor_params = [p for k, p in stacked.items() if k.startswith("actor.")]
+        self.critic_params = [p for k, p in stacked.items() if k.startswith("critic.")]
+        # stacked log std of stochastic actors, clamped after every actor step
+        self.min_logstd = getattr(agent.actor, "min_logstd", None)
+        self.actor_logstd = [
+            stacked[k] for k in ["actor.logstd", "actor.init_logstd"] if k in stacked
+        ]
+
+        if rng_states is None:
+            rng_states = [self._get_rng_state()] * self.num_seeds
+        self._rng_states = list(rng_states)
+
+        print_info(f"Training {self.num_seeds} seeds {self.seeds} in one process")
+
+    @staticmethod
+    def _modules(agent):
+        return nn.ModuleDict(dict(wm=agent.wm, actor=agent.actor, critic=agent.critic))
+
+    @classmethod
+    def from_config(cls, alg_config, seeds, wm_checkpoint=None, **kwargs):
+        """
+        Instantiate one agent per seed from the `alg` config, each after
+        seeding, and optionally load a pretrained world model into all of them.
+        """
+        agents, rng_states = [], []
+        for seed in seeds:
+            seeding(seed)
+            agent = instantiate(alg_config, **kwargs)
+            if wm_checkpoint:
+                agent.load_wm(wm_checkpoint)
+                agent.wm_bootstrapped = True
+            agents.append(agent)
+            rng_states.append(cls._get_rng_state())
+        return cls(agents, seeds, rng_states)
+
+    @staticmethod
+    def _get_rng_state():
+        cuda = torch.cuda.get_rng_state() if torch.cuda.is_available() else None
+        return torch.get_rng_state(), cuda
+
+    @staticmethod
+    def _set_rng_state(state):
+        cpu, cuda = state
+        torch.set_rng_state(cpu)
+        if cuda is not None:
+            torch.cuda.set_rng_state(cuda)
+
+    @contextmanager
+    def rng(self, i):
+        """Run the enclosed code on the RNG stream of seed `i`."""
+        outer = self._get_rng_state()
+        self._set_rng_state(self._rng_states[i])
+        try:
+            yield
+        finally:
+            self._rng_states[i] = self._get_rng_state()
+            self._set_rng_state(outer)
+
+    def sample(self, buffers):
+        """Sample one batch per seed, stacked along a leading seed dimension."""
+        if not isinstance(buffers, (list, tuple)):
+            buffers = [buffers] * self.num_seeds
+        batches = []
+        for i, buffer in enumerate(buffers):
+            with self.rng(i):
+                batches.append(buffer.sample())
+        return tuple(torch.stack(x) for x in zip(*batches))
+
+    def update_lrs(self, epoch):
+        """Apply the learning rate schedule of the agents to the stacked optimizers."""
+        lrs = self.agents[0].update_lrs(epoch)
+        for stacked, own in [
+            (self.actor_optimizer, self.agents[0].actor_optimizer),
+            (self.critic_optimizer, self.agents[0].critic_optimizer),
+            (self.wm_optimizer, self.agents[0].wm_optimizer),
+        ]:
+            for group, own_group in zip(stacked.param_groups, own.param_groups):
+                group["lr"] = own_group["lr"]
+        return lrs
+
+    def update(self, obs, act, rew, task, finetune_wm=False):
+        """
+        `PWM.update` for all seeds at once. `obs`, `act` and `rew` carry the
+        seeds in their leading dimension, e.g. as returned by `sample`.
+        Returns a list with the metrics of every seed.
+        """
+        agents = self.agents
+        template = agents[0]
+        N, L, bsz = obs.shape[:3]
+        metrics = [dict() for _ in range(N)]
+
+        # train world model
+        if finetune_wm:
+            self.wm_optimizer.zero_grad()
+            wm_loss, dyn_loss, rew_loss = self.stack.call(
+                lambda m, o, a, r: template.wm_losses(o, a, r, task), obs, act, rew
+            )
+            wm_loss.sum().backward()
+            wm_grad_norm = _clip_per_seed(self.wm_params, template.wm_grad_norm)
+            self.wm_optimizer.step()
+            for i in range(N):
+                metrics[i].update(
+                    wm_loss=wm_loss[i].item(),
+                    dynamics_loss=dyn_loss[i].item(),
+                    reward_loss=rew_loss[i].item(),
+                    wm_grad_norm=wm_grad_norm[i].item(),
+                )
+
+        # train actor on imagined rollouts from the first observation
+        self.actor_optimizer.zero_grad()
+        obs0 = obs[:, 0]
+        if template.obs_rms:
+            obs0 = torch.stack([a.obs_rms.normalize(o) for a, o in zip(agents, obs0)])
+
+        # truncation for model disagreement, as in PWM.update
+        truncate = (
+            template.use_disagreement
+            and template.wm_disagreement_threshold is not None
+        )
+
+        def rollout(m, o):
+            z = template.wm.encode(o, task)
+            zs, rews, values, disagreement = self.engine.rollout(
+                z, task, return_disagreement=True
+            )
+            if not truncate:
+                return zs, rews, values
+            # values of the latents the steps start from
+            start_value = template.critic(z).min(dim=0).values.view(1, -1)
+            start_values = torch.cat([start_value, values[:-1]])
+            return zs, rews, values, disagreement, start_values
+
+        out = self.stack.call(rollout, obs0)
+        zs, rews, values = out[:3]
+        if torch.any(torch.isnan(rews)):
+            print_warning("NaN reward from model!")
+        if (values.abs() > 1e6).any():
+            print_error("next value error")
+        rews = torch.nan_to_num(rews, 0.0, 0.0, 0.0)
+
+        alive = None
+        if truncate:
+            disagreement, start_values = out[3:]
+            alive = torch.stack([self.engine.alive_mask(d) for d in disagreement])
+            actor_loss = -torch.stack(
+                [
+                    self.engine.discounted_return(r, v, al, sv)
+                    for r, v, al, sv in zip(rews, values, alive, start_values)
+                ]
+            )
+            # truncated steps are left out of critic training
+            zs = zs.masked_fill(alive[..., None] == 0, float("nan"))
+        else:
+            actor_loss = -torch.stack(
+                [self.engine.discounted_return(r, v) for r, v in zip(rews, values)]
+            )
+        if template.ret_rms is not None:
+            for a, loss in zip(agents, actor_loss):
+                a.ret_rms.update(loss)
+            scale = torch.stack([torch.sqrt(a.ret_rms.var + 1e-5) for a in agents])
+            actor_loss = actor_loss / scale.view(N, -1)
+        else:
+            actor_loss = actor_loss / self.horizon
+        actor_loss = actor_loss.mean(dim=1)
+        actor_loss.sum().backward()
+
+        actor_grad_norm = _clip_per_seed(self.actor_params, template.actor_grad_norm)
+        if torch.isnan(actor_grad_norm).any():
+            print_error("NaN gradient")
+        self.actor_optimizer.step()
+        if self.min_logstd is not None:
+            # the actors' clamp_std would only clamp the template
+            with torch.no_grad():
+                for p in self.actor_logstd:
+                    p.clamp_(min=self.min_logstd)
+
+        # critic targets of all seeds at once
+        target_values = self._target_values(rews.detach(), values.detach(), alive)
+        obs_buf = zs.flatten(1, 2)  # [N, H * bsz, latent]
+        target_values = target_values.flatten(1, 2)
+
+        critic_batch_size = bsz * self.horizon // template.critic_batches
+        num_batches = (obs_buf.shape[1] - 1) // critic_batch_size + 1
+
+        def critic_loss(m, o, t):
+            # skip NaN latents, like CriticDataset
+            valid = (o == o).all(dim=-1)
+            pred = m["critic"](torch.nan_to_num(o)).squeeze(-1)
+            count = valid.sum().clamp(min=1) * pred.shape[0]
+            return ((pred - t) ** 2 * valid).sum() / count
+
+        value_loss = 0.0
+        for j in range(template.critic_iterations):
+            total_critic_loss = 0.0
+            for b in range(num_batches):
+                batch = slice(b * critic_batch_size, (b + 1) * critic_batch_size)
+                self.critic_optimizer.zero_grad()
+                loss = self.stack.call(critic_loss, obs_buf[:, batch], target_values[:, batch])
+                loss.sum().backward()
+                for p in self.critic_params:
+                    p.grad.nan_to_num_(0.0, 0.0, 0.0)
+                critic_grad_norm = _clip_per_seed(self.critic_params, template.critic_grad_norm)
+                self.critic_optimizer.step()
+                total_critic_loss += loss.detach()
+            value_loss += total_critic_loss / num_batches
+        value_loss /= template.critic_iterations
+
+        for i in range(N):
+            metrics[i].update(
+                actor_loss=actor_loss[i].item(),
+                value_loss=value_loss[i].item(),
+                actor_grad_norm=actor_grad_norm[i].item(),
+                critic_grad_norm=critic_grad_norm[i].item(),
+            )
+        return [filter_dict(m) for m in metrics]
+
+    def _target_values(self, rews, values, alive=None):
+        """
+        Critic targets of the agents' critic method for [N, H, bsz] rollouts,
+        with the done flags of `PWM.update`: the env-free `compute_actor_loss`
+        marks every step done, the imagination engine only the last step and
+        the steps before a truncation of the `alive` mask.
+        """
+        template = self.agents[0]
+        done_mask = torch.ones_like(rews)
+        if template.imagination is not None:
+            done_mask.zero_()
+            done_mask[:, -1] = 1.0
+            if alive is not None:
+                done_mask[:, :-1] = alive[:, :-1] - alive[:, 1:]
+        rews, values = rews.transpose(0, 1), values.transpose(0, 1)  # [H, N, bsz]
+        done_mask = done_mask.transpose(0, 1)
+        target_values = compute_target_values(
+            template.critic_method, rews, values, done_mask, template.gamma, template.lam
+        )
+        return target_values.transpose(0, 1)
+
+    def sync_to_agents(self):
+        """Copy the trained weights and optimizer states back into the agents."""
+        self.stack.unstack_into([self._modules(a) for a in self.agents])
+        stacked = self.stack.stacked_parameters()
+        for i, agent in enumerate(self.agents):
+            own_params = dict(self._modules(agent).named_parameters())
+            for opt, own in [
+                (self.wm_optimizer, agent.wm_optimizer),
+                (self.actor_optimizer, agent.actor_optimizer),
+                (self.critic_optimizer, agent.critic_optimizer),
+            ]:
+                for name, p in stacked.items():
+                    if p not in opt.state:
+                        continue
+                    own.state[own_params[name]] = {
+                        k: v[i].clone() if torch.is_tensor(v) and v.dim() > 0 else v
+                        for k, v in opt.state[p].items()
+                    }
+
+    def save(self, filename, log_dir=None):
+        """Save one checkpoint per seed to `<log_dir>/seed_<seed>`."""
+        self.sync_to_agents()
+        for seed, agent in zip(self.seeds, self.agents):
+            seed_dir = Path(log_dir or agent.log_dir) / f"seed_{seed}"
+            seed_dir.mkdir(parents=True, exist_ok=True)
+            agent.save(filename, seed_dir)
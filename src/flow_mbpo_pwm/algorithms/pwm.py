@@ -10,6 +10,7 @@ os.environ['TORCH_COMPILE_DISABLE'] = '1'
 
 import torch
 from torch.nn.utils.clip_grad import clip_grad_norm_
+from torch.utils.checkpoint import checkpoint as activation_checkpoint
 from gym import Env
 import tensordict
 from tensordict import TensorDict
@@ -20,11 +21,30 @@ from collections import OrderedDict
 from flow_mbpo_pwm.utils.common import *
 import flow_mbpo_pwm.utils.torch_utils as tu
 from flow_mbpo_pwm.utils.running_mean_std import RunningMeanStd
-from flow_mbpo_pwm.utils.dataset import CriticDataset
+from flow_mbpo_pwm.utils.critic_trainer import CriticTrainer, critic_adam
+from flow_mbpo_pwm.utils.targets import compute_target_values
 from flow_mbpo_pwm.utils.time_report import TimeReport
 from flow_mbpo_pwm.utils.average_meter import AverageMeter
+from flow_mbpo_pwm.utils.rollout_stats import RolloutStats
+from flow_mbpo_pwm.utils.prefetch import BatchPrefetcher
+from flow_mbpo_pwm.utils.latent_cache import LatentCache
 from flow_mbpo_pwm.models.model_utils import Ensemble
-from flow_mbpo_pwm.utils.buffer import Buffer
+from flow_mbpo_pwm.utils.buffer import Buffer, EpisodeStager
+from flow_mbpo_pwm.utils.shared_buffer import SharedBuffer
+from flow_mbpo_pwm.utils.streaming import EpisodeStream, stream_into_buffer
+from flow_mbpo_pwm.utils.offline_dataset import OfflineDataset, load_into_buffer
+from flow_mbpo_pwm.utils.distributed import (
+    all_reduce_grads,
+    all_reduce_rms,
+    any_rank,
+    broadcast_module,
+    get_rank,
+    get_world_size,
+    init_distributed,
+    is_main_process,
+)
+from flow_mbpo_pwm.algorithms.imagination import ImaginationEngine
+from flow_mbpo_pwm.algorithms.async_collector import AsyncCollector
 from flow_mbpo_pwm.utils.monitoring import TrainingMonitor, WandBLogger, compute_gradient_stats
 from flow_mbpo_pwm.utils.reproducibility import set_seed, ExperimentConfig, DatasetVerifier
 import pickle
@@ -69,16 +89,47 @@ class PWM:
         wm_iterations: int = 8,
         wm_grad_norm: float = 20.0,
         wm_buffer_size: int = 1_000_000,
+        wm_buffer_storage: str = "auto",  # 'auto', 'cuda', 'cpu' or 'memmap'
+        wm_buffer_dtypes: Optional[dict] = None,  # storage dtype per field, e.g. obs: bfloat16
+        wm_buffer_int8_min_range: float = 1.0,  # minimum half-range of int8 fields per feature
+        wm_prefetch: int = 0,  # WM batches prepared ahead in a background thread, 0 = inline
+        wm_latent_cache: Optional[str] = None,  # None, 'versioned' or 'frozen' encoder target cache
+        wm_latent_cache_max_age: Optional[int] = 50,  # WM updates a cached target is served for
+        wm_latent_cache_max_drift: Optional[float] = None,  # relative encoder drift clearing the cache
+        wm_buffer_scratch_dir: Optional[str] = None,  # directory for memmap storage
+        wm_data_chunk_size: int = 256,  # episodes read at a time from offline datasets
+        wm_data_reservoir: bool = False,  # uniformly subsample datasets larger than the buffer
         save_interval: int = 500,  # how often to save policy
         device: str = "cuda",
         save_data: bool = False,
         log: bool = False,
         detach: bool = False,
+        sync_free: bool = False,  # keep rollout checks on device, report per epoch
+        batched_heads: bool = False,  # reward/value heads once over the whole horizon
         # Flow-matching specific parameters
         use_flow_dynamics: bool = False,
-        flow_integrator: str = "heun",  # 'heun' or 'euler'
-        flow_substeps: int = 2,
+        flow_integrator: str = "heun",  # 'euler', 'midpoint', 'heun', 'rk4', 'adaptive'
+        flow_substeps: int = 2,  # initial step size 1/substeps if adaptive
+        flow_max_nfe: Optional[int] = None,  # cap on velocity evals per transition
+        flow_atol: float = 1e-3,  # adaptive solver tolerances
+        flow_rtol: float = 1e-3,
         flow_tau_sampling: str = "uniform",  # 'uniform' or 'midpoint'
+        flow_loss_mode: str = "sequential",  # 'sequential' or 'parallel'
+        flow_consistency_weight: float = 0.0,  # multi-step rollout term (parallel)
+        flow_consistency_substeps: Optional[int] = None,  # defaults to flow_substeps
+        actor_use_jump: bool = False,  # imagine with the distilled jump head
+        actor_checkpoint: Optional[str] = None,  # None, 'step' or 'substep'
+        imagination_batch_size: Optional[int] = None,  # actor batch from replay starts
+        async_collection: bool = False,  # collect env data in a separate process
+        async_sync_interval: int = 1,  # epochs between weight publishes to the collector
+        env_config: Optional[DictConfig] = None,  # env config for the collector process
+        wm_data_parallel: bool = False,  # all-reduce WM gradients over torch.distributed ranks
+        wm_dist_backend: Optional[str] = None,  # nccl on CUDA, gloo otherwise
+        wm_prioritized: bool = False,  # sample WM slices by their last WM loss
+        wm_priority_alpha: float = 0.6,  # priority exponent
+        wm_priority_beta: float = 0.4,  # importance-sampling exponent
+        wm_disagreement_penalty: float = 0.0,  # imagined reward minus this times the WM ensemble disagreement
+        wm_disagreement_threshold: Optional[float] = None,  # truncate imagined rollouts above this disagreement
     ):
         # sanity check parameters
         assert horizon > 0
@@ -92,13 +143,14 @@ class PWM:
         assert critic_batches > 0
         assert critic_method in ["one-step", "td-lambda"]
         assert save_interval > 0
+        assert flow_loss_mode in ["sequential", "parallel"]
+        assert actor_checkpoint in [None, "step", "substep"]
 
         self.env = env
         if env is not None:
             self.num_envs = self.env.num_envs
             self.num_obs = self.env.observation_space.shape[0]
             self.num_actions = self.env.action_space.shape[0]
-            self.episode_data = [None] * self.env.num_envs
         else:
             self.num_obs = obs_dim
             self.num_actions = act_dim
@@ -115,8 +167,18 @@ class PWM:
         self.gamma = gamma
         self.lam = lam
         self.detach = detach
+        self.sync_free = sync_free
+        self.batched_heads = batched_heads
+        self.rollout_stats = RolloutStats(self.device)
         self.critic_batches = critic_batches
 
+        # average meters, also reported by offline updates
+        self.episode_loss_meter = AverageMeter(1, 100).to(self.device)
+        self.episode_discounted_loss_meter = AverageMeter(1, 100).to(self.device)
+        self.episode_primal_meter = AverageMeter(1, 100).to(self.device)
+        self.episode_length_meter = AverageMeter(1, 100).to(self.device)
+        self.horizon_length_meter = AverageMeter(1, 100).to(self.device)
+
         self.critic_method = critic_method
         self.critic_iterations = critic_iterations
         # self.critic_batch_size = self.num_envs * self.horizon // critic_batches
@@ -129,7 +191,17 @@ class PWM:
         self.use_flow_dynamics = use_flow_dynamics
         self.flow_integrator = flow_integrator
         self.flow_substeps = flow_substeps
+        self.flow_kwargs = dict(max_nfe=flow_max_nfe, atol=flow_atol, rtol=flow_rtol)
+        self.flow_nfe = 0
         self.flow_tau_sampling = flow_tau_sampling
+        self.flow_loss_mode = flow_loss_mode
+        self.flow_consistency_weight = flow_consistency_weight
+        self.flow_consistency_substeps = flow_consistency_substeps or flow_substeps
+        self.actor_use_jump = actor_use_jump
+        if actor_checkpoint == "substep" and (actor_use_jump or not use_flow_dynamics):
+            # no ODE substeps to checkpoint
+            actor_checkpoint = "step"
+        self.actor_checkpoint = actor_checkpoint
 
         self.obs_rms = None
         if obs_rms:
@@ -144,18 +216,62 @@ class PWM:
             self.ret_rms = RunningMeanStd(shape=(1,), device=self.device)
 
         # Buffer contains un-normalized data
-        self.buffer = Buffer(
-            buffer_size=wm_buffer_size,
-            batch_size=self.wm_batch_size,
-            horizon=self.horizon,
-            device=device,
+        if async_collection and wm_prioritized:
+            print_error("wm_prioritized is not supported with async_collection")
+        if async_collection:
+            # written by the collector process, sampled by the learner
+            self.buffer = SharedBuffer(
+                buffer_size=wm_buffer_size,
+                batch_size=self.wm_batch_size,
+                horizon=self.horizon,
+                device=device,
+                obs_dim=self.num_obs,
+                act_dim=self.num_actions,
+            )
+        else:
+            self.buffer = Buffer(
+                buffer_size=wm_buffer_size,
+                batch_size=self.wm_batch_size,
+                horizon=self.horizon,
+                device=device,
+                storage=wm_buffer_storage,
+                scratch_dir=wm_buffer_scratch_dir,
+                prioritized=wm_prioritized,
+                priority_alpha=wm_priority_alpha,
+                priority_beta=wm_priority_beta,
+                dtypes=wm_buffer_dtypes,
+                int8_min_half_range=wm_buffer_int8_min_range,
+            )
+        self.wm_prioritized = wm_prioritized
+        self.wm_data_chunk_size = wm_data_chunk_size
+        self.wm_data_reservoir = wm_data_reservoir
+        # sampling of WM batches, overlapped with the updates
+        self.wm_batch_stats = RolloutStats(self.device, fatal=(), context="WM sampling")
+        self.wm_prefetcher = BatchPrefetcher(
+            self._prepare_wm_batch, depth=wm_prefetch, device=self.device
         )
+        if env is not None:
+            # per-env episodes are staged on device and flushed once per rollout
+            self.episode_stager = EpisodeStager(
+                self.num_envs,
+                self.env.episode_length + 1,
+                self.horizon,
+                self.num_obs,
+                self.num_actions,
+                self.device,
+            )
 
         self.actor_grad_norm = actor_grad_norm
         self.critic_grad_norm = critic_grad_norm
         self.save_interval = save_interval
 
-        self.log = log
+        # data-parallel world model training, one process per rank
+        self.wm_data_parallel = wm_data_parallel
+        if wm_data_parallel:
+            init_distributed(wm_dist_backend)
+            print_info(f"WM data parallel: rank {get_rank()} of {get_world_size()}")
+
+        self.log = log and is_main_process()
         self.log_dir = Path(logdir)  # Convert to Path object for proper path operations
         self.log_dir.mkdir(parents=True, exist_ok=True)
         
@@ -206,11 +322,33 @@ class PWM:
             self.actor_lr,
             betas,
         )
-        self.critic_optimizer = torch.optim.Adam(
+        self.critic_optimizer = critic_adam(
             self.critic.parameters(),
             self.critic_lr,
             betas,
+            self.device,
         )
+        self.critic_trainer = CriticTrainer(
+            self.critic,
+            self.critic_optimizer,
+            self.compute_critic_loss,
+            self.critic_iterations,
+            self.critic_grad_norm,
+        )
+
+        # uncertainty-aware imagination with a world model ensemble
+        self.wm_disagreement_penalty = wm_disagreement_penalty
+        self.wm_disagreement_threshold = wm_disagreement_threshold
+        self.use_disagreement = self.wm.ensemble_size > 1 and not actor_use_jump
+        if not self.use_disagreement and (
+            wm_disagreement_penalty > 0 or wm_disagreement_threshold is not None
+        ):
+            print_warning(
+                "wm_disagreement_penalty and wm_disagreement_threshold need a world "
+                "model with ensemble_size > 1 and actor_use_jump off, ignoring them"
+            )
+        self.rollout_disagreement = torch.zeros((), device=self.device)
+        self.rollout_truncated = torch.zeros((), device=self.device)
 
         # Get dynamics/velocity parameters based on model type
         dynamics_params = (self.wm._velocity if hasattr(self.wm, '_velocity') 
@@ -226,6 +364,56 @@ class PWM:
             lr=self.model_lr,
         )
 
+        # one-step jump head distilled from the integrated flow dynamics
+        self.jump_optimizer = None
+        if getattr(self.wm, "_jump", None) is not None:
+            self.jump_optimizer = torch.optim.Adam(
+                self.wm._jump.parameters(), lr=self.model_lr
+            )
+        elif actor_use_jump:
+            print_error("actor_use_jump requires a world model with jump_units")
+
+        # cached encoder latents of replay slots, used as WM targets
+        self.latent_cache = None
+        if wm_latent_cache is not None:
+            assert wm_latent_cache in ["versioned", "frozen"]
+            if not isinstance(self.buffer, Buffer):
+                print_error("the latent cache needs the single-process replay buffer")
+            frozen = wm_latent_cache == "frozen"
+            if frozen:
+                # the encoder and its input normalization stay as loaded
+                self.wm._encoder.requires_grad_(False)
+            self.latent_cache = LatentCache(
+                self.buffer.capacity,
+                self.latent_dim,
+                self.device,
+                max_age=wm_latent_cache_max_age,
+                max_drift=wm_latent_cache_max_drift,
+                frozen=frozen,
+            )
+            self.latent_cache.track(self._encoder_state)
+
+        # actor rollouts from replay-buffer start states
+        self.imagination = None
+        if async_collection and imagination_batch_size is None:
+            # the learner has no live env state to start rollouts from
+            imagination_batch_size = self.num_envs
+        if imagination_batch_size is not None:
+            self.imagination = ImaginationEngine(self, imagination_batch_size)
+
+        # asynchronous env collection, started by train()
+        self.async_collection = async_collection
+        self.async_sync_interval = async_sync_interval
+        self.env_config = env_config
+        self.collector = None
+        if async_collection and env_config is None:
+            print_error("async_collection requires the env_config of the collector")
+
+        if wm_data_parallel:
+            # start all ranks from the weights of rank 0
+            for module in (self.wm, self.actor, self.critic):
+                broadcast_module(module)
+
         # counting variables
         self.iter_count = 0
         self.step_count = 0
@@ -241,6 +429,7 @@ class PWM:
             print_info(f"Using Flow-Matching Dynamics:")
             print_info(f"  - Integrator: {self.flow_integrator}")
             print_info(f"  - Substeps: {self.flow_substeps}")
+            print_info(f"  - Max NFE: {self.flow_kwargs['max_nfe']}")
             print_info(f"  - Tau Sampling: {self.flow_tau_sampling}")
         else:
             print_info("Using Baseline MLP Dynamics")
@@ -293,13 +482,6 @@ class PWM:
         self.episode_end = 0
         self.last_log_steps = 0
 
-        # average meter
-        self.episode_loss_meter = AverageMeter(1, 100).to(self.device)
-        self.episode_discounted_loss_meter = AverageMeter(1, 100).to(self.device)
-        self.episode_primal_meter = AverageMeter(1, 100).to(self.device)
-        self.episode_length_meter = AverageMeter(1, 100).to(self.device)
-        self.horizon_length_meter = AverageMeter(1, 100).to(self.device)
-
         # timer
         self.time_report = TimeReport()
 
@@ -307,6 +489,187 @@ class PWM:
     def mean_horizon(self):
         return self.horizon_length_meter.get_mean()
 
+    def _sanitize_sim_obs(self, obs, real_obs):
+        """Zero out (in-place) non-finite or exploding observations from the sim."""
+        if self.sync_free:
+            self.rollout_stats.sanitize_("bad_sim_obs", obs)
+            self.rollout_stats.sanitize_("bad_sim_real_obs", real_obs)
+            return
+
+        if (~torch.isfinite(obs)).sum() > 0:
+            print_warning("Got inf obs from sim")
+            nan_idx = torch.any(~torch.isfinite(obs), dim=-1)
+            obs[nan_idx] = 0.0
+
+        if (~torch.isfinite(real_obs)).sum() > 0:
+            print_warning("Got inf real_obs from sim")
+            nan_idx = torch.any(~torch.isfinite(real_obs), dim=-1)
+            real_obs[nan_idx] = 0.0
+
+        nan_idx = torch.any(real_obs.abs() > 1e6, dim=-1)
+        if nan_idx.sum() > 0:
+            print_warning("Got large real_obs from sim")
+            real_obs[nan_idx] = 0.0
+
+        nan_idx = torch.any(obs.abs() > 1e6, dim=-1)
+        if nan_idx.sum() > 0:
+            print_warning("Got large obs from sim")
+            obs[nan_idx] = 0.0
+
+    def report_rollout_stats(self):
+        """
+        Dump the on-device rollout statistics of the sync-free mode. Raises on
+        fatal violations, so call it before an update computed from the
+        rollout is applied.
+        """
+        if not self.sync_free:
+            return
+        self.rollout_stats.flush(
+            {
+                "episode_loss": self.episode_loss_meter,
+                "episode_discounted_loss": self.episode_discounted_loss_meter,
+                "episode_primal": self.episode_primal_meter,
+                "episode_length": self.episode_length_meter,
+                "horizon_length": self.horizon_length_meter,
+            }
+        )
+
+    @torch.no_grad()
+    def _track_episodes(self, raw_rew, primal, gt_done, rollout_len):
+        """
+        Accumulate the episode statistics of one env step and dump those of
+        the done envs to the episode meters.
+        """
+        # collect episode stats
+        self.episode_loss -= raw_rew
+        self.episode_discounted_loss -= self.episode_gamma * raw_rew
+        self.episode_primal -= primal
+        self.episode_gamma *= self.gamma
+
+        if self.sync_free:
+            # accumulate on device, dumped by report_rollout_stats
+            stats = self.rollout_stats
+            stats.add("episode_loss", self.episode_loss, gt_done)
+            stats.add(
+                "episode_discounted_loss", self.episode_discounted_loss, gt_done
+            )
+            stats.add("episode_primal", self.episode_primal, gt_done)
+            stats.add("episode_length", self.episode_length, gt_done)
+            stats.add("horizon_length", rollout_len, gt_done)
+
+            # reset trackers
+            rollout_len.masked_fill_(gt_done, 0)
+            self.episode_loss.masked_fill_(gt_done, 0.0)
+            self.episode_discounted_loss.masked_fill_(gt_done, 0.0)
+            self.episode_primal.masked_fill_(gt_done, 0.0)
+            self.episode_length.masked_fill_(gt_done, 0)
+            self.episode_gamma.masked_fill_(gt_done, 1.0)
+        else:
+            # dump data from done episodes
+            gt_done_env_ids = gt_done.nonzero(as_tuple=False).squeeze(-1)
+            self.episode_loss_meter.update(self.episode_loss[gt_done_env_ids])
+            self.episode_discounted_loss_meter.update(
+                self.episode_discounted_loss[gt_done_env_ids]
+            )
+            self.episode_primal_meter.update(self.episode_primal[gt_done_env_ids])
+            self.episode_length_meter.update(self.episode_length[gt_done_env_ids])
+            self.horizon_length_meter.update(rollout_len[gt_done_env_ids])
+
+            # reset trackers
+            rollout_len[gt_done_env_ids] = 0
+            self.episode_loss[gt_done_env_ids] = 0.0
+            self.episode_discounted_loss[gt_done_env_ids] = 0.0
+            self.episode_primal[gt_done_env_ids] = 0.0
+            self.episode_length[gt_done_env_ids] = 0
+            self.episode_gamma[gt_done_env_ids] = 1.0
+
+    @torch.no_grad()
+    def collect_env_data(self, task=None):
+        """
+        Step the envs for one horizon with the current actor acting on the
+        encoded env observations and stage the transitions into the replay
+        buffer. Only the env step and episode bookkeeping is updated; unlike
+        `compute_actor_loss` it leaves the return normalizer and the critic
+        buffers alone, for actors trained on imagined rollouts.
+        """
+        obs = self.env.reset(grads=True)
+        rollout_len = torch.zeros((self.num_envs,), device=self.device)
+        for _ in range(self.horizon):
+            if self.obs_rms:
+                obs = self.obs_rms.normalize(obs)
+            actions = torch.tanh(self.actor(self.wm.encode(obs, task)))
+            obs, gt_rew, gt_done, info = self.env.step(actions)
+            real_obs = info["obs_before_reset"]
+            self._sanitize_sim_obs(obs, real_obs)
+            self.episode_stager.add(
+                real_obs, actions, gt_rew, info["termination"], gt_done, obs
+            )
+
+            if self.sync_free:
+                self.early_termination += torch.sum(info["termination"])
+                self.episode_end += torch.sum(info["truncation"])
+            else:
+                self.early_termination += torch.sum(info["termination"]).item()
+                self.episode_end += torch.sum(info["truncation"]).item()
+            rollout_len += 1
+            self._track_episodes(gt_rew, info["primal"], gt_done, rollout_len)
+
+        self.episode_stager.flush(self.buffer)
+        self.step_count += self.horizon * self.num_envs
+
+    def _wm_next(self, z, a, task):
+        if self.actor_use_jump:
+            return self.wm.jump(z, a, task)
+        if self.use_flow_dynamics:
+            z = self.wm.next(
+                z,
+                a,
+                task,
+                integrator=self.flow_integrator,
+                substeps=self.flow_substeps,
+                checkpoint=self.actor_checkpoint == "substep",
+                **self.flow_kwargs,
+            )
+            self.flow_nfe = self.wm.last_nfe
+            return z
+        return self.wm.next(z, a, task)
+
+    def _imagine_step(self, z, a, task, heads=True):
+        """
+        One imagined transition, optionally with its decoded reward and the
+        ensemble value of the next latent. Checkpointed with actor_checkpoint.
+        """
+        if self.actor_checkpoint == "step" and torch.is_grad_enabled():
+            # recompute the transition during backward
+            return activation_checkpoint(
+                self._transition, z, a, task, heads, use_reentrant=False
+            )
+        return self._transition(z, a, task, heads)
+
+    def _transition(self, z, a, task, heads=True):
+        z_next = self._wm_next(z, a, task)
+        if not heads:
+            return z_next
+        rew = self.wm.almost_two_hot_inv(self.wm.reward(z, a, task)).squeeze()
+        value = self.critic(z_next).min(dim=0).values.squeeze()
+        return z_next, rew, value
+
+    def _batched_heads(self, steps, task):
+        """
+        Decodes the rewards and ensemble values of an imagined rollout with a
+        single [H * bsz] call per head. Returns both as [H, bsz] tensors.
+        """
+        horizon, bsz = len(steps), steps[0]["z"].shape[0]
+        z = torch.stack([step["z"] for step in steps]).flatten(0, 1)
+        a = torch.stack([step["actions"] for step in steps]).flatten(0, 1)
+        z_next = torch.stack([step["z_next"] for step in steps]).flatten(0, 1)
+        if torch.is_tensor(task) and task.numel() > 1:
+            task = task.repeat(horizon)
+
+        rews = self.wm.almost_two_hot_inv(self.wm.reward(z, a, task))
+        values = self.critic(z_next).min(dim=0).values
+        return rews.view(horizon, bsz), values.view(horizon, bsz)
+
     def compute_actor_loss(self, obs=None, task=None):
 
         if obs is None:
@@ -361,7 +724,10 @@ class PWM:
         # keeps track of the current length of the rollout
         rollout_len = torch.zeros((bsz,), device=self.device)
 
-        # Start short horizon rollout
+        # Start short horizon rollout. The imagined trajectory is unrolled first
+        # and the returns are accumulated afterwards, so that with batched_heads
+        # the reward and value heads run once over all H steps.
+        steps = []
         for i in range(self.horizon):
             # collect data for critic training
             with torch.no_grad():
@@ -374,91 +740,33 @@ class PWM:
                 actions = self.actor(z)
 
             actions = torch.tanh(actions)
+            step = dict(z=z, actions=actions)
 
             # NOTE term is not consistent here
-            if self.use_flow_dynamics:
-                z, rew = self.wm.step(z, actions, task, 
-                                      integrator=self.flow_integrator, 
-                                      substeps=self.flow_substeps)
+            # with batched_heads the heads are evaluated after the rollout
+            heads = not self.batched_heads
+            out = self._imagine_step(z, actions, task, heads)
+            if heads:
+                z, step["rew"], step["value"] = out
             else:
-                z, rew = self.wm.step(z, actions, task)
-            rew = self.wm.almost_two_hot_inv(rew).squeeze()
-
-            if torch.any(torch.isnan(rew)):
-                print_warning("NaN reward from model!")
-                rew = torch.nan_to_num(rew, 0.0, 0.0, 0.0)
+                z = out
+            step["z_next"] = z
+            if self.use_disagreement:
+                step["disagreement"] = self.wm.last_disagreement
 
             if self.env:
                 obs, gt_rew, gt_done, info = self.env.step(actions)
-                term = info["termination"]
                 gt_term = info["termination"]
                 gt_trunc = info["truncation"]
                 real_obs = info["obs_before_reset"]
-                primal = info["primal"]
 
                 # sanity check; remove?
-                if (~torch.isfinite(obs)).sum() > 0:
-                    print_warning("Got inf obs from sim")
-                    nan_idx = torch.any(~torch.isfinite(obs), dim=-1)
-                    obs[nan_idx] = 0.0
-
-                if (~torch.isfinite(real_obs)).sum() > 0:
-                    print_warning("Got inf real_obs from sim")
-                    nan_idx = torch.any(~torch.isfinite(real_obs), dim=-1)
-                    real_obs[nan_idx] = 0.0
-
-                nan_idx = torch.any(real_obs.abs() > 1e6, dim=-1)
-                if nan_idx.sum() > 0:
-                    print_warning("Got large real_obs from sim")
-                    real_obs[nan_idx] = 0.0
-
-                nan_idx = torch.any(obs.abs() > 1e6, dim=-1)
-                if nan_idx.sum() > 0:
-                    print_warning("Got large obs from sim")
-                    obs[nan_idx] = 0.0
+                self._sanitize_sim_obs(obs, real_obs)
 
                 # log data to buffer
-                with torch.no_grad():
-
-                    for j in range(self.num_envs):
-                        td = TensorDict(
-                            dict(
-                                obs=real_obs[j].unsqueeze(0),
-                                action=actions[j].unsqueeze(0),
-                                reward=gt_rew[j][None],
-                                term=gt_term[j][None],
-                            ),
-                            (1,),
-                        )
-                        self.episode_data[j].append(td)
-
-                    gt_done_env_ids = gt_done.nonzero(as_tuple=False).squeeze(-1)
-                    for j in gt_done_env_ids:
-                        td = torch.cat(self.episode_data[j])
-                        self.buffer.add(td)
-
-                        # reinint data tracker with with nan action and rewards
-                        a = torch.full_like(
-                            torch.zeros(1, self.num_actions), torch.nan
-                        ).to(self.device)
-                        r = torch.full_like(
-                            torch.zeros(
-                                1,
-                            ),
-                            torch.nan,
-                        ).to(self.device)
-                        tt = torch.full_like(
-                            torch.zeros(
-                                1,
-                            ),
-                            torch.nan,
-                            dtype=torch.bool,
-                        ).to(self.device)
-                        td = TensorDict(
-                            dict(obs=obs[j].unsqueeze(0), action=a, reward=r, term=tt),
-                            (1,),
-                        )
-                        self.episode_data[j] = [td]
+                self.episode_stager.add(
+                    real_obs, actions, gt_rew, gt_term, gt_done, obs
+                )
 
                 with torch.no_grad():
                     raw_rew = gt_rew.clone()
@@ -467,53 +775,157 @@ class PWM:
                 if self.obs_rms:
                     obs = self.obs_rms.normalize(obs)
 
+                # for all done envs we reset observations and cut off gradients
+                # Note this is important to do after critic next value compuataion!
+                done = gt_term | gt_trunc
+                gt_z = self.wm.encode(obs, task)
+                z = torch.where(done[..., None], gt_z, z)
+
+                step.update(
+                    term=gt_term,
+                    gt_trunc=gt_trunc,
+                    gt_done=gt_done,
+                    primal=info["primal"],
+                    raw_rew=raw_rew,
+                )
+            steps.append(step)
+
+        if self.batched_heads:
+            rews, values = self._batched_heads(steps, task)
+        else:
+            rews = [step["rew"] for step in steps]
+            values = [step["value"] for step in steps]
+
+        # rollouts truncated for model disagreement stop contributing until
+        # their env is reset
+        alive = None
+        if self.use_disagreement and self.wm_disagreement_threshold is not None:
+            alive = torch.ones(bsz, dtype=torch.float32, device=self.device)
+            # values of the latents the steps start from, the last trusted
+            # ones of a rollout truncated at that step
+            z_start = torch.stack([step["z"] for step in steps]).flatten(0, 1)
+            start_values = self.critic(z_start).min(dim=0).values
+            start_values = start_values.view(self.horizon, bsz)
+        disagreement_sum = torch.zeros((), device=self.device)
+        truncated = torch.zeros((), device=self.device)
+
+        for i, step in enumerate(steps):
+            rew = rews[i]
+            if self.sync_free:
+                self.rollout_stats.count("nan_model_reward", torch.isnan(rew))
+                rew = torch.nan_to_num(rew, 0.0, 0.0, 0.0)
+            elif torch.any(torch.isnan(rew)):
+                print_warning("NaN reward from model!")
+                rew = torch.nan_to_num(rew, 0.0, 0.0, 0.0)
+
+            trunc = None
+            if self.use_disagreement:
+                disagreement = step["disagreement"]
+                disagreement_sum += disagreement.detach().mean()
+                if self.wm_disagreement_penalty > 0:
+                    rew = rew - self.wm_disagreement_penalty * disagreement
+
+            if self.env:
+                term = gt_term = step["term"]
+                gt_trunc = step["gt_trunc"]
+                gt_done = step["gt_done"]
+                primal = step["primal"]
+                raw_rew = step["raw_rew"]
+                if not self.sync_free:
+                    gt_done_env_ids = gt_done.nonzero(as_tuple=False).squeeze(-1)
+
             # self.episode_length += 1
             rollout_len += 1
 
-            rew_acc[i + 1, :] = rew_acc[i, :] + gamma * rew
+            if alive is None:
+                rew_acc[i + 1, :] = rew_acc[i, :] + gamma * rew
+            else:
+                rew_acc[i + 1, :] = rew_acc[i, :] + gamma * rew * alive
 
-            next_values[i + 1] = self.critic(z).min(dim=0).values.squeeze()
+            next_values[i + 1] = values[i]
 
             if self.env is not None:
                 # handle terminated environments which stopped for some bad reason
                 # since the reason is bad we set their value to 0
-                term_env_ids = term.nonzero(as_tuple=False).squeeze(-1)
-                for id in term_env_ids:
-                    next_values[i + 1, id] = 0.0
+                if self.sync_free:
+                    next_values[i + 1] = next_values[i + 1].masked_fill(term, 0.0)
+                else:
+                    term_env_ids = term.nonzero(as_tuple=False).squeeze(-1)
+                    for id in term_env_ids:
+                        next_values[i + 1, id] = 0.0
 
             # sanity check
-            if (next_values > 1e6).sum() > 0 or (next_values < -1e6).sum() > 0:
+            if self.sync_free:
+                self.rollout_stats.count(
+                    "next_value_error", next_values[i + 1].abs() > 1e6
+                )
+            elif (next_values > 1e6).sum() > 0 or (next_values < -1e6).sum() > 0:
                 print_error("next value error")
                 raise ValueError
 
-            # for all done envs we reset observations and cut off gradients
-            # Note this is important to do after critic next value compuataion!
-            if self.env:
-                done = gt_term | gt_trunc
-                done_env_ids = gt_done.nonzero(as_tuple=False).squeeze(-1)
-                gt_z = self.wm.encode(obs, task)
-                z = torch.where(done[..., None], gt_z, z)
+            untrusted = None
+            if alive is not None:
+                # truncate the rollouts the ensemble disagrees on. The predicted
+                # step is not trusted, so drop its reward and bootstrap with the
+                # critic at the latent it starts from, as for done envs
+                trunc = (disagreement.detach() > self.wm_disagreement_threshold) & (
+                    alive > 0
+                )
+                if self.env is not None:
+                    trunc = trunc & ~gt_done
+                returns = -rew_acc[i] - gamma * start_values[i]
+                actor_loss = actor_loss + torch.where(
+                    trunc, returns, torch.zeros_like(returns)
+                )
+                alive = alive.masked_fill(trunc, 0.0)
+                truncated += trunc.sum()
+                untrusted = alive == 0
 
-                self.early_termination += torch.sum(term).item()
-                self.episode_end += torch.sum(gt_trunc).item()
+            if self.env:
+                if self.sync_free:
+                    self.early_termination += torch.sum(term)
+                    self.episode_end += torch.sum(gt_trunc)
+                else:
+                    self.early_termination += torch.sum(term).item()
+                    self.episode_end += torch.sum(gt_trunc).item()
 
                 if i < self.horizon - 1:
                     # first terminate all rollouts which are 'done'
-                    returns = (
-                        -rew_acc[i + 1, done_env_ids]
-                        - self.gamma
-                        * gamma[done_env_ids]
-                        * next_values[i + 1, done_env_ids]
-                    )
-                    actor_loss[done_env_ids] += returns
+                    if self.sync_free:
+                        returns = (
+                            -rew_acc[i + 1]
+                            - self.gamma * gamma * next_values[i + 1]
+                        )
+                        if alive is not None:
+                            returns = returns * alive
+                        actor_loss = actor_loss + torch.where(
+                            gt_done, returns, torch.zeros_like(returns)
+                        )
+                    else:
+                        returns = (
+                            -rew_acc[i + 1, gt_done_env_ids]
+                            - self.gamma
+                            * gamma[gt_done_env_ids]
+                            * next_values[i + 1, gt_done_env_ids]
+                        )
+                        if alive is not None:
+                            returns = returns * alive[gt_done_env_ids]
+                        actor_loss[gt_done_env_ids] += returns
 
             # compute gamma for next step
             gamma = gamma * self.gamma
 
             if self.env is not None:
                 # clear up gamma and rew_acc for done envs
-                gamma[done_env_ids] = 1.0
-                rew_acc[i + 1, done_env_ids] = 0.0
+                if self.sync_free:
+                    gamma = gamma.masked_fill(gt_done, 1.0)
+                    rew_acc[i + 1] = rew_acc[i + 1].masked_fill(gt_done, 0.0)
+                else:
+                    gamma[gt_done_env_ids] = 1.0
+                    rew_acc[i + 1, gt_done_env_ids] = 0.0
+                if alive is not None:
+                    # reset envs start a fresh rollout
+                    alive = alive.masked_fill(gt_done, 1.0)
 
             # collect data for critic training
             with torch.no_grad():
@@ -522,43 +934,32 @@ class PWM:
                     self.done_mask[i] = gt_done.clone().to(torch.float32)
                 else:
                     self.done_mask[i, :] = 1.0
+                if trunc is not None:
+                    self.done_mask[i].masked_fill_(trunc, 1.0)
+                    if i > 0:
+                        # the previous target bootstraps from the trusted latent
+                        self.done_mask[i - 1].masked_fill_(trunc, 1.0)
+                if untrusted is not None:
+                    # truncated steps are left out of critic training
+                    self.obs_buf[i].masked_fill_(untrusted[:, None], float("nan"))
                 if self.env is not None:
                     self.term_buf[i] = gt_term.clone().to(torch.float32)
                 self.next_values[i] = next_values[i + 1].clone()
 
             # collect episode loss
             if self.env is not None:
-                with torch.no_grad():
-                    # collect episode stats
-                    self.episode_loss -= raw_rew
-                    self.episode_discounted_loss -= self.episode_gamma * raw_rew
-                    self.episode_primal -= primal
-                    self.episode_gamma *= self.gamma
-
-                    # dump data from done episodes
-                    self.episode_loss_meter.update(self.episode_loss[gt_done_env_ids])
-                    self.episode_discounted_loss_meter.update(
-                        self.episode_discounted_loss[gt_done_env_ids]
-                    )
-                    self.episode_primal_meter.update(
-                        self.episode_primal[gt_done_env_ids]
-                    )
-                    self.episode_length_meter.update(
-                        self.episode_length[gt_done_env_ids]
-                    )
-                    self.horizon_length_meter.update(rollout_len[gt_done_env_ids])
-
-                    # reset trackers
-                    rollout_len[gt_done_env_ids] = 0
-                    self.episode_loss[gt_done_env_ids] = 0.0
-                    self.episode_discounted_loss[gt_done_env_ids] = 0.0
-                    self.episode_primal[gt_done_env_ids] = 0.0
-                    self.episode_length[gt_done_env_ids] = 0
-                    self.episode_gamma[gt_done_env_ids] = 1.0
+                self._track_episodes(raw_rew, primal, gt_done, rollout_len)
 
         # terminate all envs because we reached the end of our rollout
         returns = -rew_acc[-1, :] - self.gamma * gamma * next_values[-1, :]
+        if alive is not None:
+            returns = returns * alive
         actor_loss += returns
+        self.rollout_disagreement = disagreement_sum / self.horizon
+        self.rollout_truncated = truncated / bsz
+
+        if self.env is not None:
+            self.episode_stager.flush(self.buffer)
 
         # self.horizon_length_meter.update(rollout_len)
 
@@ -574,6 +975,17 @@ class PWM:
 
         return actor_loss
 
+    def compute_imagined_actor_loss(self, obs, task=None):
+        """
+        Actor loss of latent-only rollouts from the observations `obs`, e.g.
+        replay-buffer start states. The critic training buffers afterwards
+        point at the preallocated buffers of the imagination engine.
+        """
+        actor_loss = self.imagination.actor_loss(obs, task)
+        for name in ["obs_buf", "rew_buf", "done_mask", "next_values", "target_values"]:
+            setattr(self, name, getattr(self.imagination, name))
+        return actor_loss
+
     @torch.no_grad()
     def eval(self, num_games, deterministic=True):
         episode_length_his = []
@@ -610,6 +1022,7 @@ class PWM:
                     task=None,
                     integrator=self.flow_integrator,
                     substeps=self.flow_substeps,
+                    **self.flow_kwargs,
                 )
             else:
                 res = self.wm.step(z, actions, task=None)
@@ -675,31 +1088,14 @@ class PWM:
 
     @torch.no_grad()
     def compute_target_values(self):
-        if self.critic_method == "one-step":
-            self.target_values = self.rew_buf + self.gamma * self.next_values
-        elif self.critic_method == "td-lambda":
-            bsz = self.rew_buf.shape[1]
-            Ai = torch.zeros(bsz, dtype=torch.float32, device=self.device)
-            Bi = torch.zeros(bsz, dtype=torch.float32, device=self.device)
-            lam = torch.ones(bsz, dtype=torch.float32, device=self.device)
-            for i in reversed(range(self.horizon)):
-                lam = lam * self.lam * (1.0 - self.done_mask[i]) + self.done_mask[i]
-                Ai = (1.0 - self.done_mask[i]) * (
-                    self.lam * self.gamma * Ai
-                    + self.gamma * self.next_values[i]
-                    + (1.0 - lam) / (1.0 - self.lam) * self.rew_buf[i]
-                )
-                Bi = (
-                    self.gamma
-                    * (
-                        self.next_values[i] * self.done_mask[i]
-                        + Bi * (1.0 - self.done_mask[i])
-                    )
-                    + self.rew_buf[i]
-                )
-                self.target_values[i] = (1.0 - self.lam) * Ai + lam * Bi
-        else:
-            raise NotImplementedError
+        self.target_values = compute_target_values(
+            self.critic_method,
+            self.rew_buf,
+            self.next_values,
+            self.done_mask,
+            self.gamma,
+            self.lam,
+        )
 
     def compute_critic_loss(self, batch_sample):
         predicted_values = self.critic(batch_sample["obs"]).squeeze(-2)
@@ -725,6 +1121,7 @@ class PWM:
         self.time_report.add_timer("actor training")
         self.time_report.add_timer("critic training")
         self.time_report.add_timer("world model training")
+        self.time_report.add_timer("collector wait")
         self.time_report.start_timer("algorithm")
 
         # Note: WandB logger is initialized externally by train_dflex.py
@@ -754,31 +1151,18 @@ class PWM:
 
         bsz = self.num_envs
 
-        with torch.no_grad():
-            # save data with nan action and rewards
+        # save data with nan action and rewards
+        self.episode_stager.reset(obs)
 
-            for id in range(self.num_envs):
-                act = torch.full_like(torch.zeros(1, self.num_actions), torch.nan).to(
-                    self.device
-                )
-                rew = torch.full_like(
-                    torch.zeros(
-                        1,
-                    ),
-                    torch.nan,
-                ).to(self.device)
-                term = torch.full_like(
-                    torch.zeros(
-                        1,
-                    ),
-                    torch.nan,
-                    dtype=torch.bool,
-                ).to(self.device)
-                td = TensorDict(
-                    dict(obs=obs[id].unsqueeze(0), action=act, reward=rew, term=term),
-                    (1,),
-                )
-                self.episode_data[id] = [td]
+        if self.async_collection:
+            self.collector = AsyncCollector(
+                self, self.env_config, self.buffer, self.horizon
+            )
+            self.collector.start()
+            meters = dict(
+                episode_loss=self.episode_loss_meter,
+                episode_length=self.episode_length_meter,
+            )
 
         def actor_closure():
             self.actor_optimizer.zero_grad()
@@ -786,7 +1170,15 @@ class PWM:
             self.time_report.start_timer("compute actor loss")
 
             self.time_report.start_timer("forward simulation")
-            actor_loss = self.compute_actor_loss()
+            if self.imagination is not None:
+                # step the envs only to collect data, the actor learns from
+                # imagined rollouts starting at replay states
+                if self.collector is None:
+                    self.collect_env_data()
+                obs = self.buffer.sample_obs(self.imagination.batch_size)
+                actor_loss = self.compute_imagined_actor_loss(obs)
+            else:
+                actor_loss = self.compute_actor_loss()
             if torch.isnan(actor_loss):
                 print_error("NaN actor loss")
             self.time_report.end_timer("forward simulation")
@@ -810,14 +1202,26 @@ class PWM:
 
             self.time_report.end_timer("compute actor loss")
 
+            # abort on fatal violations before the optimizer applies the step
+            self.report_rollout_stats()
+
             return actor_loss
 
         # main training process
         for epoch in range(self.max_epochs):
 
-            if self.buffer.num_eps == 0:
-                with torch.no_grad():
-                    self.compute_actor_loss()
+            if self.collector is not None:
+                # wait for the first episodes, afterwards take what has arrived
+                self.time_report.start_timer("collector wait")
+                self.step_count += self.collector.drain(
+                    meters, block=self.buffer.num_eps == 0
+                )
+                self.time_report.end_timer("collector wait")
+            elif any_rank(self.buffer.num_eps == 0, self.device):
+                # decided on all ranks together, the world model update below
+                # all-reduces gradients
+                self.collect_env_data()
+                self.report_rollout_stats()
                 continue
 
             time_start_epoch = time.time()
@@ -845,65 +1249,48 @@ class PWM:
                 ) + self.model_lr
                 for param_group in self.wm_optimizer.param_groups:
                     param_group["lr"] = model_lr
+                if self.jump_optimizer is not None:
+                    for param_group in self.jump_optimizer.param_groups:
+                        param_group["lr"] = model_lr
             else:
                 lr = self.actor_lr
 
             # train actor
             self.time_report.start_timer("actor training")
             actor_loss = self.actor_optimizer.step(actor_closure)
+            if hasattr(self.actor, "clamp_std"):
+                self.actor.clamp_std()
             self.time_report.end_timer("actor training")
 
             # train critic
             # prepare dataset
             self.time_report.start_timer("prepare critic dataset")
-            critic_batch_size = bsz * self.horizon // self.critic_batches
-            with torch.no_grad():
-                self.compute_target_values()
-                dataset = CriticDataset(
-                    critic_batch_size,
-                    self.obs_buf,
-                    self.target_values,
-                )
+            critic_bsz = self.obs_buf.shape[1]
+            critic_batch_size = critic_bsz * self.horizon // self.critic_batches
+            self.compute_target_values()
             self.time_report.end_timer("prepare critic dataset")
 
             # critic training!
             self.time_report.start_timer("critic training")
-            value_loss = 0.0
-            for j in range(self.critic_iterations):
-                total_critic_loss = 0.0
-                batch_cnt = 0
-                for i in range(len(dataset)):
-                    batch_sample = dataset[i]
-                    self.critic_optimizer.zero_grad()
-                    training_critic_loss = self.compute_critic_loss(batch_sample)
-                    training_critic_loss.backward()
-
-                    # ugly fix for simulation nan problem
-                    for params in self.critic.parameters():
-                        params.grad.nan_to_num_(0.0, 0.0, 0.0)
-
-                    critic_grad_norm = clip_grad_norm_(
-                        self.critic.parameters(), self.critic_grad_norm
-                    )
-                    self.critic_optimizer.step()
-
-                    total_critic_loss += training_critic_loss
-                    batch_cnt += 1
-
-                value_loss = total_critic_loss / batch_cnt
-                print(
-                    f"value iter {j + 1}/{self.critic_iterations}, loss = {value_loss:.2f}",
-                    end="\r",
-                )
+            value_losses, critic_grad_norm = self.critic_trainer.train(
+                self.obs_buf, self.target_values, critic_batch_size
+            )
+            value_loss = value_losses[-1] if value_losses else 0.0
+            print(
+                f"value iters {self.critic_iterations}, loss = {value_loss:.2f}",
+                end="\r",
+            )
 
             self.time_report.end_timer("critic training")
 
             self.time_report.start_timer("world model training")
 
             # world model training!
-            tot_wm_loss = tot_dynamics_loss = tot_reward_loss = tot_term_loss = 0.0
-            sample_rew_mean = sample_rew_var = 0.0
-            sample_obs_mean = sample_obs_var = 0.0
+            # accumulated on device, copied to the host once after the loop
+            tot_wm_loss, tot_dynamics_loss, tot_reward_loss, tot_jump_loss = (
+                torch.zeros(4, device=self.device).unbind()
+            )
+            tot_term_loss = 0.0
             if self.wm_bootstrapped:
                 iters = self.wm_iterations
             else:
@@ -911,59 +1298,61 @@ class PWM:
                 print(f"training wm for {iters} iterations")
                 self.wm_bootstrapped = True
 
-            for i in range(0, iters):
-                obs, act, rew = self.buffer.sample()
-
-                if torch.any(torch.isnan(obs)):
-                    print("WARN: NaN obs sampled!")
-                    obs = torch.nan_to_num(obs)
-
-                if torch.any(torch.isnan(rew)):
-                    print("WARN: NaN reward sampled!")
-
-                if self.obs_rms:
-                    self.obs_rms.update(obs.reshape((-1, self.num_obs)))
-                    obs = self.obs_rms.normalize(obs)
-
-                if self.rew_rms:
-                    self.rew_rms.update(rew.reshape((-1, 1)))
-                    rew = self.rew_rms.normalize(rew)
-
-                if torch.any(torch.isnan(rew)):
-                    print("WARN: NaN reward post-processed!")
-
-                sample_rew_mean += rew.mean().item()
-                sample_rew_var += rew.var().item()
-                sample_obs_mean += obs.mean(dim=0).mean().item()
-                sample_obs_var += obs.var(dim=0).mean().item()
-
+            # batches are sampled ahead by the prefetcher and normalized here
+            for i, (obs, act, rew, weights, index) in enumerate(
+                self.wm_prefetcher.batches(iters)
+            ):
+                obs, rew = self._normalize_wm_batch(obs, rew)
                 self.wm_optimizer.zero_grad()
-                loss, dyn_loss, rew_loss = self.compute_wm_loss(obs, act, rew)
+                loss, dyn_loss, rew_loss, sample_loss = self.wm_losses(
+                    obs, act, rew, weights=weights, return_sample_loss=True,
+                    **self._cached_latents(obs, index),
+                )
                 loss.backward()
-                wm_grad_norm = clip_grad_norm_(self.wm.parameters(), self.wm_grad_norm)
+                wm_grad_norm = self._reduce_and_clip_wm_grads()
                 if torch.isnan(wm_grad_norm):
                     print_warning("world model NaN gradient")
-                    for params in self.wm.parameters():
-                        params.grad.nan_to_num_(0.0, 0.0, 0.0)
+                    for params in self._wm_params():
+                        if params.grad is not None:
+                            params.grad.nan_to_num_(0.0, 0.0, 0.0)
                 self.wm_optimizer.step()
-                tot_wm_loss += loss.item()
-                tot_dynamics_loss += dyn_loss
+                if self.latent_cache is not None:
+                    self.latent_cache.step()
+                if index is not None:
+                    with self.wm_prefetcher.lock:
+                        self.buffer.update_priority(index, sample_loss)
+                tot_jump_loss += self.train_jump(obs, act)
+                tot_wm_loss += loss.detach()
+                tot_dynamics_loss += dyn_loss.detach()
                 tot_reward_loss += rew_loss
                 # tot_term_loss += term_loss
-                print(f"wm iter {i+1}/{iters}, loss = {loss:.2f}", end="\r")
+                print(f"wm iter {i+1}/{iters}", end="\r")
 
             # normalize for logging; TODO simplify
-            tot_wm_loss /= iters
-            tot_dynamics_loss /= iters
-            tot_reward_loss /= iters
+            tot_wm_loss, tot_dynamics_loss, tot_reward_loss, tot_jump_loss = (
+                torch.stack(
+                    [tot_wm_loss, tot_dynamics_loss, tot_reward_loss, tot_jump_loss]
+                )
+                / iters
+            ).tolist()
             tot_term_loss /= iters
-            sample_rew_mean /= iters
-            sample_rew_var /= iters
-            sample_obs_mean /= iters
-            sample_obs_var /= iters
+            _, batch_stats = self.wm_batch_stats.flush()
+            sample_rew_mean = batch_stats.get("sample_rew_mean", 0.0)
+            sample_rew_var = batch_stats.get("sample_rew_var", 0.0)
+            sample_obs_mean = batch_stats.get("sample_obs_mean", 0.0)
+            sample_obs_var = batch_stats.get("sample_obs_var", 0.0)
+
+            if self.wm_data_parallel:
+                # keep the normalizers of the replicas identical
+                for rms in (self.obs_rms, self.rew_rms):
+                    if rms is not None:
+                        all_reduce_rms(rms)
 
             self.time_report.end_timer("world model training")
 
+            if self.collector is not None and epoch % self.async_sync_interval == 0:
+                self.collector.publish(self)
+
             self.iter_count += 1
             time_end_epoch = time.time()
             fps = self.horizon * self.num_envs / (time_end_epoch - time_start_epoch)
@@ -985,9 +1374,11 @@ class PWM:
                 "wm_loss": tot_wm_loss,
                 "dynamics_loss": tot_dynamics_loss,
                 "reward_loss": tot_reward_loss,
+                "jump_loss": tot_jump_loss,
                 "term_loss": tot_term_loss,
                 "rollout_len": self.mean_horizon,
                 "fps": fps,
+                "flow_nfe": self.flow_nfe,
                 "policy_loss": mean_policy_loss,
                 "rewards": -mean_policy_loss,
                 "primal": -mean_episode_primal,
@@ -998,13 +1389,20 @@ class PWM:
                 "actor_grad_norm": self.actor_grad_norm_before_clip,
                 "critic_grad_norm": critic_grad_norm,
                 "wm_grad_norm": wm_grad_norm,
-                "episode_end": self.episode_end,
-                "early_termination": self.early_termination,
+                "episode_end": int(self.episode_end),
+                "early_termination": int(self.early_termination),
                 "sample_rew_mean": sample_rew_mean,
                 "sample_rew_var": sample_rew_var,
                 "sample_obs_mean": sample_obs_mean,
                 "sample_obs_var": sample_obs_var,
             }
+            if self.latent_cache is not None:
+                metrics["latent_cache_hit_rate"] = self.latent_cache.hit_rate()
+            if self.use_disagreement:
+                metrics["wm_disagreement"] = self.rollout_disagreement.item()
+                metrics["wm_truncated"] = self.rollout_truncated.item()
+            if self.collector is not None:
+                metrics.update(self.collector.metrics())
             if self.rew_rms:
                 metrics.update(
                     dict(
@@ -1083,6 +1481,9 @@ class PWM:
 
         self.time_report.end_timer("algorithm")
 
+        if self.collector is not None:
+            self.collector.stop()
+
         # Close training monitor and log timing stats
         timing_stats = self.training_monitor.close()
         if self.wandb_logger:
@@ -1121,14 +1522,18 @@ class PWM:
             self.wm_optimizer.zero_grad()
             wm_loss, dyn_loss, rew_loss = self.compute_wm_loss(obs, act, rew, task)
             wm_loss.backward()
-            wm_grad_norm = clip_grad_norm_(self.wm.parameters(), self.wm_grad_norm)
+            wm_grad_norm = self._reduce_and_clip_wm_grads()
             self.wm_optimizer.step()
+            self.train_jump(obs, act, task)
 
         # train actor
         self.actor_optimizer.zero_grad()
 
         # NOTE not sure about dimensionality below
-        actor_loss = self.compute_actor_loss(obs[0], task)
+        if self.imagination is not None:
+            actor_loss = self.compute_imagined_actor_loss(obs[0], task)
+        else:
+            actor_loss = self.compute_actor_loss(obs[0], task)
         actor_loss.backward()
 
         self.actor_grad_norm_before_clip = tu.grad_norm(self.actor.parameters())
@@ -1141,52 +1546,29 @@ class PWM:
             print_error("NaN gradient")
             raise ValueError
 
+        # abort on fatal violations before the optimizer applies the step
+        self.report_rollout_stats()
         self.actor_optimizer.step()
+        if hasattr(self.actor, "clamp_std"):
+            self.actor.clamp_std()
 
         # prepare dataset
         critic_batch_size = bsz * self.horizon // self.critic_batches
-        with torch.no_grad():
-            self.compute_target_values()
-            dataset = CriticDataset(
-                critic_batch_size,
-                self.obs_buf,
-                self.target_values,
-            )
+        self.compute_target_values()
 
         # critic training!
-        value_loss = 0.0
-        for j in range(self.critic_iterations):
-            total_critic_loss = 0.0
-            batch_cnt = 0
-            for i in range(len(dataset)):
-                batch_sample = dataset[i]
-                self.critic_optimizer.zero_grad()
-                training_critic_loss = self.compute_critic_loss(batch_sample)
-                training_critic_loss.backward()
-
-                # ugly fix for simulation nan problem
-                for params in self.critic.parameters():
-                    params.grad.nan_to_num_(0.0, 0.0, 0.0)
-
-                critic_grad_norm = clip_grad_norm_(
-                    self.critic.parameters(), self.critic_grad_norm
-                )
-                self.critic_optimizer.step()
-
-                total_critic_loss += training_critic_loss
-                batch_cnt += 1
-
-            value_loss += total_critic_loss / batch_cnt
-
-        value_loss /= self.critic_iterations
+        value_losses, critic_grad_norm = self.critic_trainer.train(
+            self.obs_buf, self.target_values, critic_batch_size
+        )
+        value_loss = sum(value_losses) / max(len(value_losses), 1)
 
         ac_stddev = self.actor.get_logstd().exp().mean().detach().cpu().item()
 
         metrics = {
             "actor_loss": actor_loss.item(),
-            "value_loss": value_loss.item(),
+            "value_loss": value_loss,
             "actor_grad_norm": self.actor_grad_norm_before_clip.item(),
-            "critic_grad_norm": critic_grad_norm.item(),
+            "critic_grad_norm": critic_grad_norm,
         }
         if finetune_wm:
             metrics["wm_loss"] = wm_loss
@@ -1197,6 +1579,9 @@ class PWM:
         return metrics
 
     def save(self, filename, log_dir=None, buffer=False):
+        if not is_main_process():
+            # all ranks hold the same world model, only rank 0 writes it
+            return
         log_dir = Path(self.log_dir) if log_dir is None else Path(log_dir)
         torch.save(
             {
@@ -1209,6 +1594,11 @@ class PWM:
                 "actor_opt": self.actor_optimizer.state_dict(),
                 "critic_opt": self.critic_optimizer.state_dict(),
                 "world_model_opt": self.wm_optimizer.state_dict(),
+                "jump_opt": (
+                    self.jump_optimizer.state_dict()
+                    if self.jump_optimizer is not None
+                    else None
+                ),
                 # Training progress
                 "iter_count": self.iter_count,
                 "step_count": self.step_count,
@@ -1264,6 +1654,8 @@ class PWM:
         self.critic_lr = checkpoint["critic_opt"]["param_groups"][0]["lr"]
         self.wm_optimizer.load_state_dict(checkpoint["world_model_opt"])
         self.model_lr = checkpoint["world_model_opt"]["param_groups"][0]["lr"]
+        if self.jump_optimizer is not None and checkpoint.get("jump_opt"):
+            self.jump_optimizer.load_state_dict(checkpoint["jump_opt"])
         
         # Restore training progress if resuming
         if resume_training and "iter_count" in checkpoint:
@@ -1287,7 +1679,6 @@ class PWM:
         if buffer:
             print("Loading buffer too")
             self.buffer.load(path.replace(".pt", ".buffer"))
-            self.buffer._num_eps = 100  # placeholder to avoid initialization
 
     def load_wm(self, path):
         print("Loading world model from", path)
@@ -1307,29 +1698,29 @@ class PWM:
         self.wm.load_state_dict(new_odict)
 
     def pretrain_wm(self, paths, num_iters, actually_train=True):
-        if type(paths) != List:
-            paths = [paths]
-        for path in paths:
-            print("loading", path)
-            td = torch.load(path).to("cpu")
-
-            # fetch stats for normalizing
-            if self.obs_rms:
-                obs = td["obs"]
-                # NOTE: if this fails probably load wrong data
-                obs = obs.reshape((-1, self.num_obs))
-                obs = torch.nan_to_num(obs)
-                self.obs_rms.update(obs)
-
-            if self.rew_rms:
-                self.rew_rms = self.rew_rms.to("cpu")
-                rew = td["reward"]
-                rew = rew.reshape((-1, 1))
-                rew = torch.nan_to_num(rew)
-                self.rew_rms.update(rew)
-                self.rew_rms = self.rew_rms.to(self.device)
-
-            self.buffer.add_batch(td)
+        # every rank trains on its own shard of the episodes
+        shard = (get_rank(), get_world_size()) if self.wm_data_parallel else None
+        if isinstance(paths, str) and OfflineDataset.is_converted(paths):
+            # converted dataset, normalization stats come precomputed
+            load_into_buffer(
+                self.buffer,
+                OfflineDataset(paths),
+                chunk_size=self.wm_data_chunk_size,
+                obs_rms=self.obs_rms,
+                rew_rms=self.rew_rms,
+                reservoir=self.wm_data_reservoir,
+                shard=shard,
+            )
+        else:
+            # episodes are read chunk by chunk, normalization stats cover all shards
+            stream = EpisodeStream(paths, chunk_size=self.wm_data_chunk_size, shard=shard)
+            stream_into_buffer(
+                self.buffer,
+                stream,
+                obs_rms=self.obs_rms,
+                rew_rms=self.rew_rms,
+                reservoir=self.wm_data_reservoir,
+            )
 
         if not actually_train:
             return
@@ -1338,16 +1729,23 @@ class PWM:
         log_freq = num_iters // 100
         save_at = num_iters // 5
         for i in range(0, num_iters):
-            obs, act, rew = self.buffer.sample()
+            obs, act, rew, weights, index = self._sample_wm_batch()
             if self.obs_rms:
                 obs = self.obs_rms.normalize(obs)
             if self.rew_rms:
                 rew = self.rew_rms.normalize(rew)
             self.wm_optimizer.zero_grad()
-            loss, dyn_loss, rew_loss = self.compute_wm_loss(obs, act, rew)
+            loss, dyn_loss, rew_loss = self.compute_wm_loss(
+                obs, act, rew, weights=weights, **self._cached_latents(obs, index)
+            )
             loss.backward()
-            wm_grad_norm = clip_grad_norm_(self.wm.parameters(), self.wm_grad_norm)
+            wm_grad_norm = self._reduce_and_clip_wm_grads()
             self.wm_optimizer.step()
+            if self.latent_cache is not None:
+                self.latent_cache.step()
+            if index is not None:
+                self.buffer.update_priority(index, self.wm_sample_loss)
+            self.train_jump(obs, act)
             if i % log_freq == 0 and self.log:
                 metrics = {
                     "pretrain/wm_loss": loss.item(),
@@ -1365,7 +1763,178 @@ class PWM:
         self.wm_bootstrapped = True
         self.save("pretrained", buffer=True)
 
-    def compute_wm_loss(self, obs, act, rew, task=None):
+    def train_jump(self, obs, act, task=None):
+        """
+        Distills the integrated flow dynamics into the one-step jump head on
+        the replay latents of a WM batch. Returns the distillation loss as a
+        detached tensor, so it can be accumulated without a host sync.
+        """
+        if self.jump_optimizer is None:
+            return torch.zeros((), device=self.device)
+
+        horizon = obs.shape[0] - 1
+        with torch.no_grad():
+            z = self.wm.encode(obs[:-1], task).flatten(0, 1)
+            a = act.flatten(0, 1)
+            if torch.is_tensor(task) and task.numel() > 1:
+                task = task.repeat(horizon)
+            target = self.wm.next(
+                z,
+                a,
+                task,
+                integrator=self.flow_integrator,
+                substeps=self.flow_substeps,
+                **self.flow_kwargs,
+            )
+
+        self.jump_optimizer.zero_grad()
+        jump_loss = F.mse_loss(self.wm.jump(z, a, task), target)
+        jump_loss.backward()
+        if self.wm_data_parallel:
+            all_reduce_grads(self.wm._jump.parameters())
+        clip_grad_norm_(self.wm._jump.parameters(), self.wm_grad_norm)
+        self.jump_optimizer.step()
+        self.jump_optimizer.zero_grad(set_to_none=True)
+        return jump_loss.detach()
+
+    @torch.no_grad()
+    def _prepare_wm_batch(self):
+        """
+        Samples a WM batch and zeroes NaN observations, without host syncs.
+        Runs in the prefetch worker, so it must not touch the normalizers.
+        """
+        obs, act, rew, weights, index = self._sample_wm_batch()
+        stats = self.wm_batch_stats
+        stats.count("NaN obs sampled", torch.isnan(obs))
+        stats.count("NaN reward sampled", torch.isnan(rew))
+        obs = torch.nan_to_num(obs)
+        return obs, act, rew, weights, index
+
+    @torch.no_grad()
+    def _normalize_wm_batch(self, obs, rew):
+        """
+        Updates and applies the observation and reward normalization to a
+        prepared WM batch and accumulates the batch statistics in
+        `wm_batch_stats`, without host syncs. Called on the consumer side of
+        the prefetcher, where the normalizers are also read.
+        """
+        stats = self.wm_batch_stats
+        if self.obs_rms:
+            if self.latent_cache is None or not self.latent_cache.frozen:
+                self.obs_rms.update(obs.reshape((-1, self.num_obs)))
+            obs = self.obs_rms.normalize(obs)
+
+        if self.rew_rms:
+            self.rew_rms.update(rew.reshape((-1, 1)))
+            rew = self.rew_rms.normalize(rew)
+
+        stats.count("NaN reward post-processed", torch.isnan(rew))
+        stats.add("sample_rew_mean", rew.mean())
+        stats.add("sample_rew_var", rew.var())
+        stats.add("sample_obs_mean", obs.mean(dim=0).mean())
+        stats.add("sample_obs_var", obs.var(dim=0).mean())
+        return obs, rew
+
+    def _sample_wm_batch(self):
+        """
+        Samples a WM batch from the replay buffer. Returns `(obs, act, rew,
+        weights, index)`; weights and index are None unless the buffer is
+        prioritized or the latent cache needs the slots.
+        """
+        if self.wm_prioritized or self.latent_cache is not None:
+            return self.buffer.sample(return_info=True)
+        obs, act, rew = self.buffer.sample()
+        return obs, act, rew, None, None
+
+    def _encoder_state(self):
+        """Tensors the encoder latents depend on, for the latent cache drift."""
+        tensors = list(self.wm._encoder.parameters())
+        if self.obs_rms:
+            tensors += [self.obs_rms.mean, self.obs_rms.var]
+        return tensors
+
+    def _cached_latents(self, obs, index):
+        """
+        `wm_losses` keyword arguments with the encoder latents of the
+        normalized `obs` [H+1, B] at the buffer slots `index` [B, H+1] served
+        from the latent cache: the targets, or all latents if it is frozen.
+        """
+        if self.latent_cache is None or index is None:
+            return {}
+        cache = self.latent_cache
+        slots = index.t() if cache.frozen else index[:, 1:].t()
+        obs = obs if cache.frozen else obs[1:]
+        with self.wm_prefetcher.lock:
+            episodes = self.buffer.episodes_at(slots)
+        if cache.frozen and not cache.filled:
+            self._fill_latent_cache()
+        latents = cache.encode(slots, episodes, obs, lambda o: self.wm.encode(o, None))
+        return dict(latents=latents) if cache.frozen else dict(targets=latents)
+
+    @torch.no_grad()
+    def _fill_latent_cache(self):
+        """Encodes the whole replay buffer into the latent cache once."""
+        with self.wm_prefetcher.lock:
+            slots = self.buffer.filled_slots()
+            episodes = self.buffer.episodes_at(slots)
+
+            def obs_fn(s):
+                obs = torch.nan_to_num(self.buffer.obs_at(s))
+                return self.obs_rms.normalize(obs) if self.obs_rms else obs
+
+            self.latent_cache.fill(
+                slots, episodes, obs_fn, lambda o: self.wm.encode(o, None)
+            )
+        print_info(f"Cached the latents of {len(slots)} replay steps")
+
+    def _reduce_and_clip_wm_grads(self):
+        """
+        Averages the world model gradients over all data-parallel ranks and
+        clips them. Clipping sees the averaged gradients, so every rank applies
+        the same update. Returns the gradient norm before clipping.
+        """
+        params = self._wm_params()
+        if self.wm_data_parallel:
+            all_reduce_grads(params)
+        return clip_grad_norm_(params, self.wm_grad_norm)
+
+    def _wm_params(self):
+        """Parameters updated by `wm_optimizer`, without the jump head."""
+        return [p for group in self.wm_optimizer.param_groups for p in group["params"]]
+
+    def compute_wm_loss(
+        self, obs, act, rew, task=None, weights=None, targets=None, latents=None
+    ):
+        """
+        World model loss plus its dynamics and reward parts for logging.
+        `weights` [B] are optional importance-sampling weights of the
+        subsequences. The detached loss of every subsequence is kept in
+        `wm_sample_loss`, e.g. to update replay priorities.
+        """
+        total_loss, dynamics_loss, reward_loss, sample_loss = self.wm_losses(
+            obs, act, rew, task, weights, True, targets, latents
+        )
+        self.wm_sample_loss = sample_loss
+        return total_loss, dynamics_loss, reward_loss.item()
+
+    def wm_losses(
+        self,
+        obs,
+        act,
+        rew,
+        task=None,
+        weights=None,
+        return_sample_loss=False,
+        targets=None,
+        latents=None,
+    ):
+        """
+        World model losses as tensors. Free of in-place writes and host syncs,
+        so it can be vmapped over stacked world models. Losses are computed
+        per subsequence and averaged with the optional `weights` [B].
+        Precomputed encoder latents can be passed as the dynamics `targets`
+        of obs[1:], or as the `latents` of all of obs for a frozen encoder.
+        """
         horizon, batch_size, _ = obs.shape
         assert horizon == self.horizon + 1
         discount = (
@@ -1375,22 +1944,55 @@ class PWM:
         )
 
         # Compute target latent states
-        with torch.no_grad():
-            next_z = self.wm.encode(obs[1:], task)
+        if latents is not None:
+            next_z = latents[1:].detach()
+        elif targets is not None:
+            next_z = targets.detach()
+        else:
+            with torch.no_grad():
+                next_z = self.wm.encode(obs[1:], task)
 
         # Latent rollout
-        zs = torch.empty(
-            self.horizon + 1,
-            batch_size,
-            self.latent_dim,
-            device=self.device,
-        )
-
-        z = self.wm.encode(obs[0], task)
-        zs[0] = z
+        z = latents[0] if latents is not None else self.wm.encode(obs[0], task)
+        zs = [z]
 
         # TODO: If more loss types are added in the future, refactor to strategy/ABC pattern
-        if self.use_flow_dynamics:
+        if self.use_flow_dynamics and self.flow_loss_mode == "parallel":
+            # Teacher-forced flow-matching loss: every transition starts from
+            # its encoder latent, so the velocity net runs once on [H, B]
+            from flow_mbpo_pwm.utils.integrators import (
+                compute_parallel_flow_matching_loss,
+            )
+
+            if latents is not None:
+                z_start = latents[:-1]
+            else:
+                z_start = torch.cat([z[None], self.wm.encode(obs[1:-1], task)])
+            dynamics_loss = compute_parallel_flow_matching_loss(
+                self.wm.velocity, z_start, next_z, act, task,
+                tau_sampling=self.flow_tau_sampling,
+                discount=discount.view(-1),
+                reduction="none",
+            )
+
+            if self.flow_consistency_weight > 0:
+                # Multi-step consistency of the integrated rollout
+                consistency_loss = 0.0
+                for t in range(self.horizon):
+                    z = self.wm.next(z, act[t], task,
+                                     integrator=self.flow_integrator,
+                                     substeps=self.flow_consistency_substeps,
+                                     **self.flow_kwargs)
+                    consistency_loss += (
+                        F.mse_loss(z, next_z[t], reduction="none").mean(dim=-1)
+                        * self.gamma**t
+                    )
+                    zs.append(z)
+                dynamics_loss += self.flow_consistency_weight * consistency_loss
+            else:
+                # reward head is trained on the encoder latents
+                zs = list(z_start.unbind(0)) + [z]
+        elif self.use_flow_dynamics:
             # Flow-matching dynamics loss
             from flow_mbpo_pwm.utils.integrators import compute_flow_matching_loss
             
@@ -1400,7 +2002,8 @@ class PWM:
                 flow_loss = compute_flow_matching_loss(
                     self.wm.velocity, z, next_z[t], act[t], task,
                     tau_sampling=self.flow_tau_sampling,
-                    gamma_t=self.gamma ** t
+                    gamma_t=self.gamma ** t,
+                    reduction="none",
                 )
                 dynamics_loss += flow_loss
                 
@@ -1408,31 +2011,46 @@ class PWM:
                 if self.use_flow_dynamics:
                     z = self.wm.next(z, act[t], task, 
                                     integrator=self.flow_integrator,
-                                    substeps=self.flow_substeps)
+                                    substeps=self.flow_substeps,
+                                    **self.flow_kwargs)
                 else:
                     z = self.wm.next(z, act[t], task)
-                zs[t + 1] = z
+                zs.append(z)
         else:
-            # Baseline MLP dynamics loss (MSE)
+            # Baseline MLP dynamics loss (MSE), every ensemble member is fit
+            # from the mean latent
             dynamics_loss = 0.0
             for t in range(self.horizon):
-                z = self.wm.next(z, act[t], task)
-                dynamics_loss += F.mse_loss(z, next_z[t]) * self.gamma**t
-                zs[t + 1] = z
-
-        # Reward loss (shared between baseline and flow)
-        _zs = zs[:-1]
-        rew_hat = self.wm.reward(_zs, act, task)
+                z_members = self.wm.next(z, act[t], task, members=True)
+                dynamics_loss += (
+                    F.mse_loss(z_members, next_z[t].expand_as(z_members), reduction="none")
+                    .mean(dim=(0, -1))
+                    * self.gamma**t
+                )
+                z = z_members.mean(dim=0)
+                zs.append(z)
+        if dynamics_loss.ndim > 1:
+            # flow-matching losses of the ensemble members [N, B]
+            dynamics_loss = dynamics_loss.mean(dim=0)
+
+        # Reward loss (shared between baseline and flow), per ensemble member
+        _zs = torch.stack(zs[:-1])
+        rew_hat = self.wm.reward(_zs, act, task, members=True)
         reward_loss = (rew_hat - rew) ** 2 * discount
-        reward_loss = reward_loss.mean()
-
-        total_loss = dynamics_loss + reward_loss
-        total_loss /= self.horizon
-        return (
-            total_loss,
-            dynamics_loss / self.horizon,
-            reward_loss.item() / self.horizon,
+        reward_loss = reward_loss.movedim(-2, 0).flatten(1).mean(dim=1)
+
+        # per-subsequence losses [B]
+        sample_loss = (dynamics_loss + reward_loss) / self.horizon
+        if weights is None:
+            weights = torch.ones_like(sample_loss)
+        losses = (
+            (weights * sample_loss).mean(),
+            (weights * dynamics_loss).mean() / self.horizon,
+            (weights * reward_loss).mean().detach() / self.horizon,
         )
+        if return_sample_loss:
+            losses += (sample_loss.detach(),)
+        return losses
 
     def act(self, obs, t0=False, deterministic=False, task=None):
         obs = torch.tensor(obs, dtype=torch.float32, device=self.device)[None]
@@ -1463,6 +2081,9 @@ class PWM:
             ) + self.model_lr
             for param_group in self.wm_optimizer.param_groups:
                 param_group["lr"] = model_lr
+            if self.jump_optimizer is not None:
+                for param_group in self.jump_optimizer.param_groups:
+                    param_group["lr"] = model_lr
 
             return actor_lr, critic_lr, model_lr
         else:
@@ -11,9 +11,11 @@ from tensordict import TensorDict
 from flow_mbpo_pwm.utils.common import *
 import flow_mbpo_pwm.utils.torch_utils as tu
 from flow_mbpo_pwm.utils.running_mean_std import RunningMeanStd
-from flow_mbpo_pwm.utils.dataset import CriticDataset
+from flow_mbpo_pwm.utils.critic_trainer import CriticTrainer, critic_adam
+from flow_mbpo_pwm.utils.targets import compute_target_values
 from flow_mbpo_pwm.utils.time_report import TimeReport
 from flow_mbpo_pwm.utils.average_meter import AverageMeter
+from flow_mbpo_pwm.utils.rollout_stats import RolloutStats
 from flow_mbpo_pwm.models.model_utils import Ensemble
 
 tensordict.set_lazy_legacy(False).set()
@@ -51,6 +53,7 @@ class SHAC:
         save_interval: int = 500,  # how often to save policy
         device: str = "cuda",
         save_data: bool = False,
+        sync_free: bool = False,  # keep rollout checks on device, report per epoch
         log: bool = False,
     ):
         # sanity check parameters
@@ -72,6 +75,8 @@ class SHAC:
         self.num_actions = self.env.action_space.shape[0]
         self.device = torch.device(device)
         self.save_data = save_data
+        self.sync_free = sync_free
+        self.rollout_stats = RolloutStats(self.device)
         if save_data:
             self.episode_data = []
             if env.early_termination:
@@ -130,10 +135,18 @@ class SHAC:
             self.actor_lr,
             betas,
         )
-        self.critic_optimizer = torch.optim.Adam(
+        self.critic_optimizer = critic_adam(
             self.critic.parameters(),
             self.critic_lr,
             betas,
+            self.device,
+        )
+        self.critic_trainer = CriticTrainer(
+            self.critic,
+            self.critic_optimizer,
+            self.compute_critic_loss,
+            self.critic_iterations,
+            self.critic_grad_norm,
         )
 
         # replay buffer
@@ -198,6 +211,24 @@ class SHAC:
     def mean_horizon(self):
         return self.horizon_length_meter.get_mean()
 
+    def report_rollout_stats(self):
+        """
+        Dump the on-device rollout statistics of the sync-free mode. Raises on
+        fatal violations, so call it before an update computed from the
+        rollout is applied.
+        """
+        if not self.sync_free:
+            return
+        self.rollout_stats.flush(
+            {
+                "episode_loss": self.episode_loss_meter,
+                "episode_discounted_loss": self.episode_discounted_loss_meter,
+                "episode_primal": self.episode_primal_meter,
+                "episode_length": self.episode_length_meter,
+                "horizon_length": self.horizon_length_meter,
+            }
+        )
+
     def compute_actor_loss(self, deterministic=False):
         rew_acc = torch.zeros(
             (self.horizon + 1, self.num_envs), dtype=torch.float32, device=self.device
@@ -293,39 +324,57 @@ class SHAC:
             rollout_len += 1
 
             # sanity check
-            if (~torch.isfinite(real_obs)).sum() > 0:
+            if self.sync_free:
+                self.rollout_stats.count("inf_obs", ~torch.isfinite(real_obs))
+            elif (~torch.isfinite(real_obs)).sum() > 0:
                 print_warning("Got inf obs")
 
             next_values[i + 1] = self.critic(real_obs).min(dim=0).values.squeeze()
 
             # handle terminated environments which stopped for some bad reason
             # since the reason is bad we set their value to 0
-            term_env_ids = term.nonzero(as_tuple=False).squeeze(-1)
-            for id in term_env_ids:
-                next_values[i + 1, id] = 0.0
+            if self.sync_free:
+                next_values[i + 1] = next_values[i + 1].masked_fill(term, 0.0)
+            else:
+                term_env_ids = term.nonzero(as_tuple=False).squeeze(-1)
+                for id in term_env_ids:
+                    next_values[i + 1, id] = 0.0
 
             # sanity check
-            if (next_values > 1e6).sum() > 0 or (next_values < -1e6).sum() > 0:
+            if self.sync_free:
+                self.rollout_stats.count(
+                    "next_value_error", next_values[i + 1].abs() > 1e6
+                )
+            elif (next_values > 1e6).sum() > 0 or (next_values < -1e6).sum() > 0:
                 print_error("next value error")
                 raise ValueError
 
             rew_acc[i + 1, :] = rew_acc[i, :] + gamma * rew
 
             done = term | trunc
-            done_env_ids = done.nonzero(as_tuple=False).squeeze(-1)
-
-            self.early_termination += torch.sum(term).item()
-            self.episode_end += torch.sum(trunc).item()
+            if self.sync_free:
+                self.early_termination += torch.sum(term)
+                self.episode_end += torch.sum(trunc)
+            else:
+                done_env_ids = done.nonzero(as_tuple=False).squeeze(-1)
+                self.early_termination += torch.sum(term).item()
+                self.episode_end += torch.sum(trunc).item()
 
             if i < self.horizon - 1:
                 # first terminate all rollouts which are 'done'
-                returns = (
-                    -rew_acc[i + 1, done_env_ids]
-                    - self.gamma
-                    * gamma[done_env_ids]
-                    * next_values[i + 1, done_env_ids]
-                )
-                actor_loss[done_env_ids] += returns
+                if self.sync_free:
+                    returns = -rew_acc[i + 1] - self.gamma * gamma * next_values[i + 1]
+                    actor_loss = actor_loss + torch.where(
+                        done, returns, torch.zeros_like(returns)
+                    )
+                else:
+                    returns = (
+                        -rew_acc[i + 1, done_env_ids]
+                        - self.gamma
+                        * gamma[done_env_ids]
+                        * next_values[i + 1, done_env_ids]
+                    )
+                    actor_loss[done_env_ids] += returns
             else:
                 # terminate all envs because we reached the end of our rollout
                 returns = (
@@ -337,8 +386,12 @@ class SHAC:
             gamma = gamma * self.gamma
 
             # clear up gamma and rew_acc for done envs
-            gamma[done_env_ids] = 1.0
-            rew_acc[i + 1, done_env_ids] = 0.0
+            if self.sync_free:
+                gamma = gamma.masked_fill(done, 1.0)
+                rew_acc[i + 1] = rew_acc[i + 1].masked_fill(done, 0.0)
+            else:
+                gamma[done_env_ids] = 1.0
+                rew_acc[i + 1, done_env_ids] = 0.0
 
             # collect data for critic training
             with torch.no_grad():
@@ -357,24 +410,48 @@ class SHAC:
                 self.episode_primal -= primal
                 self.episode_gamma *= self.gamma
 
-                # dump data from done episodes
-                self.episode_loss_meter.update(self.episode_loss[done_env_ids])
-                self.episode_discounted_loss_meter.update(
-                    self.episode_discounted_loss[done_env_ids]
-                )
-                self.episode_primal_meter.update(self.episode_primal[done_env_ids])
-                self.episode_length_meter.update(self.episode_length[done_env_ids])
-                self.horizon_length_meter.update(rollout_len[done_env_ids])
-
-                # reset trackers
-                rollout_len[done_env_ids] = 0
-                self.episode_loss[done_env_ids] = 0.0
-                self.episode_discounted_loss[done_env_ids] = 0.0
-                self.episode_primal[done_env_ids] = 0.0
-                self.episode_length[done_env_ids] = 0
-                self.episode_gamma[done_env_ids] = 1.0
-
-        self.horizon_length_meter.update(rollout_len)
+                if self.sync_free:
+                    # accumulate on device, dumped by report_rollout_stats
+                    stats = self.rollout_stats
+                    stats.add("episode_loss", self.episode_loss, done)
+                    stats.add(
+                        "episode_discounted_loss", self.episode_discounted_loss, done
+                    )
+                    stats.add("episode_primal", self.episode_primal, done)
+                    stats.add("episode_length", self.episode_length, done)
+                    stats.add("horizon_length", rollout_len, done)
+
+                    # reset trackers
+                    rollout_len.masked_fill_(done, 0)
+                    self.episode_loss.masked_fill_(done, 0.0)
+                    self.episode_discounted_loss.masked_fill_(done, 0.0)
+                    self.episode_primal.masked_fill_(done, 0.0)
+                    self.episode_length.masked_fill_(done, 0)
+                    self.episode_gamma.masked_fill_(done, 1.0)
+                else:
+                    # dump data from done episodes
+                    self.episode_loss_meter.update(self.episode_loss[done_env_ids])
+                    self.episode_discounted_loss_meter.update(
+                        self.episode_discounted_loss[done_env_ids]
+                    )
+                    self.episode_primal_meter.update(self.episode_primal[done_env_ids])
+                    self.episode_length_meter.update(self.episode_length[done_env_ids])
+                    self.horizon_length_meter.update(rollout_len[done_env_ids])
+
+                    # reset trackers
+                    rollout_len[done_env_ids] = 0
+                    self.episode_loss[done_env_ids] = 0.0
+                    self.episode_discounted_loss[done_env_ids] = 0.0
+                    self.episode_primal[done_env_ids] = 0.0
+                    self.episode_length[done_env_ids] = 0
+                    self.episode_gamma[done_env_ids] = 1.0
+
+        if self.sync_free:
+            self.rollout_stats.add(
+                "horizon_length", rollout_len, torch.ones_like(rollout_len)
+            )
+        else:
+            self.horizon_length_meter.update(rollout_len)
 
         if self.ret_rms is not None:
             self.ret_rms.update(actor_loss)
@@ -451,30 +528,14 @@ class SHAC:
 
     @torch.no_grad()
     def compute_target_values(self):
-        if self.critic_method == "one-step":
-            self.target_values = self.rew_buf + self.gamma * self.next_values
-        elif self.critic_method == "td-lambda":
-            Ai = torch.zeros(self.num_envs, dtype=torch.float32, device=self.device)
-            Bi = torch.zeros(self.num_envs, dtype=torch.float32, device=self.device)
-            lam = torch.ones(self.num_envs, dtype=torch.float32, device=self.device)
-            for i in reversed(range(self.horizon)):
-                lam = lam * self.lam * (1.0 - self.done_mask[i]) + self.done_mask[i]
-                Ai = (1.0 - self.done_mask[i]) * (
-                    self.lam * self.gamma * Ai
-                    + self.gamma * self.next_values[i]
-                    + (1.0 - lam) / (1.0 - self.lam) * self.rew_buf[i]
-                )
-                Bi = (
-                    self.gamma
-                    * (
-                        self.next_values[i] * self.done_mask[i]
-                        + Bi * (1.0 - self.done_mask[i])
-                    )
-                    + self.rew_buf[i]
-                )
-                self.target_values[i] = (1.0 - self.lam) * Ai + lam * Bi
-        else:
-            raise NotImplementedError
+        self.target_values = compute_target_values(
+            self.critic_method,
+            self.rew_buf,
+            self.next_values,
+            self.done_mask,
+            self.gamma,
+            self.lam,
+        )
 
     def compute_critic_loss(self, batch_sample):
         predicted_values = self.critic(batch_sample["obs"]).squeeze(-2)
@@ -556,6 +617,9 @@ class SHAC:
 
             self.time_report.end_timer("compute actor loss")
 
+            # abort on fatal violations before the optimizer applies the step
+            self.report_rollout_stats()
+
             return actor_loss
 
         # main training process
@@ -581,48 +645,25 @@ class SHAC:
             # train actor
             self.time_report.start_timer("actor training")
             actor_loss = self.actor_optimizer.step(actor_closure)
+            if hasattr(self.actor, "clamp_std"):
+                self.actor.clamp_std()
             self.time_report.end_timer("actor training")
 
             # train critic
             # prepare dataset
             self.time_report.start_timer("prepare critic dataset")
-            with torch.no_grad():
-                self.compute_target_values()
-                dataset = CriticDataset(
-                    self.critic_batch_size,
-                    self.obs_buf,
-                    self.target_values,
-                )
+            self.compute_target_values()
             self.time_report.end_timer("prepare critic dataset")
 
             self.time_report.start_timer("critic training")
-            value_loss = 0.0
-            for j in range(self.critic_iterations):
-                total_critic_loss = 0.0
-                batch_cnt = 0
-                for i in range(len(dataset)):
-                    batch_sample = dataset[i]
-                    self.critic_optimizer.zero_grad()
-                    training_critic_loss = self.compute_critic_loss(batch_sample)
-                    training_critic_loss.backward()
-
-                    # ugly fix for simulation nan problem
-                    for params in self.critic.parameters():
-                        params.grad.nan_to_num_(0.0, 0.0, 0.0)
-
-                    critic_grad_norm = clip_grad_norm_(
-                        self.critic.parameters(), self.critic_grad_norm
-                    )
-                    self.critic_optimizer.step()
-
-                    total_critic_loss += training_critic_loss
-                    batch_cnt += 1
-
-                value_loss = total_critic_loss / batch_cnt
-                print(
-                    f"value iter {j + 1}/{self.critic_iterations}, loss = {value_loss:.2f}",
-                    end="\r",
-                )
+            value_losses, critic_grad_norm = self.critic_trainer.train(
+                self.obs_buf, self.target_values, self.critic_batch_size
+            )
+            value_loss = value_losses[-1] if value_losses else 0.0
+            print(
+                f"value iters {self.critic_iterations}, loss = {value_loss:.2f}",
+                end="\r",
+            )
 
             self.time_report.end_timer("critic training")
 
@@ -655,8 +696,8 @@ class SHAC:
                 "actor_std": ac_stddev,
                 "actor_grad_norm": self.actor_grad_norm_before_clip,
                 "critic_grad_norm": critic_grad_norm,
-                "episode_end": self.episode_end,
-                "early_termination": self.early_termination,
+                "episode_end": int(self.episode_end),
+                "early_termination": int(self.early_termination),
             }
             metrics = filter_dict(metrics)
             if self.log:
@@ -87,30 +87,30 @@ class ActorStochasticMLP(nn.Module):
             param.data *= init_gain
 
     def get_logstd(self):
-        return self.logstd
+        return self.logstd.clamp(min=self.min_logstd)
 
     def clamp_std(self):
+        # in-place, call after optimizer steps and outside of vmap
         self.logstd.data = torch.clamp(self.logstd.data, self.min_logstd)
 
     def forward(self, obs, deterministic=False):
-        self.clamp_std()
         mu = self.mu_net(obs)
 
         if deterministic:
             return mu
         else:
-            std = self.logstd.exp()
-            dist = Normal(mu, std)
-            sample = dist.rsample()
+            # reparameterized sample, drawn out-of-place so that it is batched
+            # under vmap (Normal.rsample fills an unbatched tensor in place)
+            std = self.get_logstd().exp()
+            sample = mu + std * torch.randn_like(mu)
             return sample
 
     def action_log_probs(self, obs):
-        self.clamp_std()
         mu = self.mu_net(obs)
 
-        std = self.logstd.exp()
+        std = self.get_logstd().exp()
         dist = Normal(mu, std)
-        sample = dist.rsample()
+        sample = mu + std * torch.randn_like(mu)
 
         return sample, dist.log_prob(sample)
 
@@ -67,25 +67,37 @@ class DoubleCriticMLP(nn.Module):
             lambda x: nn.init.constant_(x, 0),
         )
 
-        modules = []
-        for i in range(len(self.layer_dims) - 1):
-            modules.append(init_(nn.Linear(self.layer_dims[i], self.layer_dims[i + 1])))
-            if i < len(self.layer_dims) - 2:
-                modules.append(self.activation_class())
-                modules.append(torch.nn.LayerNorm(self.layer_dims[i + 1]))
-
-        self.critic_1 = nn.Sequential(*modules)
-        self.critic_2 = nn.Sequential(*modules)
+        def build():
+            modules = []
+            for i in range(len(self.layer_dims) - 1):
+                modules.append(
+                    init_(nn.Linear(self.layer_dims[i], self.layer_dims[i + 1]))
+                )
+                if i < len(self.layer_dims) - 2:
+                    modules.append(self.activation_class())
+                    modules.append(torch.nn.LayerNorm(self.layer_dims[i + 1]))
+            return nn.Sequential(*modules)
+
+        # two independently initialized critics, evaluated in one vmapped pass
+        self.critics = model_utils.Ensemble([build(), build()])
+        self._register_load_state_dict_pre_hook(self._load_shared_critics)
 
         self.obs_dim = obs_dim
 
+    @staticmethod
+    def _load_shared_critics(state_dict, prefix, *args):
+        """Stack the weights of checkpoints with separate critic_1/critic_2 modules."""
+        old = [k for k in state_dict if k.startswith(prefix + "critic_1.")]
+        for i, k in enumerate(old):
+            name = k[len(prefix + "critic_1.") :]
+            state_dict[f"{prefix}critics.params.{i}"] = torch.stack(
+                [state_dict.pop(k), state_dict.pop(f"{prefix}critic_2.{name}")]
+            )
+
     def forward(self, observations):
-        v1 = self.critic_1(observations)
-        v2 = self.critic_2(observations)
-        return torch.min(v1, v2)
+        return self.critics(observations).min(dim=0).values
 
     def predict(self, observations):
         """Different from forward as it returns both critic values estimates"""
-        v1 = self.critic_1(observations)
-        v2 = self.critic_2(observations)
+        v1, v2 = self.critics(observations)
         return torch.cat((v1, v2), dim=-1)
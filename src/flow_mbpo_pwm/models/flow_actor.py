@@ -6,12 +6,13 @@ by integrating a learned velocity field from noise to action space.
 Based on Phase 2 of the master plan (Flow Policy with ODE-based sampling).
 """
 
-from typing import List, Type
+from typing import List, Optional, Type
 import torch
 import torch.nn as nn
 from torch.distributions.normal import Normal
 
 from flow_mbpo_pwm.models import model_utils
+from flow_mbpo_pwm.utils.integrators import integrate
 
 
 class ActorFlowODE(nn.Module):
@@ -33,7 +34,11 @@ class ActorFlowODE(nn.Module):
         activation_class: Activation function class
         init_gain: Weight initialization gain
         flow_substeps: Number of ODE integration substeps (K)
-        flow_integrator: Integration method ('euler' or 'heun')
+        flow_integrator: Integration method ('euler', 'midpoint', 'heun',
+            'rk4' or 'adaptive')
+        flow_max_nfe: Cap on velocity evaluations per integration (optional)
+        flow_atol: Absolute error tolerance of the adaptive solver
+        flow_rtol: Relative error tolerance of the adaptive solver
     """
     
     def __init__(
@@ -45,6 +50,9 @@ class ActorFlowODE(nn.Module):
         init_gain: float = 1.0,
         flow_substeps: int = 2,
         flow_integrator: str = 'heun',
+        flow_max_nfe: Optional[int] = None,
+        flow_atol: float = 1e-3,
+        flow_rtol: float = 1e-3,
     ):
         super(ActorFlowODE, self).__init__()
         
@@ -52,6 +60,10 @@ class ActorFlowODE(nn.Module):
         self.action_dim = action_dim
         self.flow_substeps = flow_substeps
         self.flow_integrator = flow_integrator
+        self.flow_max_nfe = flow_max_nfe
+        self.flow_atol = flow_atol
+        self.flow_rtol = flow_rtol
+        self.last_nfe = 0
         
         # Input to velocity net: obs + action_noise + time
         input_dim = obs_dim + action_dim + 1
@@ -87,7 +99,7 @@ class ActorFlowODE(nn.Module):
         return self.init_logstd.clamp(min=self.min_logstd)
     
     def clamp_std(self):
-        """Clamp logstd to minimum value."""
+        """Clamp logstd to minimum value, in-place. Call outside of vmap."""
         self.init_logstd.data = torch.clamp(self.init_logstd.data, self.min_logstd)
     
     def _velocity(self, z, obs, tau):
@@ -119,31 +131,19 @@ class ActorFlowODE(nn.Module):
             Final action [batch_size, action_dim]
         """
         K = substeps if substeps is not None else self.flow_substeps
-        dt = 1.0 / K
-        batch_size = z0.shape[0]
-        
-        z = z0
-        
-        for k in range(K):
-            t_k = k * dt
-            tau = torch.full((batch_size, 1), t_k, device=z.device, dtype=z.dtype)
-            
-            if self.flow_integrator == 'euler':
-                # Euler step
-                v = self._velocity(z, obs, tau)
-                z = z + dt * v
-            
-            elif self.flow_integrator == 'heun':
-                # Heun's method (RK2)
-                k1 = self._velocity(z, obs, tau)
-                z_pred = z + dt * k1
-                
-                tau_next = torch.full((batch_size, 1), t_k + dt, device=z.device, dtype=z.dtype)
-                k2 = self._velocity(z_pred, obs, tau_next)
-                
-                z = z + (dt / 2.0) * (k1 + k2)
-            else:
-                raise ValueError(f"Unknown integrator: {self.flow_integrator}")
+        
+        def velocity_fn(z, obs, tau, task):
+            return self._velocity(z, obs, tau)
+        
+        z, self.last_nfe = integrate(
+            velocity_fn, z0, obs, None,
+            method=self.flow_integrator,
+            substeps=K,
+            max_nfe=self.flow_max_nfe,
+            atol=self.flow_atol,
+            rtol=self.flow_rtol,
+            return_nfe=True,
+        )
         
         return z
     
@@ -158,7 +158,6 @@ class ActorFlowODE(nn.Module):
         Returns:
             Actions [batch_size, action_dim]
         """
-        self.clamp_std()
         batch_size = obs.shape[0]
         device = obs.device
         
@@ -167,7 +166,7 @@ class ActorFlowODE(nn.Module):
             z0 = torch.zeros(batch_size, self.action_dim, device=device)
         else:
             # Sample from learned initial distribution
-            std = self.init_logstd.exp()
+            std = self.get_logstd().exp()
             z0 = torch.randn(batch_size, self.action_dim, device=device) * std
         
         # Integrate to get action
@@ -189,12 +188,11 @@ class ActorFlowODE(nn.Module):
         Returns:
             Tuple of (actions, approx_log_probs)
         """
-        self.clamp_std()
         batch_size = obs.shape[0]
         device = obs.device
         
         # Sample initial noise
-        std = self.init_logstd.exp()
+        std = self.get_logstd().exp()
         z0 = torch.randn(batch_size, self.action_dim, device=device) * std
         
         # Compute approx log prob of initial noise
@@ -217,10 +215,9 @@ class ActorFlowODE(nn.Module):
         Returns:
             Tuple of (action, mean_action, std)
         """
-        self.clamp_std()
         batch_size = obs.shape[0]
         device = obs.device
-        std = self.init_logstd.exp()
+        std = self.get_logstd().exp()
         
         if deterministic:
             z0 = torch.zeros(batch_size, self.action_dim, device=device)
@@ -253,8 +250,7 @@ class ActorFlowODE(nn.Module):
         """
         # This is a rough approximation - we estimate based on how far 
         # the action is from the deterministic mode
-        self.clamp_std()
-        std = self.init_logstd.exp()
+        std = self.get_logstd().exp()
         
         # Get mean action (deterministic)
         mean_action = self.forward(obs, deterministic=True)
@@ -282,6 +278,9 @@ class ActorFlowODEStochastic(ActorFlowODE):
         flow_substeps: int = 2,
         flow_integrator: str = 'heun',
         exploration_noise: float = 0.1,
+        flow_max_nfe: Optional[int] = None,
+        flow_atol: float = 1e-3,
+        flow_rtol: float = 1e-3,
     ):
         super().__init__(
             obs_dim=obs_dim,
@@ -291,6 +290,9 @@ class ActorFlowODEStochastic(ActorFlowODE):
             init_gain=init_gain,
             flow_substeps=flow_substeps,
             flow_integrator=flow_integrator,
+            flow_max_nfe=flow_max_nfe,
+            flow_atol=flow_atol,
+            flow_rtol=flow_rtol,
         )
         self.exploration_noise = exploration_noise
     
@@ -9,7 +9,16 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from .mlp import mlp
-from .world_model import weight_init, zero_, symexp
+from .world_model import (
+    disagreement,
+    heads,
+    in_features,
+    last_weight,
+    member_mean,
+    symexp,
+    weight_init,
+    zero_,
+)
 
 
 class FlowWorldModel(nn.Module):
@@ -35,9 +44,17 @@ class FlowWorldModel(nn.Module):
         multitask=False,
         tasks=None,
         task_dim=0,
+        factorized_velocity=False,  # cache action/task projections across substeps
+        jump_units=None,  # hidden units of the distilled one-step dynamics head
+        ensemble_size=1,  # independent velocity and reward heads on a shared encoder
     ):
         super().__init__()
         self.multitask = multitask
+        self.ensemble_size = ensemble_size
+        # the factorized first layer is not split per member
+        self.factorized_velocity = factorized_velocity and ensemble_size == 1
+        self.last_nfe = 0
+        self.last_disagreement = None
         self.num_bins = num_bins
         self.vmin = vmin
         self.vmax = vmax
@@ -60,25 +77,43 @@ class FlowWorldModel(nn.Module):
 
         # Velocity field: takes latent, action, and time τ ∈ [0, 1]
         # Input: [latent_dim + action_dim + 1 (time) + task_dim]
-        self._velocity = mlp(
-            latent_dim + action_dim + 1 + task_dim,  # +1 for time dimension
-            units,
-            latent_dim,
-            last_layer=dynamics["last_layer"],
-            last_layer_kwargs=dynamics["last_layer_kwargs"],
+        self._velocity = heads(
+            ensemble_size,
+            lambda: mlp(
+                latent_dim + action_dim + 1 + task_dim,  # +1 for time dimension
+                units,
+                latent_dim,
+                last_layer=dynamics["last_layer"],
+                last_layer_kwargs=dynamics["last_layer_kwargs"],
+            ),
         )
 
+        # Jump: one-evaluation approximation of the integrated flow, distilled
+        # from `next`. Input: [latent_dim + action_dim + task_dim]
+        self._jump = None
+        if jump_units is not None:
+            self._jump = mlp(
+                latent_dim + action_dim + task_dim,
+                jump_units,
+                latent_dim,
+                last_layer=dynamics["last_layer"],
+                last_layer_kwargs=dynamics["last_layer_kwargs"],
+            )
+
         # Reward: identical to baseline
-        self._reward = mlp(
-            latent_dim + action_dim + task_dim,
-            units,
-            max(num_bins, 1) if num_bins else 1,
-            last_layer=reward["last_layer"],
-            last_layer_kwargs=reward["last_layer_kwargs"],
+        self._reward = heads(
+            ensemble_size,
+            lambda: mlp(
+                latent_dim + action_dim + task_dim,
+                units,
+                max(num_bins, 1) if num_bins else 1,
+                last_layer=reward["last_layer"],
+                last_layer_kwargs=reward["last_layer_kwargs"],
+            ),
         )
 
         self.apply(weight_init)
-        zero_([self._reward[-1].weight])
+        zero_([last_weight(self._reward)])
 
     @property
     def total_params(self):
@@ -137,8 +172,18 @@ class FlowWorldModel(nn.Module):
             task: Task ID or None for single-task
         
         Returns:
-            Velocity vector [batch_size, latent_dim]
+            Velocity vector [batch_size, latent_dim]. An ensemble returns the
+            velocities of all members [ensemble_size, batch_size, latent_dim];
+            z may then carry a leading member dimension to evaluate every
+            member at its own state.
         """
+        in_dims = None
+        if self.ensemble_size > 1 and z.ndim > a.ndim:
+            # member-wise states, shared action and time
+            a = a.expand(*z.shape[:-1], a.shape[-1])
+            tau = tau.expand(*z.shape[:-1], 1)
+            in_dims = 0
+
         # Concatenate latent, action, and time
         x = torch.cat([z, a, tau], dim=-1)
         
@@ -146,41 +191,122 @@ class FlowWorldModel(nn.Module):
             x = self.task_emb(x, task)
         else:
             # For single-task but with task_dim > 0, pad with zeros
-            task_dim = self._velocity[0].weight.shape[1] - x.shape[-1]
+            task_dim = in_features(self._velocity) - x.shape[-1]
             if task_dim > 0:
                 zero_pad = torch.zeros(*x.shape[:-1], task_dim, device=x.device)
                 x = torch.cat([x, zero_pad], dim=-1)
         
+        if self.ensemble_size > 1:
+            return self._velocity(x, in_dims=in_dims)
         return self._velocity(x)
 
-    def next(self, z, a, task, integrator=None, substeps=1):
+    def conditioned_velocity(self, a, task):
+        """
+        Returns a velocity function for a fixed action and task, for use with
+        the integrators. The first layer of the velocity MLP is split into its
+        z, action, τ and task blocks so that the action and task projections
+        are computed once per transition and τ enters as a rank-1 bias,
+        instead of concatenating and projecting [z, a, τ, task] every substep.
+
+        Args:
+            a: Action [batch_size, action_dim]
+            task: Task ID or None for single-task
+
+        Returns:
+            Function (z, a, τ, task) -> v_θ(z, a, τ) ignoring its a and task args
+        """
+        layer = self._velocity[0]
+        latent_dim, action_dim = self.latent_dim, a.shape[-1]
+        w_z = layer.weight[:, :latent_dim]
+        w_a = layer.weight[:, latent_dim : latent_dim + action_dim]
+        w_tau = layer.weight[:, latent_dim + action_dim]
+        w_task = layer.weight[:, latent_dim + action_dim + 1 :]
+
+        cond = F.linear(a, w_a, layer.bias)
+        if self.multitask:
+            # zero padding of single-task models contributes nothing
+            emb = self.task_emb(a[..., :0], task)
+            cond = cond + F.linear(emb, w_task)
+
+        def velocity(z, _a, tau, _task):
+            x = F.linear(z, w_z) + cond + tau * w_tau
+            if layer.dropout:
+                x = layer.dropout(x)
+            x = layer.ln(x)
+            if layer.act:
+                x = layer.act(x)
+            return self._velocity[1:](x)
+
+        return velocity
+
+    def next(self, z, a, task, integrator=None, substeps=1, members=False,
+             **solver_kwargs):
         """
         Predicts the next latent state using the specified integrator.
+        The number of velocity evaluations used is stored in `last_nfe`.
+        An ensemble integrates the flow of every member from z in one batch,
+        predicts the mean of the endpoints and stores their disagreement
+        [batch_size] in `last_disagreement`.
         
         Args:
             z: Current latent state
             a: Action
             task: Task ID
-            integrator: Integration method ('euler' or 'heun')
+            integrator: Integration method ('euler', 'midpoint', 'heun', 'rk4'
+                or 'adaptive')
             substeps: Number of substeps for integration
+            members: Return the endpoints of all members [ensemble_size, ...]
+            **solver_kwargs: max_nfe, atol, rtol and checkpoint passed to
+                `integrate`
         
         Returns:
             Next latent state
         """
         # Import here to avoid circular dependency
-        from flow_mbpo_pwm.utils.integrators import euler_step, heun_step
+        from flow_mbpo_pwm.utils.integrators import integrate
         
-        if integrator is None or integrator == 'heun':
-            return heun_step(self.velocity, z, a, task, substeps)
-        elif integrator == 'euler':
-            return euler_step(self.velocity, z, a, task, substeps)
+        velocity_fn = self.velocity
+        if self.factorized_velocity:
+            velocity_fn = self.conditioned_velocity(a, task)
+        if self.ensemble_size > 1:
+            z = z.expand(self.ensemble_size, *z.shape)
+
+        z, self.last_nfe = integrate(
+            velocity_fn, z, a, task,
+            method=integrator or 'heun',
+            substeps=substeps,
+            return_nfe=True,
+            **solver_kwargs,
+        )
+        if self.ensemble_size == 1:
+            return z[None] if members else z
+        self.last_disagreement = disagreement(z)
+        return z if members else z.mean(dim=0)
+
+    def jump(self, z, a, task):
+        """
+        Predicts the next latent state with a single evaluation of the
+        distilled jump head instead of integrating the velocity field.
+        """
+        assert self._jump is not None, "FlowWorldModel was built without jump_units"
+        z = torch.cat([z, a], dim=-1)
+        
+        if self.multitask:
+            z = self.task_emb(z, task)
         else:
-            raise ValueError(f"Unknown integrator: {integrator}")
+            # For single-task but with task_dim > 0, pad with zeros
+            task_dim = self._jump[0].weight.shape[1] - z.shape[-1]
+            if task_dim > 0:
+                zero_pad = torch.zeros(*z.shape[:-1], task_dim, device=z.device)
+                z = torch.cat([z, zero_pad], dim=-1)
+        
+        return self._jump(z)
 
-    def reward(self, z, a, task):
+    def reward(self, z, a, task, members=False):
         """
         Predicts instantaneous (single-step) reward.
-        Identical to baseline implementation.
+        Identical to baseline implementation, including the ensemble mixture
+        and `members`.
         """
         z = torch.cat([z, a], dim=-1)
         
@@ -188,14 +314,17 @@ class FlowWorldModel(nn.Module):
             z = self.task_emb(z, task)
         else:
             # For single-task but with task_dim > 0, pad with zeros
-            task_dim = self._reward[0].weight.shape[1] - z.shape[-1]
+            task_dim = in_features(self._reward) - z.shape[-1]
             if task_dim > 0:
                 zero_pad = torch.zeros(*z.shape[:-1], task_dim, device=z.device)
                 z = torch.cat([z, zero_pad], dim=-1)
         
-        return self._reward(z)
+        r = self._reward(z)
+        if self.ensemble_size == 1:
+            return r[None] if members else r
+        return r if members else member_mean(r, self.num_bins)
 
-    def step(self, z, a, task, integrator=None, substeps=1):
+    def step(self, z, a, task, integrator=None, substeps=1, **solver_kwargs):
         """
         Predicts the next latent state and reward.
         
@@ -205,12 +334,14 @@ class FlowWorldModel(nn.Module):
             task: Task ID
             integrator: Integration method
             substeps: Number of substeps for integration
+            **solver_kwargs: max_nfe, atol, rtol and checkpoint passed to
+                `integrate`
         
         Returns:
             Tuple of (next_latent_state, reward)
         """
         assert z.shape[0] == a.shape[0]
-        z_next = self.next(z, a, task, integrator, substeps)
+        z_next = self.next(z, a, task, integrator, substeps, **solver_kwargs)
         r = self.reward(z, a, task)
         return z_next, r
 
@@ -1,6 +1,9 @@
+import copy
+
+import torch
 from torch import vmap
 import torch.nn as nn
-from functorch import combine_state_for_ensemble
+from torch.func import functional_call, stack_module_state
 
 
 def init(module, weight_init, bias_init):
@@ -9,21 +12,178 @@ def init(module, weight_init, bias_init):
     return module
 
 
-class Ensemble(nn.Module):
+class _Call(nn.Module):
+    """Exposes `fn(module, *args)` as the forward of a module."""
+
+    def __init__(self, module, fn):
+        super().__init__()
+        self.module = module
+        self.fn = fn
+
+    def forward(self, *args):
+        return self.fn(self.module, *args)
+
+
+class SeedStack(nn.Module):
     """
-    Vectorized ensemble of modules.
+    Independent copies of a module (e.g. one per seed) with their parameters
+    stacked along a new leading dimension. Unlike `Ensemble`, every copy gets
+    its own inputs, and `call` vectorizes any function of the module, not
+    only its forward.
+
+    The template is not registered as a submodule. During `call` its
+    parameters are swapped for those of each copy, so methods of objects
+    that hold on to the template (e.g. an agent) can be vmapped as well.
+
+    Args:
+        template: Module with the architecture of the copies
+        modules: The copies to stack
+        randomness: vmap randomness, "different" draws independently per copy
     """
 
-    def __init__(self, modules, **kwargs):
+    def __init__(self, template, modules, randomness="different"):
         super().__init__()
-        modules = nn.ModuleList(modules)
-        fn, params, _ = combine_state_for_ensemble(modules)
-        self.vmap = vmap(fn, in_dims=(0, 0, None), randomness="different", **kwargs)
-        self.params = nn.ParameterList([nn.Parameter(p) for p in params])
-        self._repr = str(modules)
-
-    def forward(self, *args, **kwargs):
-        return self.vmap([p for p in self.params], (), *args, **kwargs)
+        params, buffers = stack_module_state(list(modules))
+        self.num_members = len(modules)
+        self.randomness = randomness
+        self._param_names = list(params)
+        self._buffer_names = list(buffers)
+        self.params = nn.ParameterList(
+            [nn.Parameter(params[k]) for k in self._param_names]
+        )
+        for i, k in enumerate(self._buffer_names):
+            self.register_buffer(f"buffer_{i}", buffers[k])
+        self.__dict__["template"] = template
+
+    def stacked_parameters(self):
+        """Return the stacked parameters keyed by their name in the template."""
+        return dict(zip(self._param_names, self.params))
+
+    def stacked_buffers(self):
+        return {
+            k: getattr(self, f"buffer_{i}") for i, k in enumerate(self._buffer_names)
+        }
+
+    def call(self, fn, *args, in_dims=0):
+        """
+        Evaluates `fn(template, *args)` under the parameters of every copy in
+        a single vmapped pass. `in_dims` follows the `vmap` convention for
+        `args`; batched args carry the copies in the given dimension.
+        """
+        return self._vmap_call(
+            fn, self.stacked_parameters(), self.stacked_buffers(), args, in_dims
+        )
+
+    def _vmap_call(self, fn, params, buffers, args, in_dims):
+        caller = _Call(self.template, fn)
+
+        def member(params, buffers, *member_args):
+            state = {f"module.{k}": v for k, v in params.items()}
+            state.update({f"module.{k}": v for k, v in buffers.items()})
+            return functional_call(caller, state, member_args)
+
+        if not isinstance(in_dims, tuple):
+            in_dims = (in_dims,) * len(args)
+        return vmap(member, in_dims=(0, 0, *in_dims), randomness=self.randomness)(
+            params, buffers, *args
+        )
+
+    def forward(self, *args, in_dims=0):
+        return self.call(lambda module, *a: module(*a), *args, in_dims=in_dims)
+
+    @torch.no_grad()
+    def unstack_into(self, modules):
+        """Copy the parameters and buffers of every copy back into `modules`."""
+        stacked = {**self.stacked_parameters(), **self.stacked_buffers()}
+        for i, module in enumerate(modules):
+            for k, v in module.state_dict(keep_vars=True).items():
+                if k in stacked:
+                    v.data.copy_(stacked[k][i])
+
+    def stack_optimizer(self, optimizer):
+        """
+        Builds an optimizer of the same type and hyperparameters as
+        `optimizer`, which optimizes parameters of the template, over the
+        corresponding stacked parameters. Element-wise optimizers such as Adam
+        keep a separate state for every copy this way.
+        """
+        names = {id(p): k for k, p in self.template.named_parameters()}
+        stacked = self.stacked_parameters()
+        groups = []
+        for group in optimizer.param_groups:
+            options = {k: v for k, v in group.items() if k != "params"}
+            params = [stacked[names[id(p)]] for p in group["params"]]
+            groups.append(dict(params=params, **options))
+        return type(optimizer)(groups)
+
+    def __repr__(self):
+        return f"{self.num_members}x Stacked " + str(self.template)
+
+
+class Ensemble(SeedStack):
+    """
+    Vectorized ensemble of modules of the same architecture, e.g. critics or
+    world models. All members see the same inputs by default and are
+    evaluated in one vmapped pass over their stacked parameters.
+
+    With `ema`, the ensemble keeps stacked target parameters that follow the
+    online ones by `update_target`, an exponential moving average with
+    weight `ema` computed with a single `_foreach_lerp_`.
+
+    Args:
+        modules: The members
+        ema: Target network update weight, None for no target parameters
+        randomness: vmap randomness, "different" draws independently per member
+    """
+
+    def __init__(self, modules, ema=None, randomness="different"):
+        modules = list(modules)
+        # parameter-free copy of the architecture, the members are stacked
+        template = copy.deepcopy(modules[0]).to("meta")
+        super().__init__(template, modules, randomness=randomness)
+        self.ema = ema
+        if ema is not None:
+            for i, p in enumerate(self.params):
+                self.register_buffer(f"target_{i}", p.detach().clone())
+        self._repr = str(nn.ModuleList(modules))
+
+    def target_parameters(self):
+        """Return the stacked target parameters keyed like `stacked_parameters`."""
+        return {
+            k: getattr(self, f"target_{i}") for i, k in enumerate(self._param_names)
+        }
+
+    @torch.no_grad()
+    def update_target(self, ema=None):
+        """Move the target parameters towards the online ones by `ema`."""
+        targets = list(self.target_parameters().values())
+        online = [p.detach() for p in self.params]
+        torch._foreach_lerp_(targets, online, self.ema if ema is None else ema)
+
+    def call(self, fn, *args, in_dims=None, members=None, target=False):
+        """
+        Evaluates `fn(member, *args)` for every member in one vmapped pass.
+        `members` selects a subset, either as indices or as a number of
+        randomly drawn members. `target` uses the target parameters.
+        """
+        params = self.target_parameters() if target else self.stacked_parameters()
+        buffers = self.stacked_buffers()
+        if members is not None:
+            if isinstance(members, int):
+                device = self.params[0].device
+                members = torch.randperm(self.num_members, device=device)[:members]
+            params = {k: v[members] for k, v in params.items()}
+            buffers = {k: v[members] for k, v in buffers.items()}
+        return self._vmap_call(fn, params, buffers, args, in_dims)
+
+    def forward(self, *args, in_dims=None, members=None, target=False):
+        return self.call(
+            lambda module, *a: module(*a),
+            *args,
+            in_dims=in_dims,
+            members=members,
+            target=target,
+        )
 
     def __repr__(self):
         return "Vectorized " + self._repr
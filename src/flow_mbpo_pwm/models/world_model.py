@@ -2,10 +2,13 @@
 # differentiating through reward two hot inversion
 # https://github.com/nicklashansen/tdmpc2/
 
+import math
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from .mlp import SimNorm, mlp
+from .model_utils import Ensemble
 
 
 def weight_init(m):
@@ -29,6 +32,42 @@ def zero_(params):
         p.data.fill_(0)
 
 
+def heads(size, build):
+    """A head `build()`, or a vectorized `Ensemble` of `size` independent heads."""
+    if size == 1:
+        return build()
+    return Ensemble([build() for _ in range(size)])
+
+
+def in_features(net):
+    """Input width of an mlp or an ensemble of mlps."""
+    if isinstance(net, Ensemble):
+        net = net.template
+    return net[0].weight.shape[1]
+
+
+def last_weight(net):
+    """Weight of the last layer of an mlp, stacked over the members of an ensemble."""
+    if isinstance(net, Ensemble):
+        return net.stacked_parameters()[f"{len(net.template) - 1}.weight"]
+    return net[-1].weight
+
+
+def member_mean(x, num_bins=None):
+    """
+    Mean of ensemble predictions [N, ...]. Two-hot reward logits are averaged
+    as distributions, i.e. the logits of the mixture are returned.
+    """
+    if num_bins is not None and num_bins > 1:
+        return torch.logsumexp(F.log_softmax(x, dim=-1), dim=0) - math.log(x.shape[0])
+    return x.mean(dim=0)
+
+
+def disagreement(x):
+    """Std of ensemble predictions [N, ..., D] across the members, averaged over D."""
+    return x.std(dim=0, unbiased=False).mean(dim=-1)
+
+
 @torch.jit.script
 def symexp(x):
     """
@@ -64,9 +103,12 @@ class WorldModel(nn.Module):
         multitask=False,
         tasks=None,
         task_dim=0,
+        ensemble_size=1,  # independent dynamics and reward heads on a shared encoder
     ):
         super().__init__()
         self.multitask = multitask
+        self.ensemble_size = ensemble_size
+        self.last_disagreement = None
         self.num_bins = num_bins
         self.vmin = vmin
         self.vmax = vmax
@@ -82,22 +124,28 @@ class WorldModel(nn.Module):
             last_layer=encoder["last_layer"],
             last_layer_kwargs=encoder["last_layer_kwargs"],
         )
-        self._dynamics = mlp(
-            latent_dim + action_dim + task_dim,
-            units,
-            latent_dim,
-            last_layer=dynamics["last_layer"],
-            last_layer_kwargs=dynamics["last_layer_kwargs"],
+        self._dynamics = heads(
+            ensemble_size,
+            lambda: mlp(
+                latent_dim + action_dim + task_dim,
+                units,
+                latent_dim,
+                last_layer=dynamics["last_layer"],
+                last_layer_kwargs=dynamics["last_layer_kwargs"],
+            ),
         )
-        self._reward = mlp(
-            latent_dim + action_dim + task_dim,
-            units,
-            max(num_bins, 1) if num_bins else 1,
-            last_layer=reward["last_layer"],
-            last_layer_kwargs=reward["last_layer_kwargs"],
+        self._reward = heads(
+            ensemble_size,
+            lambda: mlp(
+                latent_dim + action_dim + task_dim,
+                units,
+                max(num_bins, 1) if num_bins else 1,
+                last_layer=reward["last_layer"],
+                last_layer_kwargs=reward["last_layer_kwargs"],
+            ),
         )
         self.apply(weight_init)
-        zero_([self._reward[-1].weight])
+        zero_([last_weight(self._reward)])
 
     @property
     def total_params(self):
@@ -143,23 +191,35 @@ class WorldModel(nn.Module):
             obs = self.task_emb(obs, task)
         return self._encoder(obs)
 
-    def next(self, z, a, task):
+    def next(self, z, a, task, members=False):
         """
         Predicts the next latent state given the current latent state and action.
+        An ensemble predicts the mean of its members and stores their
+        disagreement [batch_size] in `last_disagreement`. With `members`, the
+        predictions of all members [ensemble_size, ...] are returned.
         """
         if self.multitask:
             z = self.task_emb(z, task)
         z = torch.cat([z, a], dim=-1)
-        return self._dynamics(z)
+        z = self._dynamics(z)
+        if self.ensemble_size == 1:
+            return z[None] if members else z
+        self.last_disagreement = disagreement(z)
+        return z if members else z.mean(dim=0)
 
-    def reward(self, z, a, task):
+    def reward(self, z, a, task, members=False):
         """
         Predicts instantaneous (single-step) reward.
+        An ensemble predicts the mixture of its members, or with `members` the
+        predictions of all members [ensemble_size, ...].
         """
         if self.multitask:
             z = self.task_emb(z, task)
         z = torch.cat([z, a], dim=-1)
-        return self._reward(z)
+        r = self._reward(z)
+        if self.ensemble_size == 1:
+            return r[None] if members else r
+        return r if members else member_mean(r, self.num_bins)
 
     def step(self, z, a, task):
         """
@@ -14,6 +14,10 @@ class AverageMeter(nn.Module):
         if size == 0:
             return
         new_mean = torch.mean(values.float(), dim=0)
+        self.update_moments(new_mean, size)
+
+    def update_moments(self, new_mean, size):
+        """Update with the mean of `size` new values."""
         if size > self.max_size:
             size = self.max_size
         old_size = min(self.max_size - size, self.current_size)
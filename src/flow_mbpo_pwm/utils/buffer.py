@@ -1,28 +1,174 @@
+import os
+import tempfile
 import torch
 from tensordict.tensordict import TensorDict
-from torchrl.data.replay_buffers import ReplayBuffer, LazyTensorStorage
-from torchrl.data.replay_buffers.samplers import SliceSampler
+from torchrl.data.replay_buffers import (
+    ReplayBuffer,
+    LazyTensorStorage,
+    LazyMemmapStorage,
+)
+from torchrl.data.replay_buffers.samplers import PrioritizedSliceSampler, SliceSampler
+
+from flow_mbpo_pwm.utils.common import print_warning
+
+
+class FieldCodec:
+    """
+    Stores a float replay field at reduced precision and restores float32 on
+    read. Supports "float32", "float16", "bfloat16" and "int8". int8 uses a
+    per-feature scale and offset calibrated on the first data (widened by
+    `margin` on both sides) and keeps NaNs, which mark episode starts, as -128.
+    The half-range of a feature is at least `min_half_range` and `margin`
+    times its |offset|, so features that are constant in the first data do
+    not get a vanishing scale. Values outside the range are clamped and
+    counted in `saturated`, with a warning the first time it happens.
+    """
+
+    DTYPES = dict(
+        float32=torch.float32,
+        float16=torch.float16,
+        bfloat16=torch.bfloat16,
+        int8=torch.int8,
+    )
+
+    def __init__(self, dtype="float32", margin=0.25, min_half_range=1.0):
+        assert dtype in self.DTYPES, f"Unknown storage dtype: {dtype}"
+        self.dtype = self.DTYPES[dtype]
+        self.margin = margin
+        self.min_half_range = min_half_range
+        self.scale = None
+        self.offset = None
+        self.saturated = 0
+
+    @property
+    def quantized(self):
+        return self.dtype == torch.int8
+
+    def calibrate(self, x):
+        """Fit the int8 range to `x` [N, *feature_shape] unless already fitted."""
+        if not self.quantized or self.scale is not None:
+            return
+        flat = x.float().reshape(x.shape[0], -1)
+        flat = flat[torch.isfinite(flat).all(dim=-1)]
+        lo, hi = flat.min(dim=0).values, flat.max(dim=0).values
+        offset = (hi + lo) / 2
+        half = (hi - lo) / 2 * (1 + self.margin)
+        half = torch.maximum(half, self.margin * offset.abs()).clamp(
+            min=self.min_half_range
+        )
+        self.scale = (half / 127).view(x.shape[1:]).cpu()
+        self.offset = offset.view(x.shape[1:]).cpu()
+
+    def encode(self, x):
+        if not self.quantized:
+            return x.to(self.dtype)
+        scale, offset = self.scale.to(x.device), self.offset.to(x.device)
+        q = ((x - offset) / scale).round()
+        saturated = int((q.abs() > 127).sum())
+        if saturated > 0:
+            if self.saturated == 0:
+                print_warning(
+                    f"{saturated} values outside the calibrated int8 range are "
+                    "clamped, consider a larger min_half_range"
+                )
+            self.saturated += saturated
+        q = q.clamp(-127, 127)
+        return q.nan_to_num(-128.0).to(torch.int8)
+
+    def decode(self, x):
+        if not self.quantized:
+            return x.float()
+        scale, offset = self.scale.to(x.device), self.offset.to(x.device)
+        out = x.float() * scale + offset
+        return out.masked_fill(x == -128, float("nan"))
+
+    def state_dict(self):
+        return dict(scale=self.scale, offset=self.offset)
+
+    def load_state_dict(self, state):
+        self.scale, self.offset = state["scale"], state["offset"]
 
 
 class Buffer:
     """
     Replay buffer for TD-MPC2 training. Based on torchrl.
     Uses CUDA memory if available, and CPU memory otherwise.
+
+    With `storage="memmap"` episodes are written to memory-mapped files in
+    `scratch_dir` instead, so only the sampled slices are paged into RAM and
+    the capacity is bounded by disk space. `save` copies these files into
+    the checkpoint.
+
+    With `prioritized=True` slice start indices are drawn from a sum-tree in
+    proportion to their priority (to the power `priority_alpha`), e.g. the
+    world model loss on the slice, and `sample(return_info=True)` returns
+    importance-sampling weights with exponent `priority_beta`.
+
+    Episodes get globally unique, increasing ids. The storage slots at which
+    a complete horizon + 1 window of a single episode starts are tracked on
+    every write, so uniform sampling is a `randint` into that index followed
+    by a single gather, and slices never straddle two episodes.
+
+    `dtypes` maps the fields "obs", "action" and "reward" to their storage
+    dtype (see `FieldCodec`), e.g. `dict(obs="bfloat16", action="bfloat16")`.
+    Fields are cast when added and upcast to float32 when sampled. int8
+    fields have a half-range of at least `int8_min_half_range` per feature.
     """
 
-    def __init__(self, buffer_size, batch_size, horizon, device, terminate=False):
+    def __init__(
+        self,
+        buffer_size,
+        batch_size,
+        horizon,
+        device,
+        terminate=False,
+        storage="auto",
+        scratch_dir=None,
+        prioritized=False,
+        priority_alpha=0.6,
+        priority_beta=0.4,
+        dtypes=None,
+        int8_min_half_range=1.0,
+    ):
+        assert storage in ["auto", "cuda", "cpu", "memmap"]
         self._device = device
         self._capacity = buffer_size
         self._horizon = horizon
-        self._sampler = SliceSampler(
-            num_slices=batch_size,
-            end_key=None,
-            traj_key="episode",
-            truncated_key=None,
-        )
+        self._storage = storage
+        self._scratch_dir = scratch_dir
+        self.prioritized = prioritized
+        if prioritized:
+            self._sampler = PrioritizedSliceSampler(
+                max_capacity=buffer_size,
+                alpha=priority_alpha,
+                beta=priority_beta,
+                num_slices=batch_size,
+                end_key=None,
+                traj_key="episode",
+                truncated_key=None,
+            )
+        else:
+            self._sampler = SliceSampler(
+                num_slices=batch_size,
+                end_key=None,
+                traj_key="episode",
+                truncated_key=None,
+            )
         self._batch_size = batch_size * (horizon + 1)
-        self._num_eps = 0
+        self._num_slices = batch_size
+        self._num_eps = 0  # also the id of the next episode
+        self._slot_episode = None  # episode id of every storage slot, -1 if empty
+        self._start_ok = None  # slots at which a valid window starts
+        self._starts = None
         self.terminate = terminate
+        dtypes = dict(dtypes or {})
+        self._codecs = {
+            key: FieldCodec(
+                dtypes.pop(key, "float32"), min_half_range=int8_min_half_range
+            )
+            for key in ["obs", "action", "reward"]
+        }
+        assert len(dtypes) == 0, f"No storage dtype for fields {list(dtypes)}"
 
     @property
     def capacity(self):
@@ -34,6 +180,23 @@ class Buffer:
         """Return the number of episodes in the buffer."""
         return self._num_eps
 
+    @property
+    def scratch_dir(self):
+        """Return the directory backing the memory-mapped storage (if any)."""
+        return self._scratch_dir
+
+    def _make_storage(self, storage_device):
+        """Create the torchrl storage for the given placement."""
+        if storage_device == "memmap":
+            if self._scratch_dir is None:
+                self._scratch_dir = tempfile.mkdtemp(prefix="pwm_buffer_")
+            os.makedirs(self._scratch_dir, exist_ok=True)
+            print(f"Memory-mapping storage to {self._scratch_dir}")
+            return LazyMemmapStorage(
+                self._capacity, scratch_dir=self._scratch_dir, device="cpu"
+            )
+        return LazyTensorStorage(self._capacity, device=torch.device(storage_device))
+
     def _reserve_buffer(self, storage):
         """
         Reserve a buffer with the given storage.
@@ -49,7 +212,7 @@ class Buffer:
     def _init(self, tds):
         """Initialize the replay buffer. Use the first episode to estimate storage requirements."""
         print(f"Buffer capacity: {self._capacity:,}")
-        mem_free, _ = torch.cuda.mem_get_info()
+        mem_free = torch.cuda.mem_get_info()[0] if torch.cuda.is_available() else 0
         bytes_per_step = sum(
             [
                 (
@@ -62,12 +225,13 @@ class Buffer:
         ) / len(tds)
         total_bytes = bytes_per_step * self._capacity
         print(f"Storage required: {total_bytes/1e9:.2f} GB")
-        # Heuristic: decide whether to use CUDA or CPU memory
-        storage_device = "cuda" if 2.5 * total_bytes < mem_free else "cpu"
+        if self._storage == "auto":
+            # Heuristic: decide whether to use CUDA or CPU memory
+            storage_device = "cuda" if 2.5 * total_bytes < mem_free else "cpu"
+        else:
+            storage_device = self._storage
         print(f"Using {storage_device.upper()} memory for storage.")
-        return self._reserve_buffer(
-            LazyTensorStorage(self._capacity, device=torch.device(storage_device))
-        )
+        return self._reserve_buffer(self._make_storage(storage_device))
 
     def _to_device(self, *args, device=None):
         if device is None:
@@ -77,31 +241,59 @@ class Buffer:
             for arg in args
         )
 
+    def _encode(self, td):
+        """Cast the fields of `td` [N] to their storage dtypes."""
+        td = td.copy()
+        for key, codec in self._codecs.items():
+            codec.calibrate(td[key])
+            td[key] = codec.encode(td[key])
+        return td
+
+    def _decode(self, key, x):
+        """Move a stored field to the device and upcast it to float32."""
+        (x,) = self._to_device(x)
+        return self._codecs[key].decode(x)
+
     def _prepare_batch(self, td):
         """
         Prepare a sampled batch for training (post-processing).
         Expects `td` to be a TensorDict with batch size TxB.
         """
-        obs = td["obs"]
-        action = td["action"][1:]
-        reward = td["reward"][1:].unsqueeze(-1)
+        obs = self._decode("obs", td["obs"])
+        action = self._decode("action", td["action"][1:])
+        reward = self._decode("reward", td["reward"][1:]).unsqueeze(-1)
         if self.terminate:
-            term = td["term"][1:].unsqueeze(-1)
-            return self._to_device(obs, action, reward, term)
+            (term,) = self._to_device(td["term"][1:].unsqueeze(-1))
+            return obs, action, reward, term
         else:
-            return self._to_device(obs, action, reward)
+            return obs, action, reward
 
     def add(self, td):
         """Add an episode to the buffer."""
         td["episode"] = (
             torch.ones_like(td["reward"].squeeze(), dtype=torch.int32) * self._num_eps
         )
+        td = self._encode(td)
         if self._num_eps == 0:
             self._buffer = self._init(td)
-        self._buffer.extend(td)
+        self._extend(td)
         self._num_eps += 1
         return self._num_eps
 
+    def add_episodes(self, td, episode):
+        """
+        Add several episodes stored back to back in a flat TensorDict.
+        `episode` holds the local index (0, 1, ...) of the episode of every step.
+        """
+        num_eps = int(episode[-1]) + 1
+        td["episode"] = (episode + self._num_eps).to(torch.int32)
+        td = self._encode(td)
+        if self._num_eps == 0:
+            self._buffer = self._init(td[episode == 0])
+        self._extend(td)
+        self._num_eps += num_eps
+        return self._num_eps
+
     def add_batch(self, td):
         """Add a batch of episodes to the buffer."""
         num_eps = td["reward"].shape[0]
@@ -109,29 +301,258 @@ class Buffer:
         max_eps = self._capacity // ep_len
         eps_that_fit = min(num_eps, max_eps)
         print(f"Can fit {eps_that_fit} episodes into buffer")
-        td = td[torch.randint(0, num_eps, (eps_that_fit,))]
-        episodes = torch.ones_like(td["reward"], dtype=torch.int32) * torch.arange(
-            0, eps_that_fit, dtype=torch.int32
-        ).view((-1, 1))
-        td["episode"] = episodes
+        td = td[torch.randperm(num_eps)[:eps_that_fit]]
+        episodes = torch.arange(
+            self._num_eps, self._num_eps + eps_that_fit, dtype=torch.int32
+        )
+        td["episode"] = episodes.view((-1, 1)).expand(td["reward"].shape)
         td = td.flatten()  # faltten to easy ading
+        td = self._encode(td)
         if self._num_eps == 0:
             self._buffer = self._init(td[0 : ep_len + 1])
-        self._buffer.extend(td)
-        self._num_eps += num_eps
+        self._extend(td)
+        self._num_eps += eps_that_fit
         return self._num_eps
 
-    def sample(self):
-        """Sample a batch of subsequences from the buffer."""
-        td = self._buffer.sample().view(-1, self._horizon + 1).permute(1, 0)
-        return self._prepare_batch(td)
+    def _extend(self, td):
+        """Write the flat TensorDict `td` to the storage and index its windows."""
+        index = self._buffer.extend(td)
+        if isinstance(index, tuple):
+            index = index[0]
+        self._index_windows(
+            torch.as_tensor(index).cpu().long(), td["episode"].cpu().long()
+        )
+
+    def _index_windows(self, pos, episode):
+        """Update the window index after `episode` ids were written to slots `pos`."""
+        H, C = self._horizon, self._capacity
+        if self._slot_episode is None:
+            self._slot_episode = torch.full((C,), -1, dtype=torch.long)
+            self._start_ok = torch.zeros(C, dtype=torch.bool)
+        # windows that contain an overwritten slot are gone
+        self._start_ok[(pos[:, None] - torch.arange(H + 1)) % C] = False
+        self._slot_episode[pos] = episode
+        # episodes are written whole and in one piece, so a window is valid iff
+        # the step H slots further was written right behind it, same episode
+        if len(pos) > H:
+            ok = (episode[H:] == episode[:-H]) & (pos[H:] == (pos[:-H] + H) % C)
+            self._start_ok[pos[:-H][ok]] = True
+        self._starts = self._start_ok.nonzero().squeeze(-1)
+
+    def _rebuild_index(self):
+        """Recover episode ids and the window index from the storage, e.g. after `load`."""
+        H, C = self._horizon, self._capacity
+        n = len(self._buffer)
+        self._slot_episode = torch.full((C,), -1, dtype=torch.long)
+        self._slot_episode[:n] = self._buffer._storage._storage["episode"][:n].cpu().long()
+        starts = torch.arange(C)
+        ends = (starts + H) % C
+        self._start_ok = (self._slot_episode >= 0) & (
+            self._slot_episode == self._slot_episode[ends]
+        )
+        self._starts = self._start_ok.nonzero().squeeze(-1)
+        if n > 0:
+            self._num_eps = max(self._num_eps, int(self._slot_episode.max()) + 1)
+
+    def _sample_windows(self):
+        """Gather `batch_size` random valid windows. Returns them [H+1, B] and their slots."""
+        if self._starts is None or len(self._starts) == 0:
+            raise RuntimeError("No complete horizon + 1 window in the buffer")
+        starts = self._starts[torch.randint(0, len(self._starts), (self._num_slices,))]
+        index = (starts[:, None] + torch.arange(self._horizon + 1)) % self._capacity
+        td = self._buffer[index.flatten()]
+        if td.device.type == "cpu" and torch.cuda.is_available():
+            td = td.pin_memory()
+        return td.view(-1, self._horizon + 1).permute(1, 0), index
+
+    def sample(self, return_info=False):
+        """
+        Sample a batch of subsequences from the buffer. With `return_info` the
+        importance-sampling weights [B] of the subsequences and their storage
+        indices (for `update_priority`) are appended to the batch.
+        """
+        if not self.prioritized:
+            td, index = self._sample_windows()
+            if not return_info:
+                return self._prepare_batch(td)
+            (weights,) = self._to_device(torch.ones(index.shape[0]))
+            return (*self._prepare_batch(td), weights, index)
+
+        if not return_info:
+            td = self._buffer.sample().view(-1, self._horizon + 1).permute(1, 0)
+            return self._prepare_batch(td)
+
+        td, info = self._buffer.sample(return_info=True)
+        td = td.view(-1, self._horizon + 1).permute(1, 0)
+        index = info["index"]
+        if isinstance(index, tuple):
+            index = index[0]
+        index = index.view(-1, self._horizon + 1)
+        if "_weight" in info:
+            weights = torch.as_tensor(info["_weight"]).view(-1, self._horizon + 1)[:, 0]
+        else:
+            weights = torch.ones(index.shape[0])
+        (weights,) = self._to_device(weights.float())
+        return (*self._prepare_batch(td), weights, index)
+
+    def update_priority(self, index, priority):
+        """
+        Set the priority of the subsequences at `index` (as returned by
+        `sample`) to the per-subsequence values in `priority` [B].
+        """
+        if not self.prioritized:
+            return
+        priority = priority.detach().float().cpu()
+        priority = priority[:, None].expand(index.shape)
+        self._buffer.update_priority(index.flatten(), priority.flatten())
+
+    def episodes_at(self, index):
+        """Episode ids held by the storage slots `index`, -1 for empty slots."""
+        return self._slot_episode[index.cpu()]
+
+    def filled_slots(self):
+        """Indices of all storage slots holding a transition."""
+        return torch.arange(len(self._buffer))
+
+    def obs_at(self, index):
+        """Observations stored at the storage slots `index`."""
+        obs = self._buffer[index.cpu().flatten()]["obs"]
+        return self._decode("obs", obs).view(*index.shape, -1)
+
+    def sample_obs(self, num_obs):
+        """Sample `num_obs` observations uniformly from all stored steps."""
+        idx = torch.randint(0, len(self._buffer), (num_obs,))
+        return self._decode("obs", self._buffer[idx]["obs"])
 
     def save(self, filepath):
+        """
+        Write a snapshot of the buffer to the directory `filepath`. With memmap
+        storage the memory-mapped files are copied, so later writes to
+        `scratch_dir` do not change the snapshot.
+        """
         self._buffer.dumps(filepath)
+        torch.save(self._codec_state(), os.path.join(filepath, "codecs.pt"))
+
+    def _codec_state(self):
+        return {key: codec.state_dict() for key, codec in self._codecs.items()}
+
+    def _load_codec_state(self, state):
+        for key, codec in self._codecs.items():
+            codec.load_state_dict(state[key])
 
     def load(self, filepath):
+        """
+        Load a snapshot written by `save`. With memmap storage its data is
+        copied into `scratch_dir`.
+        """
         if self._num_eps == 0:
-            self._buffer = self._reserve_buffer(
-                LazyTensorStorage(self._capacity, device=self._device)
-            )
+            storage_device = self._device if self._storage == "auto" else self._storage
+            self._buffer = self._reserve_buffer(self._make_storage(storage_device))
         self._buffer.loads(filepath)
+        codec_path = os.path.join(filepath, "codecs.pt")
+        if os.path.exists(codec_path):
+            self._load_codec_state(torch.load(codec_path))
+        self._rebuild_index()
+
+
+class EpisodeStager:
+    """
+    Preallocated staging area for episodes collected from vectorized envs.
+
+    Every env owns one row of a `[num_envs, slots]` TensorDict. Each step
+    stores the transitions of all envs with one indexed write and, for envs
+    that are done, the first entry (obs with NaN action and reward) of their
+    next episode right behind it. Finished episodes are moved to a `Buffer`
+    by `flush` with a single `extend` call, after which the unfinished
+    episodes are compacted into a second preallocated TensorDict that then
+    takes the place of the first.
+    """
+
+    def __init__(
+        self, num_envs, max_episode_len, steps_per_flush, obs_dim, act_dim, device
+    ):
+        # an unfinished episode plus up to two entries per step between flushes
+        self.slots = max_episode_len + 2 * steps_per_flush + 2
+        shape = (num_envs, self.slots)
+        self.data = TensorDict(
+            dict(
+                obs=torch.zeros(*shape, obs_dim),
+                action=torch.zeros(*shape, act_dim),
+                reward=torch.zeros(*shape),
+                term=torch.zeros(*shape, dtype=torch.bool),
+                start=torch.zeros(*shape, dtype=torch.bool),
+            ),
+            shape,
+            device=device,
+        )
+        self._spare = self.data.clone()
+        self._rows = torch.arange(num_envs, device=device)
+        self._pos = torch.arange(self.slots, device=device)
+        # next write position and first entry of the unfinished episode per env
+        self.ptr = torch.zeros(num_envs, dtype=torch.long, device=device)
+        self.start = torch.zeros(num_envs, dtype=torch.long, device=device)
+
+    def _start_entry(self, obs):
+        """First entry of an episode: the reset obs with NaN action and reward."""
+        n = obs.shape[0]
+        return TensorDict(
+            dict(
+                obs=obs,
+                action=torch.full_like(self.data["action"][:, 0], torch.nan),
+                reward=torch.full((n,), torch.nan, device=obs.device),
+                term=torch.ones(n, dtype=torch.bool, device=obs.device),
+                start=torch.ones(n, dtype=torch.bool, device=obs.device),
+            ),
+            (n,),
+        )
+
+    @torch.no_grad()
+    def reset(self, obs):
+        """Start a new episode in every env from the observations `obs`."""
+        self.ptr.zero_()
+        self.start.zero_()
+        self.data[self._rows, self.ptr] = self._start_entry(obs)
+        self.ptr += 1
+
+    @torch.no_grad()
+    def add(self, obs, action, reward, term, done, next_obs):
+        """
+        Stage one step of all envs. `obs` is the observation reached by taking
+        `action` (before any env reset) and `next_obs` the observation the env
+        continues from, which starts a new episode where `done` is set.
+        """
+        step = TensorDict(
+            dict(
+                obs=obs,
+                action=action,
+                reward=reward,
+                term=term.bool(),
+                start=torch.zeros_like(done, dtype=torch.bool),
+            ),
+            (obs.shape[0],),
+        )
+        self.data[self._rows, self.ptr] = step
+        # only kept (and later overwritten otherwise) if the env is done
+        self.data[self._rows, self.ptr + 1] = self._start_entry(next_obs)
+        self.ptr += 1 + done.long()
+        self.start = torch.where(done, self.ptr - 1, self.start)
+
+    @torch.no_grad()
+    def flush(self, buffer):
+        """Move all finished episodes to `buffer`. Returns the number moved."""
+        finished = self._pos[None] < self.start[:, None]
+        if not finished.any():
+            return 0
+        td = self.data[finished]  # row-major, so episodes stay contiguous
+        episode = td["start"].long().cumsum(0) - 1
+        buffer.add_episodes(td.exclude("start"), episode)
+
+        # move the unfinished episode of every env to the front of its row
+        idx = (self._pos[None] + self.start[:, None]).clamp(max=self.slots - 1)
+        for key, value in self.data.items():
+            index = idx.view(*idx.shape, *([1] * (value.ndim - 2)))
+            torch.gather(value, 1, index.expand_as(value), out=self._spare[key])
+        self.data, self._spare = self._spare, self.data
+        self.ptr -= self.start
+        self.start.zero_()
+        return int(episode[-1]) + 1
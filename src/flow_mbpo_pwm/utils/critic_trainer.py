@@ -0,0 +1,108 @@
+"""
+Minibatch training of the critic on the targets of a rollout.
+
+The critic phase consists of many small steps. `CriticTrainer` keeps their
+overhead low: NaN samples are dropped once per phase, the data is permuted
+once per iteration and minibatches are slices (views) of it, all gradients
+live in one flat buffer so zeroing, NaN scrubbing and clipping are single
+kernels, and the losses are copied to the host once at the end of the phase.
+"""
+
+import torch
+
+
+def critic_adam(params, lr, betas, device):
+    """Adam for the critic, fused on CUDA and multi-tensor (foreach) otherwise."""
+    if torch.device(device).type == "cuda":
+        return torch.optim.Adam(params, lr, betas, fused=True)
+    return torch.optim.Adam(params, lr, betas, foreach=True)
+
+
+class CriticTrainer:
+    """
+    Trains `critic` with `optimizer` on (obs, target value) pairs.
+
+    Args:
+        critic: Critic module
+        optimizer: Optimizer of the critic parameters
+        loss_fn: Loss of a batch dict with "obs" [B, 1, obs] and
+            "target_values" [B, 1], e.g. the agent's `compute_critic_loss`
+        iterations: Passes over the data per phase
+        grad_norm: Gradient clipping norm, None to not clip
+        shuffle: Draw a new permutation of the data every iteration
+    """
+
+    def __init__(self, critic, optimizer, loss_fn, iterations, grad_norm=None, shuffle=True):
+        self.critic = critic
+        self.optimizer = optimizer
+        self.loss_fn = loss_fn
+        self.iterations = iterations
+        self.grad_norm = grad_norm
+        self.shuffle = shuffle
+        self.params = [p for p in critic.parameters() if p.requires_grad]
+        self._flat_grad = None
+
+    def _bind_grads(self):
+        """Point the gradients of all parameters into one flat buffer."""
+        if self._flat_grad is None:
+            numel = sum(p.numel() for p in self.params)
+            self._flat_grad = self.params[0].new_zeros(numel)
+        offset = 0
+        for p in self.params:
+            # optimizers may have reset .grad to None since the last phase
+            p.grad = self._flat_grad[offset : offset + p.numel()].view_as(p)
+            offset += p.numel()
+
+    def _step(self, batch):
+        grad = self._flat_grad
+        grad.zero_()
+        loss = self.loss_fn(batch)
+        loss.backward()
+        # ugly fix for simulation nan problem
+        grad.nan_to_num_(0.0, 0.0, 0.0)
+        norm = grad.norm()
+        if self.grad_norm is not None:
+            grad.mul_((self.grad_norm / (norm + 1e-6)).clamp(max=1.0))
+        self.optimizer.step()
+        return loss.detach(), norm
+
+    def train(self, obs, target_values, batch_size):
+        """
+        Train on `obs` [..., obs] and `target_values` [...] in minibatches of
+        `batch_size`. Returns the mean loss of every iteration and the
+        gradient norm of the last step, as floats. Without a single finite
+        sample the phase is skipped and no losses and a norm of 0 are returned.
+        """
+        with torch.no_grad():
+            obs = obs.reshape(-1, obs.shape[-1])
+            target_values = target_values.reshape(-1)
+            # filter nans
+            valid = (obs == obs).all(dim=-1).nonzero().squeeze(-1)
+            obs, target_values = obs[valid], target_values[valid]
+        num_samples = obs.shape[0]
+        if num_samples == 0:
+            return [], 0.0
+        num_batches = (num_samples - 1) // batch_size + 1
+
+        self._bind_grads()
+        losses = []
+        for _ in range(self.iterations):
+            if self.shuffle:
+                # one gather per iteration, the minibatches are views of it
+                perm = torch.randperm(num_samples, device=obs.device)
+                obs_it, targets_it = obs[perm], target_values[perm]
+            else:
+                obs_it, targets_it = obs, target_values
+            total = obs.new_zeros(())
+            for b in range(num_batches):
+                batch = slice(b * batch_size, (b + 1) * batch_size)
+                loss, norm = self._step(
+                    {
+                        "obs": obs_it[batch].unsqueeze(1),
+                        "target_values": targets_it[batch].unsqueeze(1),
+                    }
+                )
+                total += loss
+            losses.append(total / num_batches)
+        values = torch.stack(losses + [norm]).tolist()
+        return values[:-1], values[-1]
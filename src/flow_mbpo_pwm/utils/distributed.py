@@ -0,0 +1,111 @@
+"""
+Helpers for data-parallel world model training with torch.distributed.
+
+Processes are expected to be launched with `torchrun`, which sets the
+`RANK`, `LOCAL_RANK` and `WORLD_SIZE` environment variables. Without them
+every helper falls back to single-process behaviour.
+"""
+
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    if is_distributed():
+        return dist.get_rank()
+    return int(os.environ.get("RANK", 0))
+
+
+def get_local_rank():
+    return int(os.environ.get("LOCAL_RANK", 0))
+
+
+def get_world_size():
+    if is_distributed():
+        return dist.get_world_size()
+    return int(os.environ.get("WORLD_SIZE", 1))
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_distributed(backend=None):
+    """
+    Initialize the default process group from the torchrun environment.
+    Defaults to nccl when CUDA is available and to gloo otherwise.
+    """
+    if is_distributed():
+        return
+    if backend is None:
+        backend = "nccl" if torch.cuda.is_available() else "gloo"
+    if backend == "nccl":
+        torch.cuda.set_device(get_local_rank())
+    dist.init_process_group(backend=backend)
+
+
+@torch.no_grad()
+def broadcast_module(module, src=0):
+    """Copy the parameters and buffers of `module` on rank `src` to all ranks."""
+    if not is_distributed():
+        return
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        dist.broadcast(tensor.data, src=src)
+
+
+@torch.no_grad()
+def all_reduce_grads(parameters):
+    """
+    Average the gradients of `parameters` over all ranks in place. Gradients
+    are flattened into a single buffer so only one collective is issued.
+    """
+    if not is_distributed() or get_world_size() == 1:
+        return
+    grads = [p.grad for p in parameters if p.grad is not None]
+    if len(grads) == 0:
+        return
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+    flat /= get_world_size()
+    offset = 0
+    for g in grads:
+        g.copy_(flat[offset : offset + g.numel()].view_as(g))
+        offset += g.numel()
+
+
+def any_rank(flag, device=None):
+    """Return True on every rank if `flag` is true on at least one rank."""
+    if not is_distributed() or get_world_size() == 1:
+        return bool(flag)
+    t = torch.tensor([float(flag)], device=device)
+    dist.all_reduce(t, op=dist.ReduceOp.MAX)
+    return bool(t.item())
+
+
+@torch.no_grad()
+def all_reduce_rms(rms):
+    """
+    Pool the moments of the RunningMeanStd `rms` over all ranks in place.
+    Every rank ends up with the count-weighted mean and variance of all ranks
+    and their average count, so the history shared since the previous sync
+    is not counted once per rank.
+    """
+    if not is_distributed() or get_world_size() == 1:
+        return
+    mean, var = rms.mean.double().reshape(-1), rms.var.double().reshape(-1)
+    count = torch.full((1,), float(rms.count), dtype=torch.float64, device=mean.device)
+    flat = torch.cat([count, count * mean, count * (var + mean**2)])
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+    n = mean.numel()
+    total = flat[0]
+    mean = flat[1 : 1 + n] / total
+    var = (flat[1 + n :] / total - mean**2).clamp(min=0)
+    rms.mean = mean.view_as(rms.mean).to(rms.mean.dtype)
+    rms.var = var.view_as(rms.var).to(rms.var.dtype)
+    rms.count = total.item() / get_world_size()
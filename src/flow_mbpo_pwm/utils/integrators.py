@@ -1,11 +1,17 @@
 """
 ODE integrators for flow-matching dynamics.
 
-Implements Euler and Heun's method for integrating the velocity field
-from t=0 to t=1 to predict next states.
+Implements fixed-step Euler, Heun, midpoint and RK4 methods and an adaptive
+Bogacki-Shampine 3(2) solver for integrating the velocity field from t=0 to
+t=1 to predict next states. `integrate` dispatches between them by name and
+enforces a budget on the number of velocity evaluations (NFE).
 """
 
 import torch
+from torch.utils.checkpoint import checkpoint as activation_checkpoint
+
+# Attempts of the adaptive solver when no NFE budget is given
+ADAPTIVE_MAX_ATTEMPTS = 100
 
 
 def euler_step(velocity_fn, z, a, task, substeps=1):
@@ -26,12 +32,12 @@ def euler_step(velocity_fn, z, a, task, substeps=1):
         Final latent state after integration
     """
     dt = 1.0 / substeps
-    batch_size = z.shape[0]
+    shape = (*z.shape[:-1], 1)
     
     for k in range(substeps):
         # Current time
         t_k = k * dt
-        tau = torch.full((batch_size, 1), t_k, device=z.device, dtype=z.dtype)
+        tau = torch.full(shape, t_k, device=z.device, dtype=z.dtype)
         
         # Compute velocity
         v = velocity_fn(z, a, tau, task)
@@ -63,12 +69,12 @@ def heun_step(velocity_fn, z, a, task, substeps=1):
         Final latent state after integration
     """
     dt = 1.0 / substeps
-    batch_size = z.shape[0]
+    shape = (*z.shape[:-1], 1)
     
     for k in range(substeps):
         # Current time
         t_k = k * dt
-        tau_k = torch.full((batch_size, 1), t_k, device=z.device, dtype=z.dtype)
+        tau_k = torch.full(shape, t_k, device=z.device, dtype=z.dtype)
         
         # First velocity evaluation
         k1 = velocity_fn(z, a, tau_k, task)
@@ -77,7 +83,7 @@ def heun_step(velocity_fn, z, a, task, substeps=1):
         z_pred = z + dt * k1
         
         # Second velocity evaluation at predicted point
-        tau_k_plus_dt = torch.full((batch_size, 1), t_k + dt, device=z.device, dtype=z.dtype)
+        tau_k_plus_dt = torch.full(shape, t_k + dt, device=z.device, dtype=z.dtype)
         k2 = velocity_fn(z_pred, a, tau_k_plus_dt, task)
         
         # Corrector step (trapezoidal rule)
@@ -86,8 +92,231 @@ def heun_step(velocity_fn, z, a, task, substeps=1):
     return z
 
 
+
+def midpoint_step(velocity_fn, z, a, task, substeps=1):
+    """
+    Explicit midpoint method (RK2).
+    
+    For K substeps with dt = 1/K:
+        k1 = v_θ(z_k, a, t_k)
+        k2 = v_θ(z_k + (dt/2) * k1, a, t_k + dt/2)
+        z_{k+1} = z_k + dt * k2
+    
+    Args:
+        velocity_fn: Function that computes v_θ(z, a, τ, task)
+        z: Initial latent state [batch_size, latent_dim]
+        a: Action [batch_size, action_dim]
+        task: Task ID or None
+        substeps: Number of integration substeps (K)
+    
+    Returns:
+        Final latent state after integration
+    """
+    dt = 1.0 / substeps
+    shape = (*z.shape[:-1], 1)
+    
+    for k in range(substeps):
+        t_k = k * dt
+        tau_k = torch.full(shape, t_k, device=z.device, dtype=z.dtype)
+        tau_mid = torch.full(shape, t_k + dt / 2.0, device=z.device, dtype=z.dtype)
+        
+        k1 = velocity_fn(z, a, tau_k, task)
+        k2 = velocity_fn(z + (dt / 2.0) * k1, a, tau_mid, task)
+        z = z + dt * k2
+    
+    return z
+
+
+def rk4_step(velocity_fn, z, a, task, substeps=1):
+    """
+    Classical fourth-order Runge-Kutta method.
+    
+    For K substeps with dt = 1/K:
+        k1 = v_θ(z_k, a, t_k)
+        k2 = v_θ(z_k + (dt/2) * k1, a, t_k + dt/2)
+        k3 = v_θ(z_k + (dt/2) * k2, a, t_k + dt/2)
+        k4 = v_θ(z_k + dt * k3, a, t_k + dt)
+        z_{k+1} = z_k + (dt/6) * (k1 + 2 k2 + 2 k3 + k4)
+    
+    Args:
+        velocity_fn: Function that computes v_θ(z, a, τ, task)
+        z: Initial latent state [batch_size, latent_dim]
+        a: Action [batch_size, action_dim]
+        task: Task ID or None
+        substeps: Number of integration substeps (K)
+    
+    Returns:
+        Final latent state after integration
+    """
+    dt = 1.0 / substeps
+    shape = (*z.shape[:-1], 1)
+    
+    for k in range(substeps):
+        t_k = k * dt
+        tau_k = torch.full(shape, t_k, device=z.device, dtype=z.dtype)
+        tau_mid = torch.full(shape, t_k + dt / 2.0, device=z.device, dtype=z.dtype)
+        tau_end = torch.full(shape, t_k + dt, device=z.device, dtype=z.dtype)
+        
+        k1 = velocity_fn(z, a, tau_k, task)
+        k2 = velocity_fn(z + (dt / 2.0) * k1, a, tau_mid, task)
+        k3 = velocity_fn(z + (dt / 2.0) * k2, a, tau_mid, task)
+        k4 = velocity_fn(z + dt * k3, a, tau_end, task)
+        z = z + (dt / 6.0) * (k1 + 2.0 * k2 + 2.0 * k3 + k4)
+    
+    return z
+
+
+def adaptive_step(velocity_fn, z, a, task, substeps=1, atol=1e-3, rtol=1e-3,
+                  max_nfe=None):
+    """
+    Adaptive Bogacki-Shampine 3(2) method with per-sample error control.
+    
+    Every sample carries its own time t and step size dt. A step is accepted
+    for the samples whose embedded error estimate satisfies
+        rms((z_3 - z_2) / (atol + rtol * max(|z|, |z_3|))) <= 1
+    and dt is rescaled per sample after every attempt. The last stage of an
+    accepted step is reused as the first stage of the next (FSAL), so each
+    attempt costs 3 velocity evaluations. Samples are integrated as one
+    batch until all reach t=1 or the NFE budget is spent; the remaining
+    interval is then covered by a single Euler step. Without `max_nfe` the
+    number of attempts is capped at ADAPTIVE_MAX_ATTEMPTS, and steps with a
+    non-finite error estimate are accepted as they are, so that NaN latents
+    propagate instead of shrinking dt forever.
+    
+    Args:
+        velocity_fn: Function that computes v_θ(z, a, τ, task)
+        z: Initial latent state [batch_size, latent_dim]
+        a: Action [batch_size, action_dim]
+        task: Task ID or None
+        substeps: Initial step size is 1/substeps
+        atol: Absolute error tolerance
+        rtol: Relative error tolerance
+        max_nfe: Maximum number of velocity evaluations (None for
+            ADAPTIVE_MAX_ATTEMPTS attempts)
+    
+    Returns:
+        Tuple of (final latent state, number of velocity evaluations used)
+    """
+    shape = (*z.shape[:-1], 1)
+    t = torch.zeros(shape, device=z.device, dtype=z.dtype)
+    dt = torch.full(shape, 1.0 / substeps, device=z.device, dtype=z.dtype)
+    
+    k1 = velocity_fn(z, a, t, task)
+    nfe = 1
+    if max_nfe is None:
+        max_nfe = 1 + 3 * ADAPTIVE_MAX_ATTEMPTS
+    
+    while nfe + 3 <= max_nfe:
+        active = t < 1.0
+        if not active.any():
+            break
+        dt = torch.where(active, torch.minimum(dt, 1.0 - t), torch.zeros_like(dt))
+        
+        k2 = velocity_fn(z + 0.5 * dt * k1, a, t + 0.5 * dt, task)
+        k3 = velocity_fn(z + 0.75 * dt * k2, a, t + 0.75 * dt, task)
+        z_new = z + dt * (2.0 / 9.0 * k1 + 1.0 / 3.0 * k2 + 4.0 / 9.0 * k3)
+        k4 = velocity_fn(z_new, a, t + dt, task)
+        nfe += 3
+        
+        with torch.no_grad():
+            # difference between the 3rd and embedded 2nd order solutions
+            z_err = dt * (
+                -5.0 / 72.0 * k1 + 1.0 / 12.0 * k2 + 1.0 / 9.0 * k3 - 1.0 / 8.0 * k4
+            )
+            scale = atol + rtol * torch.maximum(z.abs(), z_new.abs())
+            err = (z_err / scale).pow(2).mean(dim=-1, keepdim=True).sqrt()
+            # give up on error control where the estimate is not finite
+            finite = torch.isfinite(err)
+            accept = active & ((err <= 1.0) | ~finite)
+            factor = (0.9 * err.clamp(min=1e-10).pow(-1.0 / 3.0)).clamp(0.2, 5.0)
+            factor = torch.where(finite, factor, torch.ones_like(factor))
+        
+        z = torch.where(accept, z_new, z)
+        k1 = torch.where(accept, k4, k1)
+        t = torch.where(accept, t + dt, t)
+        dt = dt * factor
+    
+    # budget exhausted: close the remaining interval with the cached slope
+    remaining = (1.0 - t).clamp(min=0.0)
+    z = z + remaining * k1
+    
+    return z, nfe
+
+
+# Fixed-step solvers and their velocity evaluations per substep
+FIXED_STEP_SOLVERS = {
+    'euler': (euler_step, 1),
+    'midpoint': (midpoint_step, 2),
+    'heun': (heun_step, 2),
+    'rk4': (rk4_step, 4),
+}
+
+
+def checkpointed(velocity_fn):
+    """
+    Wraps a velocity function with activation checkpointing: only its inputs
+    are kept for backward and the MLP activations are recomputed.
+    """
+    def velocity(z, a, tau, task):
+        return activation_checkpoint(velocity_fn, z, a, tau, task, use_reentrant=False)
+    return velocity
+
+
+def integrate(velocity_fn, z, a, task, method='heun', substeps=1, max_nfe=None,
+              atol=1e-3, rtol=1e-3, return_nfe=False, checkpoint=False):
+    """
+    Integrates the velocity field from τ=0 to τ=1 with the solver `method`.
+    
+    For the fixed-step solvers `max_nfe` caps the number of substeps and
+    must allow at least one substep; for the adaptive solver it caps the
+    number of error-controlled attempts.
+    With `checkpoint`, every velocity evaluation of every substep is
+    recomputed during backward instead of storing its activations.
+    
+    Args:
+        velocity_fn: Function that computes v_θ(z, a, τ, task)
+        z: Initial latent state [batch_size, latent_dim]
+        a: Action [batch_size, action_dim]
+        task: Task ID or None
+        method: 'euler', 'midpoint', 'heun', 'rk4' or 'adaptive'
+        substeps: Number of substeps (initial step size 1/substeps if adaptive)
+        max_nfe: Maximum number of velocity evaluations (None for no cap)
+        atol: Absolute error tolerance of the adaptive solver
+        rtol: Relative error tolerance of the adaptive solver
+        return_nfe: Also return the number of velocity evaluations used
+        checkpoint: Checkpoint the velocity evaluations (needs grad enabled)
+    
+    Returns:
+        Final latent state, and the NFE used if `return_nfe`
+    """
+    if checkpoint and torch.is_grad_enabled():
+        velocity_fn = checkpointed(velocity_fn)
+    
+    if method == 'adaptive':
+        z, nfe = adaptive_step(
+            velocity_fn, z, a, task, substeps, atol=atol, rtol=rtol, max_nfe=max_nfe
+        )
+    elif method in FIXED_STEP_SOLVERS:
+        solver, stages = FIXED_STEP_SOLVERS[method]
+        if max_nfe is not None:
+            if max_nfe < stages:
+                raise ValueError(
+                    f"max_nfe={max_nfe} is below the {stages} velocity evaluations "
+                    f"of a single {method} substep, use a solver with fewer stages"
+                )
+            substeps = min(substeps, max_nfe // stages)
+        z = solver(velocity_fn, z, a, task, substeps)
+        nfe = stages * substeps
+    else:
+        raise ValueError(f"Unknown integrator: {method}")
+    
+    if return_nfe:
+        return z, nfe
+    return z
+
 def compute_flow_matching_loss(velocity_fn, z_start, z_target, a, task, 
-                                 tau_sampling='uniform', gamma_t=1.0):
+                                 tau_sampling='uniform', gamma_t=1.0,
+                                 reduction='mean'):
     """
     Computes the flow-matching loss for a single transition.
     
@@ -105,6 +334,7 @@ def compute_flow_matching_loss(velocity_fn, z_start, z_target, a, task,
         task: Task ID or None
         tau_sampling: 'uniform' or 'midpoint'
         gamma_t: Discount factor for this timestep
+        reduction: 'mean' or 'none' for per-sample losses [batch_size]
     
     Returns:
         Flow-matching loss (scalar)
@@ -130,6 +360,57 @@ def compute_flow_matching_loss(velocity_fn, z_start, z_target, a, task,
     v_pred = velocity_fn(z_tau, a, tau, task)
     
     # MSE loss
-    loss = ((v_pred - v_target) ** 2).mean() * gamma_t
+    loss = ((v_pred - v_target) ** 2).mean(dim=-1) * gamma_t
+    if reduction == 'mean':
+        loss = loss.mean()
+    
+    return loss
+
+
+def compute_parallel_flow_matching_loss(velocity_fn, z_start, z_target, a, task,
+                                        tau_sampling='uniform', discount=None,
+                                        reduction='mean'):
+    """
+    Teacher-forced flow-matching loss over a whole horizon in one call.
+    
+    Every transition t starts from its own (encoder) latent, so all (t, batch)
+    pairs are independent and the velocity field is evaluated once on the
+    [H, batch_size] batch instead of once per step.
+    
+    Args:
+        velocity_fn: Function that computes v_θ(z, a, τ, task)
+        z_start: Starting latent states [horizon, batch_size, latent_dim]
+        z_target: Target latent states [horizon, batch_size, latent_dim]
+        a: Actions [horizon, batch_size, action_dim]
+        task: Task ID or None
+        tau_sampling: 'uniform' or 'midpoint'
+        discount: Per-timestep discount factors [horizon] or None
+        reduction: 'mean' or 'none' to keep the batch dimension [batch_size]
+    
+    Returns:
+        Sum over t of the discounted per-step flow-matching losses (scalar),
+        matching a sequence of `compute_flow_matching_loss` calls
+    """
+    shape = (*z_start.shape[:-1], 1)
+    
+    # Sample one τ per (t, batch) pair
+    if tau_sampling == 'uniform':
+        tau = torch.rand(shape, device=z_start.device, dtype=z_start.dtype)
+    elif tau_sampling == 'midpoint':
+        tau = torch.full(shape, 0.5, device=z_start.device, dtype=z_start.dtype)
+    else:
+        raise ValueError(f"Unknown tau_sampling: {tau_sampling}")
+    
+    z_tau = (1.0 - tau) * z_start + tau * z_target
+    v_target = z_target - z_start
+    v_pred = velocity_fn(z_tau, a, tau, task)
+    
+    # Per-sample MSE [horizon, batch_size], led by the members of an ensemble
+    loss = ((v_pred - v_target) ** 2).mean(dim=-1)
+    if discount is not None:
+        loss = loss * discount[:, None]
+    loss = loss.sum(dim=-2)
+    if reduction == 'mean':
+        loss = loss.mean()
     
     return loss
@@ -0,0 +1,165 @@
+"""
+Cache of encoder latents of replay buffer slots.
+
+The world model targets are encodings of replayed observations under
+`no_grad`, and the same slots are re-encoded on every WM iteration they are
+sampled in. `LatentCache` keeps the latent of every slot together with the
+episode id the slot held and the encoder version it was computed with.
+Lookups and bookkeeping run on the host, so serving a batch from the cache
+adds no device synchronization; only the missing latents are encoded.
+"""
+
+import torch
+
+
+class LatentCache:
+    """
+    Latents of replay buffer slots, tagged with an encoder version.
+
+    A cached latent is served while it is at most `max_age` encoder updates
+    old and the relative drift of the tracked tensors since the cache was
+    last cleared stays below `max_drift`; once the drift exceeds it the
+    whole cache is cleared. With `frozen`, the encoder never changes and
+    cached latents never go stale.
+
+    Args:
+        capacity: Number of buffer slots
+        latent_dim: Latent dimension
+        device: Device the latents are kept on
+        max_age: Encoder updates a latent is served for, None for no limit
+        max_drift: Relative parameter drift that clears the cache, None to not track it
+        drift_check_interval: Encoder updates between drift measurements
+        frozen: The encoder is frozen, latents stay valid until overwritten
+    """
+
+    def __init__(
+        self,
+        capacity,
+        latent_dim,
+        device,
+        max_age=None,
+        max_drift=None,
+        drift_check_interval=10,
+        frozen=False,
+    ):
+        self.capacity = capacity
+        self.device = device
+        self.max_age = None if frozen else max_age
+        self.max_drift = None if frozen else max_drift
+        self.drift_check_interval = drift_check_interval
+        self.frozen = frozen
+        self._latents = torch.zeros(capacity, latent_dim, device=device)
+        # episode id the slot held when encoded, -1 if not cached
+        self._episode = torch.full((capacity,), -1, dtype=torch.long)
+        self._version = torch.zeros(capacity, dtype=torch.long)
+        self.version = 0
+        self._tensors_fn = None
+        self._reference = None
+        self.hits = self.lookups = 0
+        self.filled = False
+
+    def track(self, tensors_fn):
+        """
+        Measure drift on the tensors returned by `tensors_fn`, e.g. the encoder
+        parameters and the observation normalization statistics.
+        """
+        self._tensors_fn = tensors_fn
+        self._snapshot()
+
+    @torch.no_grad()
+    def _snapshot(self):
+        if self._tensors_fn is not None:
+            self._reference = [t.detach().clone() for t in self._tensors_fn()]
+
+    @torch.no_grad()
+    def drift(self):
+        """Relative change of the tracked tensors since the last snapshot."""
+        tensors = [t.detach() for t in self._tensors_fn()]
+        diff = torch._foreach_sub(tensors, self._reference)
+        diff_norm = torch.stack(torch._foreach_norm(diff)).square().sum().sqrt()
+        ref_norm = torch.stack(torch._foreach_norm(self._reference)).square().sum().sqrt()
+        return (diff_norm / (ref_norm + 1e-8)).item()
+
+    def clear(self):
+        """Invalidate all cached latents."""
+        self._episode.fill_(-1)
+        self._snapshot()
+
+    def step(self):
+        """Record an encoder update."""
+        if self.frozen:
+            return
+        self.version += 1
+        if (
+            self.max_drift is not None
+            and self._reference is not None
+            and self.version % self.drift_check_interval == 0
+            and self.drift() > self.max_drift
+        ):
+            self.clear()
+
+    def _valid(self, slots, episodes):
+        valid = self._episode[slots] == episodes
+        if self.max_age is not None:
+            valid &= self._version[slots] >= self.version - self.max_age
+        return valid
+
+    def store(self, slots, episodes, latents):
+        """Cache `latents` [N, latent] of the slots `slots` holding `episodes`."""
+        self._latents[slots.to(self.device)] = latents.detach().to(self._latents.dtype)
+        self._episode[slots] = episodes
+        self._version[slots] = self.version
+
+    @torch.no_grad()
+    def encode(self, slots, episodes, obs, encode_fn):
+        """
+        Latents of the observations `obs` [..., obs_dim] stored at the buffer
+        `slots` [...] of the episodes `episodes` [...]. Cached latents are
+        served, the others are computed with `encode_fn` and cached.
+        """
+        shape = slots.shape
+        slots, episodes = slots.cpu().reshape(-1), episodes.cpu().reshape(-1)
+        valid = self._valid(slots, episodes)
+        hit = valid.nonzero().squeeze(-1)
+        miss = (~valid).nonzero().squeeze(-1)
+        self.hits += len(hit)
+        self.lookups += len(slots)
+
+        z = torch.empty(len(slots), self._latents.shape[1], device=obs.device)
+        if len(hit) > 0:
+            z[hit.to(obs.device)] = self._latents[slots[hit].to(self.device)].to(obs.device)
+        if len(miss) > 0:
+            obs_miss = obs.reshape(len(slots), -1)[miss.to(obs.device)]
+            z_miss = encode_fn(obs_miss)
+            z[miss.to(obs.device)] = z_miss
+            # a slot can appear several times in one batch, store it once
+            slots_miss, first = _unique_first(slots[miss])
+            self.store(slots_miss, episodes[miss][first], z_miss[first.to(obs.device)])
+        return z.view(*shape, -1)
+
+    @torch.no_grad()
+    def fill(self, slots, episodes, obs_fn, encode_fn, chunk_size=65536):
+        """
+        Encode and cache the slots `slots` holding `episodes` in chunks, e.g. the
+        whole buffer for a frozen encoder. `obs_fn` returns the observations
+        of a chunk of slots.
+        """
+        for i in range(0, len(slots), chunk_size):
+            s = slots[i : i + chunk_size]
+            self.store(s, episodes[i : i + chunk_size], encode_fn(obs_fn(s)))
+        self.filled = True
+
+    def hit_rate(self, reset=True):
+        """Fraction of lookups served from the cache since the last reset."""
+        rate = self.hits / max(self.lookups, 1)
+        if reset:
+            self.hits = self.lookups = 0
+        return rate
+
+
+def _unique_first(x):
+    """Unique values of `x` and the position of their first occurrence."""
+    values, inverse = torch.unique(x, return_inverse=True)
+    first = torch.full((len(values),), len(x), dtype=torch.long)
+    first.scatter_reduce_(0, inverse, torch.arange(len(x)), reduce="amin")
+    return values, first
@@ -0,0 +1,149 @@
+"""
+Reader for offline datasets converted by scripts/convert_tdmpc2_dataset.py.
+
+A converted dataset is a directory with one `.npy` array per field of shape
+[episodes, steps, ...], with the episodes grouped by task, and a `meta.json`
+holding the episode range and the observation/reward moments of every task.
+The arrays are opened memory-mapped, so opening a task costs no reads and
+concurrent jobs share the page cache of the same files.
+"""
+
+import json
+import os
+
+import numpy as np
+import torch
+from tensordict.tensordict import TensorDict
+
+META_FILE = "meta.json"
+
+
+class OfflineDataset:
+    """
+    Task-indexed episodes of a converted dataset.
+
+    Args:
+        root: Directory written by scripts/convert_tdmpc2_dataset.py
+    """
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.episode_length = self.meta["episode_length"]
+        self.fields = {
+            key: np.load(os.path.join(root, f"{key}.npy"), mmap_mode="r")
+            for key in self.meta["fields"]
+        }
+        self.tasks = {int(k): v for k, v in self.meta["tasks"].items()}
+
+    @staticmethod
+    def is_converted(path):
+        """Whether `path` is a directory written by the converter."""
+        return os.path.isfile(os.path.join(path, META_FILE))
+
+    def __len__(self):
+        return self.meta["num_episodes"]
+
+    def episode_range(self, task_id=None):
+        """(start, end) of the episodes of `task_id`, or of all episodes."""
+        if task_id is None:
+            return 0, len(self)
+        if task_id not in self.tasks:
+            return 0, 0
+        return tuple(self.tasks[task_id]["episodes"])
+
+    def moments(self, task_id=None):
+        """
+        Per-feature (mean, var, count) of the observations and rewards of
+        `task_id`, or of the whole dataset, as computed during conversion.
+        """
+        tasks = list(self.tasks) if task_id is None else [task_id]
+        moments = {}
+        for key in ["obs", "reward"]:
+            stats = [self.tasks[t][key] for t in tasks if t in self.tasks]
+            count = sum(s["count"] for s in stats)
+            if count == 0:
+                moments[key] = None
+                continue
+            mean = sum(np.asarray(s["mean"]) * s["count"] for s in stats) / count
+            # combine per-task variances with the spread of their means
+            sq = sum(
+                (np.asarray(s["var"]) + np.asarray(s["mean"]) ** 2) * s["count"]
+                for s in stats
+            )
+            var = np.maximum(sq / count - mean**2, 0.0)
+            moments[key] = (
+                torch.as_tensor(mean, dtype=torch.float32).reshape(-1),
+                torch.as_tensor(var, dtype=torch.float32).reshape(-1),
+                count,
+            )
+        return moments
+
+    def update_rms(self, task_id=None, obs_rms=None, rew_rms=None):
+        """Fold the stored moments of `task_id` into running mean/std trackers."""
+        moments = self.moments(task_id)
+        for rms, key in [(obs_rms, "obs"), (rew_rms, "reward")]:
+            if rms is None or moments[key] is None:
+                continue
+            mean, var, count = moments[key]
+            device = rms.mean.device
+            rms.update_from_moments(mean.to(device), var.to(device), count)
+
+    def select(self, task_id=None, max_episodes=None, shard=None, generator=None):
+        """
+        Indices of the episodes to load: those of `task_id`, every
+        world_size-th one for a (rank, world_size) `shard`, and a sorted
+        uniform random subset if there are more than `max_episodes`.
+        """
+        start, end = self.episode_range(task_id)
+        idx = torch.arange(start, end)
+        if shard is not None:
+            rank, world_size = shard
+            idx = idx[rank::world_size]
+        if max_episodes is not None and len(idx) > max_episodes:
+            keep = torch.randperm(len(idx), generator=generator)[:max_episodes]
+            idx = idx[keep.sort().values]
+        return idx
+
+    def chunks(self, idx, chunk_size=256):
+        """Yield TensorDicts of at most `chunk_size` of the episodes `idx`."""
+        for i in range(0, len(idx), chunk_size):
+            part = idx[i : i + chunk_size].numpy()
+            if len(part) == 0:
+                continue
+            # contiguous index ranges are read as slices, everything else gathered
+            lo, hi = int(part[0]), int(part[-1]) + 1
+            contiguous = hi - lo == len(part)
+            data = {
+                key: torch.from_numpy(
+                    np.ascontiguousarray(arr[lo:hi] if contiguous else arr[part])
+                )
+                for key, arr in self.fields.items()
+            }
+            yield TensorDict(data, batch_size=(len(part), self.episode_length))
+
+
+def load_into_buffer(
+    buffer,
+    dataset,
+    task_id=None,
+    chunk_size=256,
+    obs_rms=None,
+    rew_rms=None,
+    reservoir=False,
+    shard=None,
+    generator=None,
+):
+    """
+    Add the episodes of `task_id` from a converted `dataset` to `buffer`.
+    The normalization statistics are updated from the stored moments of the
+    task. With `reservoir`, a uniform random subset of episodes that fits the
+    buffer is loaded. Returns the number of added episodes.
+    """
+    dataset.update_rms(task_id, obs_rms, rew_rms)
+    max_eps = buffer.capacity // dataset.episode_length if reservoir else None
+    idx = dataset.select(task_id, max_eps, shard, generator)
+    for td in dataset.chunks(idx, chunk_size):
+        buffer.add_batch(td)
+    return len(idx)
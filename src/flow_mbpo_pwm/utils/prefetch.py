@@ -0,0 +1,99 @@
+"""
+Background preparation of training batches.
+
+`BatchPrefetcher` runs a batch-producing function in a worker thread, on its
+own CUDA stream when the batches live on a GPU, and keeps up to `depth`
+prepared batches queued. Sampling and host-to-device copies of the next
+batches thereby overlap with the gradient step on the current one. State that
+the consumer reads on its own stream, e.g. normalization statistics, should be
+updated on the consumer side rather than in `prepare_fn`.
+"""
+
+import queue
+import threading
+
+import torch
+
+
+class BatchPrefetcher:
+    """
+    Prepares batches with `prepare_fn` ahead of their use.
+
+    `prepare_fn` is always called under `lock`; hold it as well when touching
+    state the function reads, e.g. when updating replay priorities.
+
+    Args:
+        prepare_fn: Callable without arguments returning a tuple of tensors
+        depth: Number of batches prepared ahead, 0 prepares them inline
+        device: Device of the prepared batches
+    """
+
+    def __init__(self, prepare_fn, depth=2, device="cuda"):
+        self.prepare_fn = prepare_fn
+        self.depth = depth
+        self.device = torch.device(device)
+        self.lock = threading.Lock()
+        self.stream = None
+        if depth > 0 and self.device.type == "cuda":
+            self.stream = torch.cuda.Stream(device=self.device)
+
+    def _prepare(self):
+        with self.lock, torch.no_grad():
+            return self.prepare_fn()
+
+    def _produce(self, num_batches, out, stop):
+        try:
+            for _ in range(num_batches):
+                if stop.is_set():
+                    return
+                event = None
+                if self.stream is not None:
+                    with torch.cuda.stream(self.stream):
+                        batch = self._prepare()
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                else:
+                    batch = self._prepare()
+                out.put((batch, event))
+        except BaseException as e:
+            out.put((e, None))
+
+    def batches(self, num_batches):
+        """Yield `num_batches` prepared batches in order."""
+        if self.depth == 0:
+            for _ in range(num_batches):
+                yield self._prepare()
+            return
+
+        if self.stream is not None:
+            # the worker must not run ahead of work already queued on the
+            # consumer's stream, e.g. writes to the replay buffer
+            self.stream.wait_stream(torch.cuda.current_stream(self.device))
+        out = queue.Queue(self.depth)
+        stop = threading.Event()
+        worker = threading.Thread(
+            target=self._produce, args=(num_batches, out, stop), daemon=True
+        )
+        worker.start()
+        try:
+            for _ in range(num_batches):
+                batch, event = out.get()
+                if isinstance(batch, BaseException):
+                    raise batch
+                if event is not None:
+                    # order the consumer after the copies and keep the memory
+                    # of the batch alive until the consumer is done with it
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(event)
+                    for x in batch:
+                        if torch.is_tensor(x) and x.is_cuda:
+                            x.record_stream(stream)
+                yield batch
+        finally:
+            stop.set()
+            while worker.is_alive():
+                try:
+                    out.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            worker.join()
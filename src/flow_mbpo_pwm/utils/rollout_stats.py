@@ -0,0 +1,99 @@
+"""
+On-device bookkeeping for the sync-free rollout mode.
+
+Sanity checks, counters and per-episode statistics are accumulated as masked
+tensor ops during the rollout and only copied to the host once per epoch by
+`RolloutStats.flush`, so the rollout never stalls on a host-device sync.
+"""
+
+import torch
+
+from flow_mbpo_pwm.utils.common import print_warning
+
+
+def sanitize_obs_(x, limit=1e6):
+    """
+    Zero out (in-place) rows of `x` that are non-finite or larger than `limit`
+    without a host sync. Returns the mask of zeroed rows.
+    """
+    bad = ~(x.abs() <= limit).all(dim=-1)
+    x.masked_fill_(bad.unsqueeze(-1), 0.0)
+    return bad
+
+
+class RolloutStats:
+    """
+    Accumulates violation counts and masked episode statistics on device.
+
+    Args:
+        device: Device of the accumulators
+        fatal: Names of violations that abort training when reported
+        context: Where the violations happened, used in the reports
+    """
+
+    def __init__(self, device, fatal=("next_value_error",), context="rollout"):
+        self.device = device
+        self.fatal = set(fatal)
+        self.context = context
+        self.reset()
+
+    def reset(self):
+        self._violations = {}
+        self._sums = {}
+        self._counts = {}
+
+    def count(self, name, mask):
+        """Count the entries of `mask` that are set as violations of `name`."""
+        total = mask.sum()
+        self._violations[name] = self._violations.get(name, 0) + total
+
+    def sanitize_(self, name, x):
+        """Zero out (in-place) rows of `x` that are non-finite or larger than 1e6."""
+        self.count(name, sanitize_obs_(x))
+        return x
+
+    def add(self, name, values, mask=None):
+        """Accumulate the entries of `values` selected by `mask` (default: all) under `name`."""
+        if mask is None:
+            mask = torch.ones_like(values, dtype=torch.bool)
+        mask = mask.to(values.dtype) if values.is_floating_point() else mask.float()
+        self._sums[name] = self._sums.get(name, 0) + (values * mask).sum()
+        self._counts[name] = self._counts.get(name, 0) + mask.sum()
+
+    @torch.no_grad()
+    def flush(self, meters=None):
+        """
+        Copy everything to the host with a single sync, update the AverageMeters
+        in `meters` (keyed like `add`) with the episode statistics and report
+        the violations. Returns the violation counts and the means of the
+        statistics accumulated with `add`.
+        """
+        groups = dict(violations=self._violations, sums=self._sums, counts=self._counts)
+        flat = [(g, k, v) for g, d in groups.items() for k, v in d.items()]
+        self.reset()
+        if len(flat) == 0:
+            return {}, {}
+        host = torch.stack(
+            [torch.as_tensor(v, dtype=torch.float32, device=self.device) for *_, v in flat]
+        ).tolist()
+        out = {g: {} for g in groups}
+        for (g, k, _), v in zip(flat, host):
+            out[g][k] = v
+        violations, sums, counts = out["violations"], out["sums"], out["counts"]
+
+        means = {}
+        for name, total in sums.items():
+            if counts[name] > 0:
+                means[name] = total / counts[name]
+            if meters is not None and name in meters and counts[name] > 0:
+                meters[name].update_moments(means[name], int(counts[name]))
+
+        for name, n in violations.items():
+            if n == 0:
+                continue
+            message = f"{name}: {int(n)} violations during {self.context}"
+            if name in self.fatal:
+                raise RuntimeError(message)
+            else:
+                print_warning(message)
+        return violations, means
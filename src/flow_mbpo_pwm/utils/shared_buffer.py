@@ -0,0 +1,206 @@
+"""
+Replay buffer in shared memory, usable from several local processes.
+
+All storage is preallocated with `share_memory_()`, so collector processes
+can `add` episodes and learner processes can `sample` slices of the same
+buffer without copies or pickling of the data. Writers reserve a contiguous
+range of slots through an atomic cursor and write without holding a lock.
+"""
+
+import torch
+import torch.multiprocessing as mp
+from tensordict.tensordict import TensorDict
+
+
+class SharedBuffer:
+    """
+    Ring buffer of transitions in shared CPU memory with the interface of
+    `Buffer`. Pass it to child processes (e.g. as a `Process` argument) to
+    share it.
+
+    Every slot stores the id of the episode it belongs to. A writer first
+    invalidates the slots it reserved (id -1), then writes the data and the
+    episode ids last. Samplers only accept windows whose first and last slot
+    carry the same valid episode id both before and after gathering, which
+    rejects windows that cross episodes or are being overwritten.
+
+    Args:
+        buffer_size: Capacity in transitions
+        batch_size: Number of sampled subsequences
+        horizon: Length of a subsequence is horizon + 1
+        device: Device the sampled batches are moved to
+        obs_dim: Observation dimension
+        act_dim: Action dimension
+        terminate: Also return termination flags when sampling
+    """
+
+    def __init__(
+        self,
+        buffer_size,
+        batch_size,
+        horizon,
+        device,
+        obs_dim,
+        act_dim,
+        terminate=False,
+    ):
+        self._device = device
+        self._capacity = buffer_size
+        self._horizon = horizon
+        self._num_slices = batch_size
+        self.terminate = terminate
+        self._data = TensorDict(
+            dict(
+                obs=torch.zeros(buffer_size, obs_dim),
+                action=torch.zeros(buffer_size, act_dim),
+                reward=torch.zeros(buffer_size),
+                term=torch.zeros(buffer_size, dtype=torch.bool),
+            ),
+            (buffer_size,),
+        ).share_memory_()
+        self._episode = torch.full((buffer_size,), -1, dtype=torch.long).share_memory_()
+        ctx = mp.get_context("spawn")
+        # total number of transitions and episodes ever written
+        self._cursor = ctx.Value("q", 0)
+        self._eps_written = ctx.Value("q", 0, lock=False)
+
+    @property
+    def capacity(self):
+        """Return the capacity of the buffer."""
+        return self._capacity
+
+    @property
+    def num_eps(self):
+        """Return the number of episodes added to the buffer."""
+        return self._eps_written.value
+
+    def __len__(self):
+        return min(self._cursor.value, self._capacity)
+
+    def _reserve(self, num_steps, num_eps):
+        """Atomically reserve slots and episode ids. Returns their first index."""
+        assert num_steps <= self._capacity, "episodes do not fit into the buffer"
+        with self._cursor.get_lock():
+            start, first_ep = self._cursor.value, self._eps_written.value
+            self._cursor.value += num_steps
+            self._eps_written.value += num_eps
+        return start, first_ep
+
+    @torch.no_grad()
+    def add_episodes(self, td, episode):
+        """
+        Add several episodes stored back to back in a flat TensorDict.
+        `episode` holds the local index (0, 1, ...) of the episode of every step.
+        """
+        num_steps, num_eps = td.shape[0], int(episode[-1]) + 1
+        start, first_ep = self._reserve(num_steps, num_eps)
+        idx = (start + torch.arange(num_steps)) % self._capacity
+
+        self._episode[idx] = -1
+        for key in self._data.keys():
+            self._data[key][idx] = td[key].to("cpu", self._data[key].dtype)
+        self._episode[idx] = episode.cpu().long() + first_ep
+        return self.num_eps
+
+    def add(self, td):
+        """Add an episode to the buffer."""
+        episode = torch.zeros(td.shape[0], dtype=torch.long)
+        return self.add_episodes(td, episode)
+
+    def add_batch(self, td):
+        """Add a batch of episodes to the buffer."""
+        num_eps, ep_len = td["reward"].shape[:2]
+        eps_that_fit = min(num_eps, self._capacity // ep_len)
+        print(f"Can fit {eps_that_fit} episodes into buffer")
+        td = td[torch.randperm(num_eps)[:eps_that_fit]]
+        episode = torch.arange(eps_that_fit).repeat_interleave(ep_len)
+        return self.add_episodes(td.flatten(), episode)
+
+    def _valid_windows(self, num, length=None):
+        """
+        Sample `num` start slots of windows of `length` steps (default: the
+        horizon + 1) inside a single episode.
+        """
+        size = len(self)
+        if size == 0:
+            raise RuntimeError("Sampling from an empty SharedBuffer")
+        offsets = torch.arange(self._horizon + 1 if length is None else length)
+        starts = []
+        found = 0
+        for _ in range(100):
+            cand = torch.randint(0, size, (2 * num,))
+            ep = self._episode[(cand[:, None] + offsets) % self._capacity]
+            ok = (ep[:, 0] >= 0) & (ep[:, 0] == ep[:, -1])
+            starts.append(cand[ok])
+            found += int(ok.sum())
+            if found >= num:
+                break
+        else:
+            raise RuntimeError("No valid windows in SharedBuffer")
+        return torch.cat(starts)[:num]
+
+    def _gather(self, starts):
+        offsets = torch.arange(self._horizon + 1)
+        idx = (starts[None, :] + offsets[:, None]) % self._capacity  # [H+1, B]
+        ids = self._episode[idx]
+        td = self._data[idx]
+        # reject windows that were (partly) overwritten while gathering
+        ids_after = self._episode[idx]
+        ok = (ids == ids[:1]).all(0) & (ids_after == ids).all(0) & (ids[0] >= 0)
+        return td, ok
+
+    def sample(self):
+        """Sample a batch of subsequences from the buffer."""
+        td, ok = self._gather(self._valid_windows(self._num_slices))
+        while not ok.all():
+            bad = (~ok).nonzero().squeeze(-1)
+            redo, redo_ok = self._gather(self._valid_windows(bad.numel()))
+            td[:, bad] = redo
+            ok[bad] = redo_ok
+        return self._prepare_batch(td)
+
+    def sample_obs(self, num_obs):
+        """Sample `num_obs` observations uniformly from all valid stored steps."""
+        idx = self._valid_windows(num_obs, length=1)
+        while True:
+            ids = self._episode[idx]
+            obs = self._data["obs"][idx]
+            # reject slots that were invalidated or overwritten while gathering
+            bad = ((ids < 0) | (self._episode[idx] != ids)).nonzero().squeeze(-1)
+            if bad.numel() == 0:
+                return obs.to(self._device, non_blocking=True)
+            idx[bad] = self._valid_windows(bad.numel(), length=1)
+
+    def _prepare_batch(self, td):
+        """
+        Prepare a sampled batch for training (post-processing).
+        Expects `td` to be a TensorDict with batch size TxB.
+        """
+        td = td.to(self._device, non_blocking=True)
+        obs = td["obs"]
+        action = td["action"][1:]
+        reward = td["reward"][1:].unsqueeze(-1)
+        if self.terminate:
+            term = td["term"][1:].unsqueeze(-1).float()
+            return obs, action, reward, term
+        return obs, action, reward
+
+    def save(self, filepath):
+        torch.save(
+            dict(
+                data=self._data.to_dict(),
+                episode=self._episode,
+                cursor=self._cursor.value,
+                num_eps=self.num_eps,
+            ),
+            filepath,
+        )
+
+    def load(self, filepath):
+        snapshot = torch.load(filepath)
+        for key, value in snapshot["data"].items():
+            self._data[key].copy_(value)
+        self._episode.copy_(snapshot["episode"])
+        with self._cursor.get_lock():
+            self._cursor.value = snapshot["cursor"]
+            self._eps_written.value = snapshot["num_eps"]
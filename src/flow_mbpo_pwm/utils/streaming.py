@@ -0,0 +1,182 @@
+"""
+Chunked ingestion of offline episode datasets into a replay buffer.
+
+TD-MPC2 style dataset files hold a TensorDict of [episodes, steps]. Instead of
+loading a whole file and filtering or subsampling it afterwards, `EpisodeStream`
+memory-maps the file and materializes `chunk_size` episodes at a time, so peak
+RAM stays at one chunk on top of the buffer. `stream_into_buffer` updates the
+normalization statistics and fills the buffer chunk by chunk, with a uniform
+random subset of episodes when the data exceeds the buffer.
+"""
+
+import torch
+
+from flow_mbpo_pwm.utils.common import print_info, print_warning
+
+
+def load_dataset_file(path):
+    """Load `path` with memory-mapped storages where the file format allows it."""
+    try:
+        return torch.load(path, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        # older torch or legacy (non-zip) files cannot be mapped
+        print_warning(f"Cannot memory-map {path}, loading it into RAM")
+        return torch.load(path, map_location="cpu")
+
+
+class EpisodeStream:
+    """
+    Iterates over the episodes of several dataset files in chunks.
+
+    Args:
+        paths: Dataset files, each a TensorDict of shape [episodes, steps]
+        chunk_size: Number of episodes materialized at a time
+        task_id: Only keep episodes of this task (needs a "task" field)
+        episode_length: Expected number of steps per episode, checked if given
+        shard: (rank, world_size) to only keep every world_size-th episode
+    """
+
+    def __init__(
+        self, paths, chunk_size=256, task_id=None, episode_length=None, shard=None
+    ):
+        if isinstance(paths, (str, bytes)) or not hasattr(paths, "__iter__"):
+            paths = [paths]
+        self.paths = list(paths)
+        self.chunk_size = chunk_size
+        self.task_id = task_id
+        self.episode_length = episode_length
+        self.shard = shard
+
+    def unsharded(self):
+        """The same stream over the episodes of all shards."""
+        return EpisodeStream(
+            self.paths, self.chunk_size, self.task_id, self.episode_length
+        )
+
+    def _episodes(self, path, td, offset):
+        """Indices of the episodes of `td` to keep. `offset` counts earlier episodes."""
+        if self.episode_length is not None:
+            assert td.shape[1] == self.episode_length, (
+                f"Expected episode length {td.shape[1]} in {path} to match config "
+                f"episode length {self.episode_length}, please double-check your config."
+            )
+        keep = torch.ones(td.shape[0], dtype=torch.bool)
+        if self.task_id is not None:
+            # only the task ids are read here, chunk by chunk
+            for i in range(0, td.shape[0], self.chunk_size):
+                task = td["task"][i : i + self.chunk_size]
+                keep[i : i + self.chunk_size] = torch.all(task == self.task_id, dim=1)
+        idx = keep.nonzero().squeeze(-1)
+        if self.shard is not None:
+            rank, world_size = self.shard
+            idx = idx[(idx + offset) % world_size == rank]
+        return idx
+
+    def index(self):
+        """List of (path, episode indices to keep) without reading the episode data."""
+        index, offset = [], 0
+        for path in self.paths:
+            td = load_dataset_file(path)
+            index.append((path, self._episodes(path, td, offset)))
+            offset += td.shape[0]
+            del td
+        return index
+
+    def chunks(self, index=None):
+        """
+        Yield materialized TensorDicts of at most `chunk_size` episodes. Pass a
+        (possibly subsampled) `index` to only read those episodes.
+        """
+        for path, idx in index if index is not None else self.index():
+            if len(idx) == 0:
+                continue
+            print_info(f"Streaming {len(idx)} episodes from {path}")
+            td = load_dataset_file(path)
+            for i in range(0, len(idx), self.chunk_size):
+                yield td[idx[i : i + self.chunk_size]].clone()
+            del td
+
+
+def reservoir_index(index, num_eps, generator=None):
+    """
+    Uniform random subset of `num_eps` episodes of an `EpisodeStream.index`.
+
+    Reservoir sampling with random keys: every episode gets a uniform key and
+    the `num_eps` smallest keys seen so far are kept, file by file, so only the
+    reservoir and the keys of one file are held at a time. The episodes keep
+    their order within every file.
+    """
+    keys = torch.empty(0)
+    owners = torch.empty(0, dtype=torch.long)  # file of every kept episode
+    episodes = torch.empty(0, dtype=torch.long)
+    for f, (_, idx) in enumerate(index):
+        keys = torch.cat([keys, torch.rand(len(idx), generator=generator)])
+        owners = torch.cat([owners, torch.full((len(idx),), f, dtype=torch.long)])
+        episodes = torch.cat([episodes, idx])
+        if len(keys) > num_eps:
+            kept = keys.topk(num_eps, largest=False).indices
+            keys, owners, episodes = keys[kept], owners[kept], episodes[kept]
+    return [
+        (path, episodes[owners == f].sort().values) for f, (path, _) in enumerate(index)
+    ]
+
+
+def _update_stats(td, obs_rms=None, rew_rms=None):
+    """Update the observation and reward statistics with the episodes `td`."""
+    if obs_rms is not None:
+        obs = td["obs"].reshape((-1, obs_rms.mean.shape[-1]))
+        obs_rms.update(torch.nan_to_num(obs).to(obs_rms.mean.device))
+    if rew_rms is not None:
+        rew = td["reward"].reshape((-1, 1))
+        rew_rms.update(torch.nan_to_num(rew).to(rew_rms.mean.device))
+
+
+@torch.no_grad()
+def stream_into_buffer(
+    buffer, stream, obs_rms=None, rew_rms=None, reservoir=False, generator=None
+):
+    """
+    Add the episodes of `stream` to `buffer` chunk by chunk and update the
+    observation and reward statistics.
+
+    The statistics always cover all episodes of the stream, including those
+    of other shards and those not selected for the buffer, as if every file
+    were loaded whole. Ranks with different shards therefore normalize
+    alike. Episodes are selected before any episode data is read:
+    without `reservoir`, every file larger than the buffer contributes a
+    uniform random subset that fits, like `Buffer.add_batch` on whole files,
+    and later files overwrite the oldest episodes. With `reservoir`, a
+    uniform random subset of all episodes that fits the buffer is selected.
+    Returns the number of added episodes.
+    """
+    index = stream.index()
+    selected, subsampled = index, False
+    total = sum(len(idx) for _, idx in index)
+    if total > 0:
+        ep_len = load_dataset_file(index[0][0]).shape[1]
+        fit = buffer.capacity // ep_len
+        if reservoir and total > fit:
+            print_info(f"Selecting {fit} of {total} episodes by reservoir sampling")
+            selected, subsampled = reservoir_index(index, fit, generator), True
+        elif not reservoir and any(len(idx) > fit for _, idx in index):
+            selected, subsampled = [], True
+            for path, idx in index:
+                if len(idx) > fit:
+                    keep = torch.randperm(len(idx), generator=generator)[:fit]
+                    idx = idx[keep.sort().values]
+                selected.append((path, idx))
+
+    # statistics on the fly if all episodes of the stream are added
+    fused = not subsampled and stream.shard is None
+    if not fused and (obs_rms is not None or rew_rms is not None):
+        full = index if stream.shard is None else stream.unsharded().index()
+        for td in stream.chunks(full):
+            _update_stats(td, obs_rms, rew_rms)
+
+    added = 0
+    for td in stream.chunks(selected):
+        if fused:
+            _update_stats(td, obs_rms, rew_rms)
+        buffer.add_batch(td)
+        added += td.shape[0]
+    return added
@@ -0,0 +1,106 @@
+"""
+Critic targets of short-horizon rollouts.
+
+The TD(lambda) targets of PWM and SHAC are defined by a backward recurrence
+over the horizon. Every quantity in it is a first-order linear recurrence
+x_i = a_i * x_{i+1} + b_i, which `linear_recurrence` evaluates in closed
+form as one product with a [H, H+1] discount matrix per rollout instead of H
+sequential steps. All functions take tensors of shape [H, *batch], so many
+rollouts (e.g. of several seeds or imagination batches) are handled at once.
+"""
+
+import torch
+import torch.nn.functional as F
+
+
+def discount_matrix(a):
+    """
+    Matrix M [*batch, H, H+1] with M[i, j] = a_i * ... * a_{j-1} for j >= i
+    and 0 otherwise, for non-negative coefficients `a` [H, *batch]. Built from
+    cumulative log-sums in float64; zero coefficients are counted separately.
+    """
+    a = a.movedim(0, -1).double()
+    zero = a == 0
+    log_a = torch.where(zero, torch.zeros_like(a), a.log())
+    L = F.pad(log_a.cumsum(-1), (1, 0))  # [*batch, H+1]
+    Z = F.pad(zero.long().cumsum(-1), (1, 0))
+
+    H = a.shape[-1]
+    upper = torch.ones(H, H + 1, dtype=torch.bool, device=a.device).triu()
+    mask = (Z[..., None, :] == Z[..., :H, None]) & upper
+    diff = L[..., None, :] - L[..., :H, None]
+    return torch.exp(diff.masked_fill(~mask, float("-inf")))
+
+
+def linear_recurrence(a, b, x_last):
+    """
+    Solve x_i = a_i * x_{i+1} + b_i for i = H-1, ..., 0 with x_H = `x_last`.
+    `a` and `b` are [H, *batch], `x_last` broadcasts to [*batch]. Returns x [H, *batch].
+    Only b_j with j >= i enter x_i, so non-finite entries of `b` spread to
+    the earlier steps exactly as in the sequential recurrence.
+    """
+    M = discount_matrix(a).to(b.dtype)
+    x_last = torch.as_tensor(x_last, dtype=b.dtype, device=b.device)
+    b = b.movedim(0, -1)
+    H = b.shape[-1]
+    upper = torch.ones(H, H, dtype=torch.bool, device=b.device).triu()
+    terms = torch.where(upper, M[..., :-1] * b[..., None, :], torch.zeros_like(M[..., :-1]))
+    x = terms.sum(dim=-1) + M[..., -1] * x_last
+    return x.movedim(-1, 0)
+
+
+def one_step_targets(rew, next_values, gamma):
+    """One-step TD targets r_i + gamma * V(s_{i+1})."""
+    return rew + gamma * next_values
+
+
+def td_lambda_targets(rew, next_values, done_mask, gamma, lam):
+    """
+    TD(lambda) targets of rollouts with rewards `rew`, bootstrap values
+    `next_values` and termination / truncation flags `done_mask`, all
+    [H, *batch]. Equal to `td_lambda_targets_loop` up to float rounding.
+    """
+    not_done = 1.0 - done_mask
+    # weight of the bootstrapped tail, lam_H = 1
+    lam_i = linear_recurrence(lam * not_done, done_mask, 1.0)
+    A = linear_recurrence(
+        lam * gamma * not_done,
+        not_done * (gamma * next_values + (1.0 - lam_i) / (1.0 - lam) * rew),
+        0.0,
+    )
+    B = linear_recurrence(
+        gamma * not_done, gamma * next_values * done_mask + rew, 0.0
+    )
+    return (1.0 - lam) * A + lam_i * B
+
+
+def td_lambda_targets_loop(rew, next_values, done_mask, gamma, lam):
+    """Reference TD(lambda) recurrence, one step at a time."""
+    horizon = rew.shape[0]
+    target_values = torch.zeros_like(rew)
+    Ai = torch.zeros_like(rew[0])
+    Bi = torch.zeros_like(rew[0])
+    lam_i = torch.ones_like(rew[0])
+    for i in reversed(range(horizon)):
+        lam_i = lam_i * lam * (1.0 - done_mask[i]) + done_mask[i]
+        Ai = (1.0 - done_mask[i]) * (
+            lam * gamma * Ai
+            + gamma * next_values[i]
+            + (1.0 - lam_i) / (1.0 - lam) * rew[i]
+        )
+        Bi = (
+            gamma * (next_values[i] * done_mask[i] + Bi * (1.0 - done_mask[i]))
+            + rew[i]
+        )
+        target_values[i] = (1.0 - lam) * Ai + lam_i * Bi
+    return target_values
+
+
+@torch.no_grad()
+def compute_target_values(method, rew, next_values, done_mask, gamma, lam):
+    """Critic targets for `method` 'one-step' or 'td-lambda'."""
+    if method == "one-step":
+        return one_step_targets(rew, next_values, gamma)
+    elif method == "td-lambda":
+        return td_lambda_targets(rew, next_values, done_mask, gamma, lam)
+    raise NotImplementedError(method)